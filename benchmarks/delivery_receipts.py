@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Delivery receipt handling cost against chat buffer size.
+# Usage: python benchmarks/delivery_receipts.py
+
+import os
+import sys
+import time
+import xmpp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmpp_session_pool.event_id import XMPPSessionEventID
+from xmpp_session_pool.message_store import XMPPMessagesStore
+from xmpp_session_pool.xmpp_roster import XMPPRoster
+
+CONTACT_JID = 'contact@example.com'
+
+
+class RosterOwner(object):
+    def __init__(self, roster):
+        self.roster = roster
+
+    def getRoster(self):
+        return self.roster
+
+
+def receipt_stanza(message_id):
+    received = xmpp.protocol.Protocol(name='received', xmlns='urn:xmpp:receipts', attrs={'id':message_id})
+    return xmpp.protocol.Message(frm=CONTACT_JID, payload=[received])
+
+
+def run(chat_buffer_size, receipts=1000):
+    id_generator = XMPPSessionEventID()
+    roster = XMPPRoster(id_generator)
+    store = XMPPMessagesStore(id_generator, chat_buffer_size=chat_buffer_size)
+    store._owner = RosterOwner(roster)
+    contact_id = roster.itemId(CONTACT_JID)
+
+    for i in xrange(chat_buffer_size):
+        store.append_message(contact_id=contact_id, inbound=False, text='message', message_id='out%d'%i)
+
+    stanzas = [receipt_stanza('out%d'%i) for i in xrange(chat_buffer_size - receipts, chat_buffer_size)]
+
+    start = time.time()
+    for stanza in stanzas:
+        store.xmpp_delivery_status_handler(None, stanza)
+    return (time.time() - start) / len(stanzas)
+
+
+def main():
+    print '%15s %20s'%('chat_buffer_size', 'us per receipt')
+    for chat_buffer_size in (1000, 10000, 100000):
+        print '%15d %20.2f'%(chat_buffer_size, run(chat_buffer_size) * 1000000)
+
+
+if __name__ == '__main__':
+    main()
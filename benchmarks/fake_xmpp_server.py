@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Local stand-in XMPP server for benchmarks: SASL PLAIN, resource binding, session,
+# a generated roster with versioning (XEP-0237), presences, message routing between connected
+# users and stream management with resumption (XEP-0198). No TLS.
+# Usage: python benchmarks/fake_xmpp_server.py [PORT]
+
+import base64
+import itertools
+import logging
+import sys
+import xmpp
+from xmpp.simplexml import NodeBuilder, ustr
+from tornado import ioloop
+from tornado.tcpserver import TCPServer
+
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_ROSTER = 'jabber:iq:roster'
+NS_SM = 'urn:xmpp:sm:3'
+NS_ROSTER_VER = 'urn:xmpp:features:rosterver'
+STANZAS = ('message', 'presence', 'iq')
+
+STREAM_HEADER = ("<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+                 "xmlns:stream='http://etherx.jabber.org/streams' id='%s' from='%s' version='1.0'>")
+
+
+class FakeStreamSession(object):
+    """ Stream management state which outlives connection until stream is closed or resumed."""
+    ids = itertools.count()
+
+    def __init__(self, connection):
+        self.id = 'sm%d' % self.ids.next()
+        self.jid = connection.jid
+        self.resource = connection.resource
+        self.connection = connection
+        self.inbound = 0
+        self.outbound = 0
+        self.unacked = []
+
+    def track(self, data):
+        self.outbound += 1
+        self.unacked.append((self.outbound, data))
+
+    def acknowledged(self, h):
+        self.unacked = [(sequence, data) for sequence, data in self.unacked if sequence > h]
+
+
+class FakeXMPPConnection(object):
+    ids = itertools.count()
+
+    def __init__(self, server, stream):
+        self.server = server
+        self.stream = stream
+        self.user = None
+        self.resource = None
+        self.authenticated = False
+        self.available = False
+        self.stanzas_received = 0
+        self.session = None
+        self.closed_cleanly = False
+        self.stream.set_close_callback(self.on_close)
+        self.restart()
+        self.stream.read_until_close(self.on_close_data, streaming_callback=self.on_data)
+
+    @property
+    def jid(self):
+        return '%s@%s' % (self.user, self.server.domain)
+
+    def restart(self):
+        self.parser = NodeBuilder()
+        self.parser._dispatch_depth = 2
+        self.parser.dispatch = self.dispatch
+        self.parser.stream_header_received = self.stream_header_received
+        self.parser.stream_footer_received = self.stream_footer_received
+
+    def write(self, data):
+        name = None
+        if not isinstance(data, basestring):
+            name = data.getName()
+            data = ustr(data)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self.session is not None and name in STANZAS:
+            self.session.track(data)
+        if self.stream.closed():
+            return
+        self.stream.write(data)
+        if self.session is not None and name == 'message':
+            self.stream.write("<r xmlns='%s'/>" % NS_SM)
+
+    def on_data(self, data):
+        try:
+            self.parser.Parse(data)
+        except Exception:
+            logging.exception('fake server parse error')
+            self.stream.close()
+
+    def on_close_data(self, data):
+        pass
+
+    def on_close(self):
+        self.server.connection_closed(self)
+        if self.session is not None and self.session.connection is self:
+            self.session.connection = None
+            if self.closed_cleanly:
+                self.server.stream_sessions.pop(self.session.id, None)
+
+    def stream_header_received(self, ns, tag, attrs):
+        self.write(STREAM_HEADER % (self.ids.next(), self.server.domain))
+        features = xmpp.Node('stream:features')
+        if not self.authenticated:
+            mechanisms = features.addChild('mechanisms', namespace=NS_SASL)
+            mechanisms.addChild('mechanism').setData('PLAIN')
+        else:
+            features.addChild('bind', namespace=NS_BIND)
+            features.addChild('session', namespace=NS_SESSION)
+            if self.server.stream_management:
+                features.addChild('sm', namespace=NS_SM)
+            if self.server.roster_versioning:
+                features.addChild('ver', namespace=NS_ROSTER_VER)
+        self.write(features)
+
+    def stream_footer_received(self):
+        self.closed_cleanly = True
+        self.write('</stream:stream>')
+        self.stream.close()
+
+    def dispatch(self, node):
+        self.stanzas_received += 1
+        name = node.getName()
+        if self.session is not None and name in STANZAS:
+            self.session.inbound += 1
+        if node.getNamespace() == NS_SM:
+            self.handle_stream_management(node)
+        elif name == 'auth':
+            self.handle_auth(node)
+        elif name == 'iq':
+            self.handle_iq(xmpp.Iq(node=node))
+        elif name == 'presence':
+            self.handle_presence(xmpp.Presence(node=node))
+        elif name == 'message':
+            self.handle_message(xmpp.Message(node=node))
+
+    def handle_auth(self, node):
+        try:
+            authzid, user, password = base64.b64decode(node.getData()).split('\x00')
+        except Exception:
+            user, password = None, None
+        if user is not None and self.server.check_password(user, password):
+            self.user = user
+            self.authenticated = True
+            self.server.logins += 1
+            self.write("<success xmlns='%s'/>" % NS_SASL)
+            self.restart()
+        else:
+            self.write("<failure xmlns='%s'><not-authorized/></failure>" % NS_SASL)
+
+    def handle_iq(self, iq):
+        result = iq.buildReply('result')
+        query_ns = iq.getQueryNS()
+        if iq.getTag('bind') is not None:
+            resource = iq.getTag('bind').getTagData('resource') or 'fake'
+            self.resource = resource
+            result.addChild('bind', namespace=NS_BIND).addChild('jid').setData('%s/%s' % (self.jid, resource))
+        elif query_ns == NS_ROSTER and iq.getType() == 'get':
+            version = self.server.roster_version(self.user)
+            if self.server.roster_versioning and iq.getTag('query').getAttr('ver') == version:
+                self.server.roster_unchanged += 1
+                self.write(xmpp.Iq('result', attrs={'id':iq.getID()}))
+                return
+            self.server.roster_requests += 1
+            query = result.setTag('query', namespace=NS_ROSTER)
+            if self.server.roster_versioning:
+                query.setAttr('ver', version)
+            for contact_jid in self.server.roster(self.user):
+                query.addChild('item', attrs={'jid':contact_jid, 'subscription':'both', 'name':contact_jid.split('@')[0]})
+        self.write(result)
+
+    def handle_presence(self, presence):
+        if presence.getTo() is None and presence.getType() is None and not self.available:
+            self.available = True
+            for contact_jid in self.server.roster(self.user)[:self.server.online_contacts]:
+                self.write(xmpp.Presence(frm=contact_jid + '/fake', to=self.jid))
+
+    def handle_message(self, message):
+        self.server.route(message, self)
+
+    def handle_stream_management(self, node):
+        name = node.getName()
+        if name == 'enable' and self.server.stream_management:
+            self.session = FakeStreamSession(self)
+            self.server.stream_sessions[self.session.id] = self.session
+            self.write("<enabled xmlns='%s' id='%s' resume='true'/>" % (NS_SM, self.session.id))
+        elif name == 'resume':
+            session = self.server.stream_sessions.get(node.getAttr('previd'))
+            if session is None or session.jid != self.jid:
+                self.write("<failed xmlns='%s'><item-not-found xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></failed>" % NS_SM)
+                return
+            if session.connection is not None:
+                session.connection.session = None
+                session.connection.stream.close()
+            self.server.resumes += 1
+            session.acknowledged(int(node.getAttr('h')))
+            session.connection = self
+            self.session = session
+            self.resource = session.resource
+            self.available = True
+            self.write("<resumed xmlns='%s' previd='%s' h='%d'/>" % (NS_SM, session.id, session.inbound))
+            for sequence, data in session.unacked:
+                self.stream.write(data)
+        elif name == 'r' and self.session is not None:
+            self.write("<a xmlns='%s' h='%d'/>" % (NS_SM, self.session.inbound))
+        elif name == 'a' and self.session is not None:
+            self.session.acknowledged(int(node.getAttr('h')))
+
+
+class FakeXMPPServer(TCPServer):
+    def __init__(self, domain='localhost', roster_size=10, online_contacts=0, password='password',
+                 stream_management=True, roster_versioning=True, io_loop=None):
+        super(FakeXMPPServer, self).__init__(io_loop=io_loop)
+        self.domain = domain
+        self.roster_size = roster_size
+        self.online_contacts = online_contacts
+        self.password = password
+        self.stream_management = stream_management
+        self.roster_versioning = roster_versioning
+        self.connections = set()
+        self.stream_sessions = {}
+        self.logins = 0
+        self.resumes = 0
+        self.roster_requests = 0
+        self.roster_unchanged = 0
+
+    def handle_stream(self, stream, address):
+        self.connections.add(FakeXMPPConnection(self, stream))
+
+    def connection_closed(self, connection):
+        self.connections.discard(connection)
+
+    def check_password(self, user, password):
+        return password == self.password
+
+    def roster(self, user):
+        return ['contact%d@%s' % (i, self.domain) for i in xrange(self.roster_size)]
+
+    def roster_version(self, user):
+        return 'v%d' % self.roster_size
+
+    def route(self, message, connection):
+        to = message.getTo()
+        if to is None:
+            return
+        message.setFrom('%s/%s' % (connection.jid, connection.resource))
+        for other in self.connections:
+            if other.authenticated and other.jid == to.getStripped():
+                other.write(message)
+        for session in self.stream_sessions.itervalues():
+            if session.connection is None and session.jid == to.getStripped():
+                session.track(ustr(message).encode('utf-8'))
+
+    def drop_connections(self):
+        for connection in list(self.connections):
+            connection.stream.close()
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5222
+    server = FakeXMPPServer()
+    server.listen(port, '127.0.0.1')
+    ioloop.IOLoop.instance().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Payload bytes and encode time of a 1k-contact feed for the available encoders,
+# with full objects and with a fields projection.
+# Usage: python benchmarks/feed_encoding.py
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmpp_session_pool.event_id import XMPPSessionEventID
+from xmpp_session_pool.message import XMPPMessage
+from xmpp_session_pool.xmpp_roster import XMPPRoster
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CONTACT_FIELDS = ['id', 'name', 'show', 'status', 'read_offset', 'event_id']
+MESSAGE_FIELDS = ['contact_id', 'inbound', 'text', 'timestamp', 'event_id']
+
+
+def feed(contacts_count=1000, messages_count=200):
+    id_generator = XMPPSessionEventID()
+    roster = XMPPRoster(id_generator)
+    for i in xrange(contacts_count):
+        item = roster._new_roster_item(u'contact%d@example.com'%i)
+        roster._touch_item(item)
+        item['name'] = u'Contact %d'%i
+        item['subscription'] = 'both'
+        item['authorization'] = 'granted'
+        item['groups'] = [u'Friends']
+        if i % 3 == 0:
+            item['show'] = 'online'
+            item['status'] = u'At work'
+
+    contacts = roster.getContacts()
+    messages = []
+    for i in xrange(messages_count):
+        contact = contacts[i % len(contacts)]
+        message = XMPPMessage(event_id=id_generator.id(), inbound=bool(i % 2), text=u'message text %d'%i,
+                              timestamp=time.time(), contact_id=contact['id'], message_id=str(i))
+        messages.append(message.as_dict())
+
+    return {'contacts':contacts, 'messages':messages}
+
+
+def project(objects, fields):
+    return [dict((field, item[field]) for field in fields if field in item) for item in objects]
+
+
+def measure(encode, response, repeat=20):
+    started = time.time()
+    for i in xrange(repeat):
+        payload = encode(response)
+    return len(payload), (time.time() - started) / repeat * 1000
+
+
+def main():
+    encoders = [('json', json.dumps)]
+    if ujson is not None:
+        encoders.append(('ujson', ujson.dumps))
+    if msgpack is not None:
+        encoders.append(('msgpack', msgpack.packb))
+
+    full = feed()
+    projected = {'contacts':project(full['contacts'], CONTACT_FIELDS),
+                 'messages':project(full['messages'], MESSAGE_FIELDS)}
+
+    print '%10s %10s %12s %12s'%('encoder', 'fields', 'bytes', 'encode, ms')
+    for name, encode in encoders:
+        for fields, response in (('all', full), ('projected', projected)):
+            size, encode_time = measure(encode, response)
+            print '%10s %10s %12d %12.2f'%(name, fields, size, encode_time)
+
+
+if __name__ == '__main__':
+    main()
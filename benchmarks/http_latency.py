@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# HTTP latency under inbound XMPP load with streams read and handled on the main IOLoop, as data arrives
+# or limited to BUDGET seconds per IOLoop iteration, and on IO_LOOPS sharded XMPP IOLoop threads.
+# COUNT sessions are logged in to the local stand-in XMPP server, then the server floods every connection
+# with RATE messages every INTERVAL ms while a separate process makes sequential HTTP requests
+# to the service for DURATION seconds and reports their latency.
+# Each configuration runs in a child process, the stand-in server runs in another one.
+# Sessions use the default XMPP port, so the stand-in server listens on 5222.
+# Usage: python benchmarks/http_latency.py [COUNT] [RATE] [INTERVAL] [DURATION] [BUDGET] [IO_LOOPS],
+# IO_LOOPS are comma separated
+
+import os
+import sys
+import time
+import httplib
+import itertools
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop, gen, web
+from xmpp_session_pool import XMPPSessionPool
+from xmpp_session_pool.xmpp_client import XMPPClient
+from fake_xmpp_server import FakeXMPPServer
+
+PORT = 5222
+HTTP_PORT = 18889
+FLOOD_JID = 'flood@localhost'
+
+
+class FloodingXMPPServer(FakeXMPPServer):
+    """ Message to FLOOD_JID switches flooding of all connections on and off."""
+    def __init__(self, rate, interval, **kwargs):
+        super(FloodingXMPPServer, self).__init__(**kwargs)
+        self.rate = rate
+        self.sent = 0
+        self.flood = ioloop.PeriodicCallback(self._flood, interval, io_loop=self.io_loop)
+
+    def route(self, message, connection):
+        if message.getTo() is not None and message.getTo().getStripped() == FLOOD_JID:
+            if self.flood._running:
+                self.flood.stop()
+            else:
+                self.flood.start()
+            return
+        super(FloodingXMPPServer, self).route(message, connection)
+
+    def _flood(self):
+        for connection in self.connections:
+            if not connection.authenticated:
+                continue
+            data = ''.join("<message from='contact%d@localhost/flood' to='%s' type='chat'><body>flood %d</body></message>"%
+                           (i, connection.jid, self.sent + i) for i in xrange(self.rate))
+            connection.stream.write(data)
+            self.sent += self.rate
+
+
+class StatusHandler(web.RequestHandler):
+    def initialize(self, pool):
+        self.pool = pool
+
+    def get(self):
+        self.write({'sessions':len(self.pool.session_pool)})
+
+
+def serve(rate, interval):
+    # Child process inherits IOLoop instance of the parent, so server gets its own
+    io_loop = ioloop.IOLoop()
+    server = FloodingXMPPServer(rate, interval, roster_size=20, stream_management=False, io_loop=io_loop)
+    server.listen(PORT, '127.0.0.1')
+    io_loop.start()
+
+
+def request_latencies(duration, results):
+    connection = httplib.HTTPConnection('127.0.0.1', HTTP_PORT)
+    latencies = []
+    finish = time.time() + duration
+    while time.time() < finish:
+        started = time.time()
+        connection.request('GET', '/status')
+        connection.getresponse().read()
+        latencies.append(time.time() - started)
+    results.put(latencies)
+
+
+@gen.coroutine
+def run(count, duration, io_loops, stanza_budget, flood):
+    io_loop = ioloop.IOLoop.instance()
+    pool = XMPPSessionPool(io_loops=io_loops, stanza_budget=stanza_budget, keepalive_interval=0)
+    application = web.Application([(r'/status', StatusHandler, {'pool':pool})])
+    application.listen(HTTP_PORT, '127.0.0.1')
+
+    # Handlers run on several threads, next() of itertools.count is atomic
+    received = itertools.count()
+    message_handler = XMPPClient._xmpp_message_handler
+    def counting_message_handler(client, con, event):
+        next(received)
+        return message_handler(client, con, event)
+    XMPPClient._xmpp_message_handler = counting_message_handler
+
+    session_ids = yield [pool.start_session('user%d@localhost'%i, 'password', server='127.0.0.1')
+                         for i in xrange(count)]
+    session = pool.session_for_id(session_ids[0])
+    yield gen.Task(io_loop.add_timeout, time.time() + 0.5)
+
+    if flood:
+        session.send_by_jid(FLOOD_JID, 'start')
+        yield gen.Task(io_loop.add_timeout, time.time() + 0.5)
+    received_before = next(received)
+
+    results = multiprocessing.Queue()
+    requests = multiprocessing.Process(target=request_latencies, args=(duration, results))
+    requests.start()
+    while requests.is_alive() and results.empty():
+        yield gen.Task(io_loop.add_timeout, time.time() + 0.05)
+    latencies = sorted(results.get())
+    messages = next(received) - received_before - 1
+    requests.join()
+
+    if flood:
+        session.send_by_jid(FLOOD_JID, 'stop')
+        yield gen.Task(io_loop.add_timeout, time.time() + 0.5)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    if io_loops:
+        parsing = '%d loops'%io_loops
+    else:
+        parsing = '%gs budget'%stanza_budget if stanza_budget else 'as arrives'
+    print '%-6s %-12s %10d %8.2f %8.2f %8.2f %8.2f %12d'%('flood' if flood else 'idle', parsing, len(latencies),
+                                                         percentile(0.5), percentile(0.99), percentile(0.999),
+                                                         latencies[-1] * 1000, messages / duration)
+    if pool.stanza_scheduler is not None:
+        print '       %s'%pool.stanza_scheduler.stats()
+    if pool.io_loop_pool is not None:
+        print '       %s'%pool.io_loop_pool.stats()
+
+
+def run_in_process(count, duration, io_loops, stanza_budget, flood):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    ioloop.IOLoop.instance().run_sync(lambda: run(count, duration, io_loops, stanza_budget, flood), timeout=duration + 120)
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def main(count=50, rate=100, interval=1000, duration=10, stanza_budget=0.01, io_loops='2,4'):
+    server = multiprocessing.Process(target=serve, args=(rate, interval))
+    server.start()
+    time.sleep(0.5)
+    print '%-6s %-12s %10s %8s %8s %8s %8s %12s'%('load', 'parsing', 'requests', 'p50 ms', 'p99 ms', 'p99.9 ms',
+                                                 'max ms', 'messages/s')
+    try:
+        configurations = [(0, None, False), (0, None, True), (0, stanza_budget, True)]
+        configurations += [(int(loops), None, True) for loops in io_loops.split(',') if int(loops)]
+        for loops, budget, flood in configurations:
+            process = multiprocessing.Process(target=run_in_process, args=(count, duration, loops, budget, flood))
+            process.start()
+            process.join()
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:4]] + [float(arg) for arg in args[4:5]] + args[5:6])
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Cost of keepalive timer wheel ticks for COUNT connections, of which IDLE percent
+# received nothing during the last interval and get pinged.
+# Usage: python benchmarks/keepalive_wheel.py [COUNT] [IDLE]
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmpp_session_pool.keepalive import XMPPKeepalive
+
+
+class Connection(object):
+    def __init__(self, last_received):
+        self.last_received = last_received
+
+
+class XMPPClient(object):
+    """ Connected client stand-in, pings are counted instead of sent and answered at once."""
+    Server = 'localhost'
+    jid = 'user@localhost'
+
+    logged_in = True
+
+    def __init__(self, last_received):
+        self.Connection = Connection(last_received)
+        self.lock = threading.RLock()
+        self.sent = 0
+
+    def send(self, stanza):
+        self.sent += 1
+        self.Connection.last_received = time.time()
+
+
+def main(count=50000, idle=10):
+    interval = 60
+    keepalive = XMPPKeepalive(idle_interval=interval, pong_timeout=30)
+    now = time.time()
+    clients = []
+    for i in xrange(count):
+        client = XMPPClient(now - interval if i % 100 < idle else now)
+        clients.append(client)
+        keepalive.add(client)
+
+    ticks = []
+    for i in xrange(len(keepalive._slots)):
+        tick_started = time.time()
+        keepalive._advance()
+        ticks.append(time.time() - tick_started)
+    ticks.sort()
+
+    print '%-28s %d'%('connections', count)
+    print '%-28s %d'%('wheel slots', len(keepalive._slots))
+    print '%-28s %d'%('pings sent', sum(client.sent for client in clients))
+    print '%-28s %.2f'%('one revolution, ms', sum(ticks) * 1000)
+    print '%-28s %.2f'%('median tick, ms', ticks[len(ticks) / 2] * 1000)
+    print '%-28s %.2f'%('worst tick, ms', ticks[-1] * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Login throughput against the local stand-in XMPP server: COUNT concurrent IOLoop driven
+# logins (connect_async) versus blocking xmpppy logins on a thread pool of WORKERS.
+# Each login is TCP connect, SASL, bind, session, presence and roster fetch.
+# Server runs in a child process, with LATENCY seconds added before each of its writes.
+# Usage: python benchmarks/login_throughput.py [COUNT] [WORKERS] [LATENCY]
+
+import os
+import sys
+import time
+import resource
+import multiprocessing
+import xmpp
+from concurrent import futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop, gen
+from xmpp_session_pool.xmpp_client import XMPPClient
+from fake_xmpp_server import FakeXMPPServer, FakeXMPPConnection
+
+PORT = 15222
+
+
+def serve(port, latency):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    io_loop = ioloop.IOLoop.instance()
+    if latency:
+        write = FakeXMPPConnection.write
+        FakeXMPPConnection.write = lambda self, data: io_loop.add_timeout(time.time() + latency,
+                                                                          lambda: write(self, data))
+    server = FakeXMPPServer(roster_size=50)
+    server.listen(port, '127.0.0.1')
+    io_loop.start()
+
+
+def clients(count):
+    return [XMPPClient('user%d@localhost'%i, 'password', '127.0.0.1', PORT) for i in xrange(count)]
+
+
+def login_blocking(index):
+    """ Same steps with xmpppy's blocking connect and auth, the way logins were done before connect_async."""
+    client = xmpp.Client('localhost', PORT, debug=[])
+    client.connect(server=('127.0.0.1', PORT))
+    client.auth('user%d'%index, 'password', 'bench')
+    client.sendInitPresence()
+    client.getRoster()
+    return client
+
+
+def close(clients):
+    for client in clients:
+        if client.isConnected():
+            client.Connection.disconnect()
+
+
+def run_async(count):
+    logins = clients(count)
+    io_loop = ioloop.IOLoop.instance()
+
+    @gen.coroutine
+    def login_all():
+        yield [client.connect_async() for client in logins]
+
+    started = time.time()
+    io_loop.run_sync(login_all)
+    elapsed = time.time() - started
+    close(logins)
+    return elapsed
+
+
+def run_blocking(count, workers):
+    started = time.time()
+    with futures.ThreadPoolExecutor(workers) as executor:
+        logins = list(executor.map(login_blocking, xrange(count)))
+    elapsed = time.time() - started
+    close(logins)
+    return elapsed
+
+
+def main(count=500, workers=10, latency=0.01):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    server = multiprocessing.Process(target=serve, args=(PORT, latency))
+    server.start()
+    try:
+        time.sleep(1)
+        print '%-28s %12s %12s'%('', 'seconds', 'logins/s')
+        elapsed = run_async(count)
+        print '%-28s %12.2f %12.1f'%('async, %d concurrent'%count, elapsed, count / elapsed)
+        elapsed = run_blocking(count, workers)
+        print '%-28s %12.2f %12.1f'%('blocking, %d threads'%workers, elapsed, count / elapsed)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]] + [float(arg) for arg in args[2:]])
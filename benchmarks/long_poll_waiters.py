@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Memory and wakeup latency of concurrent idle /notification long-polls,
+# and cleanup of waiters when clients disconnect.
+# Server runs in a child process, so each side needs COUNT file descriptors.
+# Usage: python benchmarks/long_poll_waiters.py [COUNT]
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop, iostream, web, httpclient
+from xmpp_session_pool.session import XMPPSession
+from tornado_app import SessionNotificationHandler
+
+SESSION_ID = 'benchmark'
+TOKEN = 'token'
+REQUEST = ('GET /sessions/%s/notification HTTP/1.1\r\n'
+           'Host: localhost\r\n'
+           'Authorization: Bearer %s\r\n\r\n')%(SESSION_ID, TOKEN)
+
+
+class IdleXMPPClient(object):
+    """ XMPP client stand-in, long-polls do not touch the connection."""
+    restored = True
+    available = True
+
+    def register_events_observer(self, observer):
+        pass
+
+    def isConnected(self):
+        return True
+
+
+class SessionPool(object):
+    def __init__(self, session):
+        self.session = session
+
+    def session_for_id(self, session_id):
+        if session_id != self.session.session_id:
+            raise KeyError(session_id)
+        return self.session
+
+
+class WakeHandler(web.RequestHandler):
+    def initialize(self, session):
+        self.session = session
+
+    def get(self):
+        self.session.notify_observers()
+
+
+class StatsHandler(web.RequestHandler):
+    def initialize(self, session):
+        self.session = session
+
+    def get(self):
+        self.write({'waiters':len(self.session.notification_waiters), 'rss':rss()})
+
+
+def rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def raise_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(port, count):
+    raise_files_limit()
+    session = XMPPSession(SESSION_ID, IdleXMPPClient(), im_client=None, token=TOKEN, max_waiters=count)
+    options = dict(session_pool=SessionPool(session), async_worker=None)
+    application = web.Application([
+        (r"/sessions/([^/]*)/notification", SessionNotificationHandler, options),
+        (r"/wake", WakeHandler, dict(session=session)),
+        (r"/stats", StatsHandler, dict(session=session)),
+    ])
+    application.listen(port, '127.0.0.1')
+    ioloop.IOLoop.instance().start()
+
+
+def fetch(port, path):
+    response = httpclient.HTTPClient().fetch('http://127.0.0.1:%d%s'%(port, path))
+    if response.body:
+        return json.loads(response.body)
+
+
+def wait_for_waiters(port, count, timeout=60):
+    deadline = time.time() + timeout
+    while True:
+        stats = fetch(port, '/stats')
+        if stats['waiters'] == count or time.time() > deadline:
+            return stats
+        time.sleep(0.1)
+
+
+def open_polls(port, count):
+    io_loop = ioloop.IOLoop.instance()
+    streams = []
+    pending = [count]
+
+    def connected():
+        pending[0] -= 1
+        if not pending[0]:
+            io_loop.stop()
+
+    for i in xrange(count):
+        stream = iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        stream.connect(('127.0.0.1', port), connected)
+        stream.write(REQUEST)
+        streams.append(stream)
+
+    io_loop.start()
+    return streams
+
+
+def measure_wakeup(port, streams):
+    io_loop = ioloop.IOLoop.instance()
+    latencies = []
+    pending = [len(streams)]
+
+    def response_received(data):
+        latencies.append(time.time() - started)
+        pending[0] -= 1
+        if not pending[0]:
+            io_loop.stop()
+
+    for stream in streams:
+        stream.read_until('\r\n\r\n', response_received)
+
+    started = time.time()
+    fetch(port, '/wake')
+    io_loop.start()
+    latencies.sort()
+    return latencies
+
+
+def main(count=10000):
+    raise_files_limit()
+    port = 18888
+    server = multiprocessing.Process(target=serve, args=(port, count))
+    server.start()
+    try:
+        time.sleep(1)
+        idle_rss = fetch(port, '/stats')['rss']
+
+        streams = open_polls(port, count)
+        stats = wait_for_waiters(port, count)
+        waiting_rss = stats['rss']
+        print '%-28s %d'%('waiters', stats['waiters'])
+        print '%-28s %.1f'%('bytes per waiter', (waiting_rss - idle_rss) / float(count))
+
+        latencies = measure_wakeup(port, streams)
+        print '%-28s %.1f'%('wakeup p50, ms', latencies[len(latencies) / 2] * 1000)
+        print '%-28s %.1f'%('wakeup p99, ms', latencies[int(len(latencies) * 0.99)] * 1000)
+        print '%-28s %.1f'%('wakeup all, ms', latencies[-1] * 1000)
+        for stream in streams:
+            stream.close()
+
+        streams = open_polls(port, count)
+        wait_for_waiters(port, count)
+        for stream in streams:
+            stream.close()
+        stats = wait_for_waiters(port, 0)
+        print '%-28s %d'%('waiters after disconnect', stats['waiters'])
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Resident bytes per buffered message for dict and slotted message records.
+# Usage: python benchmarks/message_memory.py
+
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmpp_session_pool.message import XMPPMessage
+
+
+def dict_message(event_id, contact_id, text, message_id):
+    return {'event_id':event_id,
+            'inbound':True,
+            'text':text,
+            'timestamp':time.time(),
+            'contact_id':contact_id,
+            'message_id':message_id,
+            'delivered':False,
+            'delivery_receipt_asked':True}
+
+
+def slotted_message(event_id, contact_id, text, message_id):
+    return XMPPMessage(event_id=event_id,
+                       inbound=True,
+                       text=text,
+                       timestamp=time.time(),
+                       contact_id=contact_id,
+                       message_id=message_id,
+                       delivered=False,
+                       delivery_receipt_asked=True)
+
+
+def record_size(message, fields):
+    """ Size of the record itself plus values owned by this message only.
+        Contact ids, booleans and small ints are shared between messages."""
+    size = sys.getsizeof(message)
+    for value in fields(message):
+        size += sys.getsizeof(value)
+    return size
+
+
+def run(factory, fields, count):
+    contact_id = uuid.uuid4().hex
+    messages = [factory(i, contact_id, u'message text %d'%i, 'purple%d'%i) for i in xrange(count)]
+    return sum(record_size(message, fields) for message in messages) / float(count)
+
+
+def main(count=50000):
+    dict_fields = lambda message: (message['text'], message['timestamp'], message['message_id'])
+    slotted_fields = lambda message: (message.text, message.timestamp, message.message_id)
+
+    before = run(dict_message, dict_fields, count)
+    after = run(slotted_message, slotted_fields, count)
+
+    print '%10s %20s'%('record', 'bytes per message')
+    print '%10s %20.1f'%('dict', before)
+    print '%10s %20.1f'%('slotted', after)
+
+
+if __name__ == '__main__':
+    main()
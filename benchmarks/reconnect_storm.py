@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Reconnect policy check: COUNT sessions are logged in to the local stand-in XMPP server,
+# then the server drops all connections and refuses new ones for DOWNTIME seconds.
+# Reports session states, reconnect attempts, peak concurrent logins and the longest IOLoop stall,
+# and exits with status 1 when the policy is violated: a session did not reconnect, more than
+# CONCURRENCY logins were in progress at once, or reconnect delays did not back off exponentially.
+# Sessions use the default XMPP port, so the stand-in server listens on 5222.
+# Usage: python benchmarks/reconnect_storm.py [COUNT] [CONCURRENCY] [DOWNTIME]
+
+import os
+import sys
+import time
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop, gen
+from xmpp_session_pool import XMPPSessionPool
+from xmpp_session_pool.xmpp_client import XMPPClient
+from fake_xmpp_server import FakeXMPPServer
+
+PORT = 5222
+
+
+class IOLoopLag(object):
+    """ Longest gap between ticks of a 10 ms periodic callback."""
+    def __init__(self):
+        self.last = time.time()
+        self.max_gap = 0.0
+        ioloop.PeriodicCallback(self.tick, 10).start()
+
+    def tick(self):
+        now = time.time()
+        self.max_gap = max(self.max_gap, now - self.last)
+        self.last = now
+
+
+def check_backoff(delays, scheduler):
+    """ Every delay is within the bound of its attempt and delays grow while the bound is not capped."""
+    failures = []
+    for attempt, attempt_delays in sorted(delays.iteritems()):
+        bound = min(scheduler.max_delay, scheduler.base_delay * 2 ** attempt)
+        if max(attempt_delays) > bound + 0.01:
+            failures.append('attempt %d delay %.2f s exceeds %.2f s'%(attempt + 1, max(attempt_delays), bound))
+
+    means = [(attempt, sum(attempt_delays) / len(attempt_delays)) for attempt, attempt_delays in sorted(delays.iteritems())
+             if len(attempt_delays) >= 20 and scheduler.base_delay * 2 ** attempt <= scheduler.max_delay]
+    for (attempt, mean), (next_attempt, next_mean) in zip(means, means[1:]):
+        if next_mean <= mean:
+            failures.append('mean delay of attempt %d, %.2f s, is not above attempt %d, %.2f s'%
+                            (next_attempt + 1, next_mean, attempt + 1, mean))
+    if len(means) < 2:
+        failures.append('too few reconnect attempts to check backoff: %s'%
+                        dict((attempt + 1, len(attempt_delays)) for attempt, attempt_delays in delays.iteritems()))
+    return failures
+
+
+def count_states(sessions):
+    states = {}
+    for session in sessions:
+        states[session.state] = states.get(session.state, 0) + 1
+    return states
+
+
+@gen.coroutine
+def run(count, concurrency, downtime):
+    io_loop = ioloop.IOLoop.instance()
+    server = FakeXMPPServer()
+    server.listen(PORT, '127.0.0.1')
+    pool = XMPPSessionPool(reconnect_max_delay=5, reconnect_concurrency=concurrency)
+
+    session_ids = yield [pool.start_session('user%d@localhost'%i, 'password', server='127.0.0.1')
+                         for i in xrange(count)]
+    sessions = [pool.session_for_id(session_id) for session_id in session_ids]
+    print '%-28s %s'%('logged in', count_states(sessions))
+
+    peak = [0]
+    connect_async = XMPPClient.connect_async
+    def counting_connect_async(client, *args, **kwargs):
+        peak[0] = max(peak[0], pool.reconnect_scheduler.stats()['connecting'])
+        return connect_async(client, *args, **kwargs)
+    XMPPClient.connect_async = counting_connect_async
+
+    scheduler = pool.reconnect_scheduler
+    delays = {}
+    schedule = scheduler._schedule
+    def recording_schedule(client):
+        attempt = scheduler._attempts.get(client, 0)
+        schedule(client)
+        timeout = scheduler._timeouts.get(client)
+        if timeout is not None:
+            delays.setdefault(attempt, []).append(timeout.deadline - time.time())
+    scheduler._schedule = recording_schedule
+
+    lag = IOLoopLag()
+    server.stop()
+    server.drop_connections()
+    dropped = time.time()
+    yield gen.Task(io_loop.add_timeout, time.time() + 0.5)
+    print '%-28s %s'%('server down', count_states(sessions))
+    print '%-28s %d'%('contacts while reconnecting', len(sessions[0].contacts()))
+
+    yield gen.Task(io_loop.add_timeout, dropped + downtime)
+    server = FakeXMPPServer()
+    server.listen(PORT, '127.0.0.1')
+    while count_states(sessions).get('connected', 0) < count and time.time() - dropped < downtime + 60:
+        yield gen.Task(io_loop.add_timeout, time.time() + 0.1)
+
+    print '%-28s %s'%('server up', count_states(sessions))
+    print '%-28s %.2f'%('all reconnected after, s', time.time() - dropped)
+    print '%-28s %s'%('reconnect', pool.reconnect_scheduler.stats())
+    print '%-28s %d'%('peak concurrent logins', peak[0])
+    print '%-28s %.1f'%('longest IOLoop stall, ms', lag.max_gap * 1000)
+    print '%-28s %s'%('mean delay by attempt, s', ', '.join('%d: %.2f'%(attempt + 1, sum(values) / len(values))
+                                                           for attempt, values in sorted(delays.iteritems())))
+
+    failures = check_backoff(delays, scheduler)
+    states = count_states(sessions)
+    if states.get('connected', 0) != count:
+        failures.append('not all sessions reconnected: %s'%states)
+    if peak[0] > concurrency:
+        failures.append('%d concurrent logins, limit is %d'%(peak[0], concurrency))
+    raise gen.Return(failures)
+
+
+def main(count=200, concurrency=10, downtime=3.0):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    failures = ioloop.IOLoop.instance().run_sync(lambda: run(count, concurrency, downtime))
+    for failure in failures:
+        print 'FAILED: %s'%failure
+    if failures:
+        sys.exit(1)
+    print 'reconnect policy OK'
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]] + [float(arg) for arg in args[2:]])
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Reconnect time versus roster size with and without roster versioning (XEP-0237).
+# For every roster size a client reconnects REPEAT times to the local stand-in XMPP server,
+# then a new client logs in with the roster cached in SQLite, as after service restart.
+# Each login is TCP connect, SASL, bind, session, presence and roster request. Stream management
+# is disabled on the server, so reconnects are not resumed. Server runs in a child process.
+# Usage: python benchmarks/roster_versioning.py [SIZES] [REPEAT], SIZES are comma separated
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop, gen
+from xmpp_session_pool.xmpp_client import XMPPClient
+from xmpp_session_pool.roster_backends import SQLiteRosterStorage
+from fake_xmpp_server import FakeXMPPServer
+
+PORT = 15223
+
+
+class ManualReconnect(object):
+    """ Reconnect scheduler stand-in, benchmark reconnects clients itself."""
+    def schedule(self, client):
+        pass
+
+    def cancel(self, client):
+        pass
+
+
+def serve(port, roster_size, roster_versioning):
+    # Child process inherits IOLoop instance of the previous runs, so server gets its own
+    io_loop = ioloop.IOLoop()
+    server = FakeXMPPServer(roster_size=roster_size, stream_management=False, roster_versioning=roster_versioning,
+                            io_loop=io_loop)
+    server.listen(port, '127.0.0.1')
+    io_loop.start()
+
+
+def new_client(roster_storage):
+    return XMPPClient('user@localhost', 'password', '127.0.0.1', PORT,
+                      reconnect_scheduler=ManualReconnect(), roster_storage=roster_storage)
+
+
+@gen.coroutine
+def measure(repeat, roster_storage):
+    client = new_client(roster_storage)
+    yield client.connect_async()
+    contacts = len(client.getRoster().getRawRoster())
+
+    reconnects = []
+    for i in xrange(repeat):
+        client.Connection.disconnect()
+        client.disconnected()
+        started = time.time()
+        yield client.connect_async()
+        reconnects.append(time.time() - started)
+    client.close()
+    yield gen.Task(ioloop.IOLoop.instance().add_timeout, time.time() + 0.2)
+
+    fresh_client = new_client(roster_storage)
+    started = time.time()
+    yield fresh_client.connect_async()
+    fresh_login = time.time() - started
+    fresh_contacts = len(fresh_client.getRoster().getRawRoster())
+    fresh_client.close()
+
+    reconnects.sort()
+    raise gen.Return((contacts, fresh_contacts, reconnects[len(reconnects) / 2], fresh_login))
+
+
+def run(roster_size, roster_versioning, repeat):
+    server = multiprocessing.Process(target=serve, args=(PORT, roster_size, roster_versioning))
+    server.start()
+    path = tempfile.mkdtemp()
+    roster_storage = SQLiteRosterStorage(os.path.join(path, 'rosters.db'))
+    roster_storage.start()
+    try:
+        time.sleep(0.5)
+        return ioloop.IOLoop.instance().run_sync(lambda: measure(repeat, roster_storage), timeout=300)
+    finally:
+        roster_storage.stop()
+        roster_storage.join()
+        shutil.rmtree(path)
+        server.terminate()
+        server.join()
+
+
+def main(sizes='100,1000,5000', repeat=5):
+    print '%8s %12s %16s %12s %16s'%('contacts', 'reconnect ms', 'versioned ms', 'login ms', 'cached login ms')
+    for roster_size in [int(size) for size in sizes.split(',')]:
+        contacts, fresh_contacts, reconnect, login = run(roster_size, False, repeat)
+        versioned_contacts, cached_contacts, versioned_reconnect, cached_login = run(roster_size, True, repeat)
+        assert contacts == fresh_contacts == versioned_contacts == cached_contacts == roster_size
+        print '%8d %12.1f %16.1f %12.1f %16.1f'%(roster_size, reconnect * 1000, versioned_reconnect * 1000,
+                                                login * 1000, cached_login * 1000)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*args[:1] + [int(arg) for arg in args[1:]])
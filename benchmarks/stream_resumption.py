@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+# Stream resumption check: COUNT sessions are logged in to the local stand-in XMPP server,
+# half of them send a message to their partner and lose connection at once, so the message is
+# in flight, then partners send messages back while they are disconnected.
+# Runs with and without stream management on the server, each in a child process, and reports
+# lost and duplicated messages, logins, resumes and roster downloads on reconnect and how long
+# reconnection took.
+# Sessions use the default XMPP port, so the stand-in server listens on 5222.
+# Usage: python benchmarks/stream_resumption.py [COUNT] [ROSTER]
+
+import os
+import sys
+import time
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop, gen
+from xmpp_session_pool import XMPPSessionPool
+from xmpp_session_pool.xmpp_client import XMPPClient
+from fake_xmpp_server import FakeXMPPServer
+
+PORT = 5222
+
+
+def jid(i):
+    return 'user%d@localhost'%i
+
+
+@gen.coroutine
+def run(count, roster_size, stream_management):
+    io_loop = ioloop.IOLoop.instance()
+    server = FakeXMPPServer(roster_size=roster_size, stream_management=stream_management)
+    server.listen(PORT, '127.0.0.1')
+    pool = XMPPSessionPool(reconnect_max_delay=1)
+
+    received = {}
+    message_handler = XMPPClient._xmpp_message_handler
+    def counting_message_handler(client, con, event):
+        if event.getBody() is not None:
+            received.setdefault(client.jid, []).append(event.getBody())
+        return message_handler(client, con, event)
+    XMPPClient._xmpp_message_handler = counting_message_handler
+
+    connect_times = []
+    connect_async = XMPPClient.connect_async
+    def timed_connect_async(client, *args, **kwargs):
+        started = time.time()
+        future = connect_async(client, *args, **kwargs)
+        io_loop.add_future(future, lambda future: connect_times.append(time.time() - started))
+        return future
+    XMPPClient.connect_async = timed_connect_async
+
+    session_ids = yield [pool.start_session(jid(i), 'password', server='127.0.0.1') for i in xrange(count)]
+    sessions = [pool.session_for_id(session_id) for session_id in session_ids]
+    dropped = sessions[:count / 2]
+    partners = sessions[count / 2:]
+    logins, roster_requests = server.logins, server.roster_requests
+    del connect_times[:]
+    yield gen.Task(io_loop.add_timeout, time.time() + 0.2)
+
+    for i, session in enumerate(dropped):
+        session.send_by_jid(jid(count / 2 + i), 'in flight %d'%i)
+    dropped_jids = set(jid(i) for i in xrange(count / 2))
+    for connection in list(server.connections):
+        if connection.jid in dropped_jids:
+            connection.stream.close()
+    started = time.time()
+
+    yield gen.Task(io_loop.add_timeout, time.time() + 0.1)
+    for i, session in enumerate(partners):
+        session.send_by_jid(jid(i), 'while away %d'%i)
+
+    while sum(session.state == 'connected' for session in dropped) < len(dropped) and time.time() - started < 60:
+        yield gen.Task(io_loop.add_timeout, time.time() + 0.05)
+    reconnected = time.time() - started
+    yield gen.Task(io_loop.add_timeout, time.time() + 0.5)
+
+    expected = count / 2 * 2
+    delivered = sum(len(set(bodies)) for bodies in received.itervalues())
+    duplicated = sum(len(bodies) - len(set(bodies)) for bodies in received.itervalues())
+    connect_times.sort()
+
+    print 'stream management %s'%('on' if stream_management else 'off')
+    print '  %-28s %d of %d'%('messages lost', expected - delivered, expected)
+    print '  %-28s %d'%('messages duplicated', duplicated)
+    print '  %-28s %d'%('logins on reconnect', server.logins - logins)
+    print '  %-28s %d'%('resumes', server.resumes)
+    print '  %-28s %d'%('roster downloads', server.roster_requests - roster_requests)
+    print '  %-28s %.1f'%('median reconnect login, ms', connect_times[len(connect_times) / 2] * 1000 if connect_times else 0)
+    print '  %-28s %.2f'%('all reconnected after, s', reconnected)
+    print '  %-28s %s'%('client counters', pool.stream_management_stats())
+
+
+def run_in_process(count, roster_size, stream_management):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    ioloop.IOLoop.instance().run_sync(lambda: run(count, roster_size, stream_management), timeout=120)
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def main(count=100, roster_size=200):
+    for stream_management in (False, True):
+        process = multiprocessing.Process(target=run_in_process, args=(count, roster_size, stream_management))
+        process.start()
+        process.join()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
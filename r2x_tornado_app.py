@@ -2,17 +2,22 @@ __author__ = 'kovtash'
 
 import inspect
 import os
-from xmpp_session_pool import XMPPSessionPool, PyAPNSNotification, APNWSGINotification
+from xmpp_session_pool import XMPPSessionPool, PyAPNSNotification, APNWSGINotification, SQLiteMessagesStorage, SQLiteRosterStorage
 from concurrent import futures
 import tornado.ioloop
 import tornado.web
 from tornado_app import MainHandler, StartSession, SessionHandler, SessionContactsHandler, SessionMessagesHandler, \
-    SessionFeedHandler, SessionNotificationHandler, ContactHandler, ContactMessagesHandler, ServerStatusHandler
+    SessionFeedHandler, SessionNotificationHandler, SessionStreamHandler, ContactHandler, ContactMessagesHandler, ServerStatusHandler
 
 class TornadoApp(object):
     def __init__(self,debug=False,push_app_id='im',
                  push_dev_mode=False,push_notification_sender='apnwsgi',
-                 push_server_address=None,push_cert_dir='certificates'):
+                 push_server_address=None,push_cert_dir='certificates',
+                 messages_db=None,roster_db=None,chat_buffer_size=50,presence_debounce=None,notification_window=None,
+                 send_high_water_mark=256*1024,credentials_ttl=300,
+                 reconnect_max_delay=300,reconnect_concurrency=10,keepalive_interval=60,keepalive_timeout=30,
+                 xmpp_io_loops=0,stanza_budget=0.01,
+                 snapshot_file=None,snapshot_interval=300):
         notification_sender = None
         if  push_server_address is not None:
             if  push_notification_sender == 'pyapns':
@@ -22,11 +27,29 @@ class TornadoApp(object):
             elif push_notification_sender == 'apnwsgi':
                 notification_sender = APNWSGINotification(host=push_server_address,app_id=push_app_id)
 
-        self._xmpp_session_pool = XMPPSessionPool(debug=debug,push_sender=notification_sender)
+        messages_storage = None
+        if  messages_db is not None:
+            messages_storage = SQLiteMessagesStorage(path=messages_db)
+
+        roster_storage = None
+        if  roster_db is not None:
+            roster_storage = SQLiteRosterStorage(path=roster_db)
+
+        self._xmpp_session_pool = XMPPSessionPool(debug=debug,push_sender=notification_sender,
+                                                  messages_storage=messages_storage,roster_storage=roster_storage,
+                                                  chat_buffer_size=chat_buffer_size,
+                                                  presence_debounce=presence_debounce,notification_window=notification_window,
+                                                  send_high_water_mark=send_high_water_mark,credentials_ttl=credentials_ttl,
+                                                  reconnect_max_delay=reconnect_max_delay,reconnect_concurrency=reconnect_concurrency,
+                                                  keepalive_interval=keepalive_interval,keepalive_timeout=keepalive_timeout,
+                                                  io_loops=xmpp_io_loops,stanza_budget=stanza_budget)
         self._async_worker = futures.ThreadPoolExecutor(max_workers=10)
+        self._snapshot_file = snapshot_file
+        self._snapshot_interval = snapshot_interval
         self._app = tornado.web.Application([
             (r"/sessions/([^/]*)/notification", SessionNotificationHandler, dict(session_pool = self._xmpp_session_pool, async_worker = self._async_worker)),
             (r"/sessions/([^/]*)/feed", SessionFeedHandler, dict(session_pool = self._xmpp_session_pool, async_worker = self._async_worker)),
+            (r"/sessions/([^/]*)/stream", SessionStreamHandler, dict(session_pool = self._xmpp_session_pool, async_worker = self._async_worker)),
             (r"/sessions/([^/]*)/contacts", SessionContactsHandler, dict(session_pool = self._xmpp_session_pool, async_worker = self._async_worker)),
             (r"/sessions/([^/]*)/contacts/([^/]*)", ContactHandler, dict(session_pool = self._xmpp_session_pool, async_worker = self._async_worker)),
             (r"/sessions/([^/]*)/contacts/([^/]*)/messages", ContactMessagesHandler, dict(session_pool = self._xmpp_session_pool, async_worker = self._async_worker)),
@@ -38,8 +61,21 @@ class TornadoApp(object):
         ])
 
     def run(self,host='0.0.0.0',port=5000):
+        if  self._snapshot_file is not None:
+            if self._xmpp_session_pool.load_snapshot(self._snapshot_file):
+                self._xmpp_session_pool.connect_restored_clients()
+            if self._snapshot_interval:
+                tornado.ioloop.PeriodicCallback(self.save_snapshot, self._snapshot_interval * 1000).start()
+
         self._app.listen(port)
         tornado.ioloop.IOLoop.instance().start()
 
+    def save_snapshot(self):
+        self._xmpp_session_pool.save_snapshot(self._snapshot_file, async_worker=self._async_worker)
+
     def stop(self):
-        self._xmpp_session_pool.clean()
\ No newline at end of file
+        if  self._snapshot_file is not None:
+            self._xmpp_session_pool.save_snapshot(self._snapshot_file)
+            self._xmpp_session_pool.shutdown()
+        else:
+            self._xmpp_session_pool.clean()
\ No newline at end of file
@@ -19,6 +19,44 @@ def arguments():
         help='Logging verbosity level.')
     parser.add_argument('--log-file', action='store', nargs='?',
         help='Log file path.')
+    storage_settings_group = parser.add_argument_group('Message storage settings')
+    storage_settings_group.add_argument('--messages-db', action='store', nargs='?',
+        help='SQLite database path for messages history. History is kept in memory only when not set.')
+    storage_settings_group.add_argument('--roster-db', action='store', nargs='?',
+        help='SQLite database path for rosters cache. Only roster changes are downloaded at login when server supports roster versioning.')
+    storage_settings_group.add_argument('--chat-buffer-size', action='store', default=50, type=int, nargs='?',
+        help='Number of last messages per contact kept in memory.')
+    parser.add_argument('--presence-debounce', action='store', type=float, nargs='?',
+        help='Minimal interval in seconds between published presence changes of a contact. Disabled when not set.')
+    parser.add_argument('--notification-window', action='store', type=float, nargs='?',
+        help='Interval in seconds during which session notifications are merged into one wakeup. '
+             'Notifications are merged within one IOLoop iteration when not set.')
+    parser.add_argument('--send-high-water-mark', action='store', default=256 * 1024, type=int, nargs='?',
+        help='Bytes waiting to be sent to XMPP server above which new messages are rejected with 503.')
+    parser.add_argument('--credentials-ttl', action='store', default=300, type=int, nargs='?',
+        help='Seconds during which verified password of a connected jid is accepted without checking it on XMPP server. '
+             'Every login is checked when 0.')
+    reconnect_settings_group = parser.add_argument_group('Reconnect settings')
+    reconnect_settings_group.add_argument('--reconnect-max-delay', action='store', default=300, type=float, nargs='?',
+        help='Maximal delay in seconds between reconnect attempts of a client which lost XMPP connection.')
+    reconnect_settings_group.add_argument('--reconnect-concurrency', action='store', default=10, type=int, nargs='?',
+        help='Maximal number of reconnects in progress per XMPP server.')
+    reconnect_settings_group.add_argument('--keepalive-interval', action='store', default=60, type=float, nargs='?',
+        help='Seconds without data from XMPP server after which connection is pinged. Disabled when 0.')
+    reconnect_settings_group.add_argument('--keepalive-timeout', action='store', default=30, type=float, nargs='?',
+        help='Seconds to wait for ping answer before reconnecting.')
+    parser.add_argument('--xmpp-io-loops', action='store', default=0, type=int, nargs='?',
+        help='Number of threads reading XMPP connections and handling their stanzas, clients are assigned '
+             'to them by jid. Connections are served by the HTTP IOLoop when 0.')
+    parser.add_argument('--stanza-budget', action='store', default=0.01, type=float, nargs='?',
+        help='Seconds per IOLoop iteration spent parsing XMPP streams on the HTTP IOLoop, the rest waits '
+             'for the next iteration. Applies to streams of all sessions, restored ones included. '
+             'Streams are parsed as data arrives when 0. Not used with --xmpp-io-loops.')
+    snapshot_settings_group = parser.add_argument_group('Snapshot settings')
+    snapshot_settings_group.add_argument('--snapshot-file', action='store', nargs='?',
+        help='Sessions snapshot file path. Sessions are saved on shutdown and restored on startup when set.')
+    snapshot_settings_group.add_argument('--snapshot-interval', action='store', default=300, type=int, nargs='?',
+        help='Interval in seconds between periodic snapshots, 0 disables periodic snapshots.')
     push_settings_group = parser.add_argument_group('Push server settings')
     push_settings_group.add_argument('--push-mechanism', action='store', nargs='?',
         choices=['apnwsgi', 'pyapns'],
@@ -63,7 +101,22 @@ def main():
         push_notification_sender=args.push_mechanism,
         push_server_address=args.push_server_address,
         push_app_id=args.push_app_id,
-        push_cert_dir=args.push_cert_dir)
+        push_cert_dir=args.push_cert_dir,
+        messages_db=args.messages_db,
+        roster_db=args.roster_db,
+        chat_buffer_size=args.chat_buffer_size,
+        presence_debounce=args.presence_debounce,
+        notification_window=args.notification_window,
+        send_high_water_mark=args.send_high_water_mark,
+        credentials_ttl=args.credentials_ttl,
+        reconnect_max_delay=args.reconnect_max_delay,
+        reconnect_concurrency=args.reconnect_concurrency,
+        keepalive_interval=args.keepalive_interval,
+        keepalive_timeout=args.keepalive_timeout,
+        xmpp_io_loops=args.xmpp_io_loops,
+        stanza_budget=args.stanza_budget,
+        snapshot_file=args.snapshot_file,
+        snapshot_interval=args.snapshot_interval)
 
     def term_handler(signum = None, frame = None):
         logging.info('Server cleanup started')
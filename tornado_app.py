@@ -1,11 +1,24 @@
 __author__ = 'kovtash'
 
 from tornado import web, gen, ioloop
-from xmpp_session_pool import XMPPAuthError, XMPPConnectionError, XMPPSendError
+from tornado.concurrent import Future
+from xmpp_session_pool import XMPPAuthError, XMPPConnectionError, XMPPSendError, XMPPSendQueueFull
 from datetime import timedelta
-import json
+import itertools
 import os
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
 
 class MainHandler(web.RequestHandler):
     @gen.coroutine
@@ -20,7 +33,46 @@ class XMPPClientHandler(web.RequestHandler):
         self.response = {}
 
     def write_error(self, status_code, **kwargs):
-        self.write(self.response)
+        self.write_response()
+
+    def write_response(self, response=None):
+        """ Writes response as MessagePack when client accepts it and msgpack is installed, as JSON otherwise."""
+        if response is None:
+            response = self.response
+
+        accept = self.get_header('Accept')
+        self.set_header('Vary', 'Accept')
+        if msgpack is not None and accept is not None and MSGPACK_CONTENT_TYPE in accept:
+            self.set_header('Content-Type', MSGPACK_CONTENT_TYPE)
+            self.write(msgpack.packb(response))
+        else:
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.write(json.dumps(response))
+
+    def get_fields(self):
+        """ Returns list of object fields requested by comma separated fields parameter or None."""
+        fields = self.get_argument('fields', None)
+
+        if fields is not None:
+            fields = [field for field in fields.split(',') if field]
+            if not fields:
+                self.raise_value_error('fields')
+
+        return fields
+
+    def set_next_offset(self, objects, limit):
+        """ Sets next_offset cursor to the last returned event_id when the page is full, to None otherwise."""
+        if limit is None:
+            return
+        if len(objects) == limit:
+            self.response['next_offset'] = max(item['event_id'] for item in objects)
+        else:
+            self.response['next_offset'] = None
+
+    def project(self, objects, fields):
+        if fields is None:
+            return objects
+        return [dict((field, item[field]) for field in fields if field in item) for item in objects]
 
     def raise_value_error(self, parameter_name):
         self.response['error'] = {'code':'XMPPServiceParametersError','text':'Parameter %s has wrong value'%parameter_name}
@@ -30,6 +82,11 @@ class XMPPClientHandler(web.RequestHandler):
         self.response['error'] = {'code':'XMPPSendError','text':'Message sending failed'}
         raise web.HTTPError(404)
 
+    def raise_send_queue_full_error(self):
+        self.response['error'] = {'code':'XMPPSendQueueFull','text':'Too much data is waiting to be sent, retry later'}
+        self.set_header('Retry-After', 1)
+        raise web.HTTPError(503)
+
     def raise_contact_error(self, contact_id):
         self.response['error'] = {'code':'XMPPContactError','text':'There is no contact with id %s'%contact_id}
         raise web.HTTPError(404)
@@ -56,6 +113,47 @@ class XMPPClientHandler(web.RequestHandler):
 
         return offset
 
+    def get_before(self):
+        before = self.get_argument('before', None)
+
+        if before is not None:
+            try:
+                before = float(before)
+            except ValueError:
+                self.raise_value_error('before')
+
+        return before
+
+    def get_limit(self, default=None):
+        limit = self.get_argument('limit', None)
+
+        if limit is None:
+            return default
+
+        try:
+            limit = int(limit)
+        except ValueError:
+            self.raise_value_error('limit')
+
+        if limit < 1:
+            self.raise_value_error('limit')
+
+        return limit
+
+    def get_timeout(self):
+        timeout = self.get_argument('timeout', None)
+
+        if timeout is not None:
+            try:
+                timeout = float(timeout)
+            except ValueError:
+                self.raise_value_error('timeout')
+
+            if timeout <= 0:
+                self.raise_value_error('timeout')
+
+        return timeout
+
     def get_should_wait(self):
         should_wait_param = self.get_argument('wait', None)
         should_wait = False
@@ -103,6 +201,29 @@ class XMPPClientHandler(web.RequestHandler):
             return body
 
 
+class XMPPWaitingHandler(XMPPClientHandler):
+    def initialize(self, session_pool, async_worker):
+        super(XMPPWaitingHandler, self).initialize(session_pool, async_worker)
+        self.waiting_session = None
+        self.waiter = None
+        self.connection_closed = False
+
+    def wait_for_notification(self, session, timeout=None):
+        """ Returns Future resolved with True on session notification or with False on timeout."""
+        self.waiting_session = session
+        self.waiter = session.wait_for_notification(timeout=timeout)
+        return self.waiter
+
+    def on_connection_close(self):
+        """ Waiter is resolved with False, handler should check connection_closed after waiting
+            and return without reading the feed, which would mark messages as delivered."""
+        self.connection_closed = True
+        if self.waiter is not None:
+            waiter, self.waiter = self.waiter, None
+            waiting_session, self.waiting_session = self.waiting_session, None
+            waiting_session.cancel_wait(waiter)
+
+
 class StartSession(XMPPClientHandler):
     @gen.coroutine
     def post(self):
@@ -117,7 +238,7 @@ class StartSession(XMPPClientHandler):
             raise web.HTTPError(400)
 
         try:
-            session_id = yield self.async_worker.submit(self.session_pool.start_session, jid=jid, password=password, server=server, push_token=push_token, im_client_id=client_id)
+            session_id = yield self.session_pool.start_session(jid=jid, password=password, server=server, push_token=push_token, im_client_id=client_id)
             self.response['session'] = {'session_id':session_id}
         except XMPPAuthError:
             self.response['error'] = {'code':'XMPPUpstreamAuthError', 'text':'Can\'t authenticate on XMPP server with jid %s'%jid}
@@ -137,7 +258,7 @@ class StartSession(XMPPClientHandler):
             self.response['error'] = {'code':'XMPPSessionError', 'text':'There is no session with id %s'%session_id}
             raise web.HTTPError(404)
 
-        self.write(self.response)
+        self.write_response()
 
 
 class SessionHandler(XMPPClientHandler):
@@ -146,19 +267,20 @@ class SessionHandler(XMPPClientHandler):
         session = self.get_session(session_id)
         self.response['session']['jid'] = session.jid
         self.response['session']['should_send_message_body'] = session.should_send_message_body
+        self.response['session']['state'] = session.state
 
-        self.write(self.response)
+        self.write_response()
 
-    @gen.coroutine
     def delete(self, session_id):
+        """ Session is closed on IOLoop, pool and XMPP connection are not touched from worker threads."""
         self.get_session(session_id)
         try:
-            result = yield self.async_worker.submit(self.session_pool.close_session, session_id)
+            self.session_pool.close_session(session_id)
         except KeyError:
             self.response['error'] = {'code':'XMPPSessionError', 'text':'There is no session with id %s'%session_id}
             raise web.HTTPError(404)
 
-        self.write(self.response)
+        self.write_response()
 
     def put(self, session_id):
         self.response['session'] = {'session_id':session_id}
@@ -180,12 +302,14 @@ class SessionContactsHandler(XMPPClientHandler):
         """
             Request parameters:
                 offset - returns contacts which has been changed since offset or has messages with event_id greater than offset
+                fields - comma separated list of contact fields to return
         """
         session = self.get_session(session_id)
         offset = self.get_offset()
+        fields = self.get_fields()
 
-        self.response['contacts'] = session.contacts(event_offset=offset)
-        self.write(self.response)
+        self.response['contacts'] = self.project(session.contacts(event_offset=offset), fields)
+        self.write_response()
 
     @gen.coroutine
     def post(self, session_id):
@@ -197,7 +321,10 @@ class SessionContactsHandler(XMPPClientHandler):
         contact = json_body['contact']
         session = self.get_session(session_id)
         jid = contact.get('jid')
-        contact_added = yield self.async_worker.submit(session.add_contact, jid, contact.get('name'))
+        try:
+            contact_added = session.add_contact(jid, contact.get('name'))
+        except XMPPSendQueueFull:
+            self.raise_send_queue_full_error()
 
         timeout = 5.0
         while timeout and contact_added is None:
@@ -211,7 +338,7 @@ class SessionContactsHandler(XMPPClientHandler):
         else:
             self.raise_contact_error(jid)
 
-        self.write(self.response)
+        self.write_response()
 
 
 class SessionMessagesHandler(XMPPClientHandler):
@@ -219,15 +346,21 @@ class SessionMessagesHandler(XMPPClientHandler):
         """
             Request parameters:
                 offset - returns messages with event_id greater that offset
+                limit - maximum number of messages, next_offset is returned to request the next page
+                fields - comma separated list of message fields to return
         """
         session = self.get_session(session_id)
         offset = self.get_offset()
+        limit = self.get_limit()
+        fields = self.get_fields()
 
-        self.response['messages'] = session.messages(event_offset=offset)
-        self.write(self.response)
+        messages = session.messages(event_offset=offset, limit=limit)
+        self.set_next_offset(messages, limit)
+        self.response['messages'] = self.project(messages, fields)
+        self.write_response()
 
 
-class SessionFeedHandler(XMPPClientHandler):
+class SessionFeedHandler(XMPPWaitingHandler):
     @web.asynchronous
     @gen.coroutine
     def get(self, session_id):
@@ -235,36 +368,140 @@ class SessionFeedHandler(XMPPClientHandler):
             Returns both - messages and contacts
             Request parameters:
                 offset - returns objects which has been changed  or added since offset
+                wait - wait for changes when there is nothing to return
+                timeout - maximum wait time in seconds, empty lists are returned when it expires
+                limit - maximum number of contacts and messages in total, next_offset is returned to request the next page
+                fields - comma separated list of contact and message fields to return
         """
         offset = self.get_offset()
         should_wait = self.get_should_wait()
+        timeout = self.get_timeout()
+        limit = self.get_limit()
+        fields = self.get_fields()
         session = self.get_session(session_id)
 
-        self.response['contacts'] = session.contacts(event_offset=offset)
-        self.response['messages'] = session.messages(event_offset=offset)
+        contacts, messages = session.feed(event_offset=offset, limit=limit)
 
-        if (not (len(self.response['contacts'])+len(self.response['messages'])) and should_wait):
-            session.wait_for_notification(callback = (yield gen.Callback("notification")))
-            yield gen.Wait("notification")
+        if (not (len(contacts)+len(messages)) and should_wait):
+            yield self.wait_for_notification(session, timeout=timeout)
+            if self.connection_closed:
+                return
             session = self.get_session(session_id)
-            self.response['contacts'] = session.contacts(event_offset=offset)
-            self.response['messages'] = session.messages(event_offset=offset)
-        self.write(self.response)
+            contacts, messages = session.feed(event_offset=offset, limit=limit)
+
+        self.set_next_offset(contacts + messages, limit)
+        self.response['contacts'] = self.project(contacts, fields)
+        self.response['messages'] = self.project(messages, fields)
+        self.response['state'] = session.state
+        self.write_response()
         self.finish()
 
 
-class SessionNotificationHandler(XMPPClientHandler):
+class SessionNotificationHandler(XMPPWaitingHandler):
     @web.asynchronous
     @gen.coroutine
     def get(self, session_id):
+        """
+            Request parameters:
+                timeout - maximum wait time in seconds, 204 is returned when it expires
+        """
         self.response['session'] = {'session_id':session_id}
+        timeout = self.get_timeout()
         session = self.get_session(session_id)
-        session.wait_for_notification(callback = (yield gen.Callback("notification")))
-        yield gen.Wait("notification")
-        self.write(self.response)
+        notified = yield self.wait_for_notification(session, timeout=timeout)
+        if self.connection_closed:
+            return
+        if not notified:
+            self.set_status(204)
+            self.finish()
+            return
+        self.write_response()
         self.finish()
 
 
+class SessionStreamHandler(XMPPWaitingHandler):
+    keepalive_interval = 30
+    event_limit = 100
+
+    def initialize(self, session_pool, async_worker):
+        super(SessionStreamHandler, self).initialize(session_pool, async_worker)
+        self.flushed = None
+
+    @web.asynchronous
+    @gen.coroutine
+    def get(self, session_id):
+        """
+            Server-Sent Events stream of contacts and messages changes.
+            Every event carries feed object of at most event_limit objects and its id is the offset to resume from.
+            XMPP connection state changes are sent as "state" events.
+            Request parameters:
+                offset - stream objects which has been changed or added since offset,
+                         Last-Event-ID header takes precedence when reconnecting
+        """
+        offset = self.get_offset()
+        last_event_id = self.get_header('Last-Event-ID')
+        if last_event_id is not None:
+            try:
+                offset = float(last_event_id)
+            except ValueError:
+                self.raise_value_error('Last-Event-ID')
+        session = self.get_session(session_id)
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        yield self.flush_stream()
+
+        state = 'connected'
+        while not self.connection_closed:
+            try:
+                self.session_pool.session_for_id(session_id)
+            except KeyError:
+                break
+
+            if session.state != state:
+                state = session.state
+                self.write('event: state\ndata: %s\n\n'%json.dumps({'state':state}))
+
+            contacts, messages = session.feed(event_offset=offset, limit=self.event_limit)
+
+            if len(contacts) + len(messages):
+                offset = max(item['event_id'] for item in itertools.chain(contacts, messages))
+                self.write('id: %s\ndata: %s\n\n'%(offset, json.dumps({'contacts':contacts, 'messages':messages})))
+            else:
+                notified = yield self.wait_for_notification(session, timeout=self.keepalive_interval)
+                if self.connection_closed:
+                    break
+                if notified:
+                    continue
+                self.write(':\n\n')
+
+            # Next event is produced only after the previous one reached the socket,
+            # changes made meanwhile are collected by the next contacts and messages read.
+            yield self.flush_stream()
+
+        if not self.connection_closed:
+            self.finish()
+
+    def flush_stream(self):
+        """ Returns Future resolved when written data reached the socket or connection is closed,
+            flush callback is never called for a closed stream."""
+        self.flushed = Future()
+        if self.request.connection.stream.closed():
+            self.flushed.set_result(None)
+        else:
+            self.flush(callback=self._stream_flushed)
+        return self.flushed
+
+    def _stream_flushed(self):
+        if not self.flushed.done():
+            self.flushed.set_result(None)
+
+    def on_connection_close(self):
+        super(SessionStreamHandler, self).on_connection_close()
+        if self.flushed is not None:
+            self._stream_flushed()
+
+
 class ContactHandler(XMPPClientHandler):
     def get(self, session_id, contact_id):
         self.check_contact_id(contact_id)
@@ -273,10 +510,10 @@ class ContactHandler(XMPPClientHandler):
             self.response['contact'] = session.contact(contact_id)
         except KeyError:
             self.raise_contact_error(contact_id)
-        self.write(self.response)
+        self.write_response()
 
-    @gen.coroutine
     def put(self, session_id, contact_id):
+        """ Contact is changed on IOLoop thread, where roster change index is kept."""
         json_body = self.get_body()
         if 'contact' not in json_body:
             self.response['error'] = {'code':'XMPPServiceParametersError','text':'Missing or wrong request body'}
@@ -286,24 +523,25 @@ class ContactHandler(XMPPClientHandler):
         session = self.get_session(session_id)
 
         try:
-            updated_contact = yield self.async_worker.submit(self.put_contact, session, contact_id, json_body)
+            updated_contact = self.put_contact(session, contact_id, json_body)
             self.response['contacts'] = [updated_contact]
         except KeyError:
             self.raise_contact_error(contact_id)
+        except XMPPSendQueueFull:
+            self.raise_send_queue_full_error()
 
-        self.write(self.response)
+        self.write_response()
 
-    @gen.coroutine
     def delete(self, session_id, contact_id):
         self.check_contact_id(contact_id)
         session = self.get_session(session_id)
 
         try:
-            yield self.async_worker.submit(session.remove_contact, contact_id)
+            session.remove_contact(contact_id)
         except TypeError:
             self.raise_contact_error(contact_id)
 
-        self.write(self.response)
+        self.write_response()
 
     def put_contact(self, session, contact_id, json_body):
         contact = json_body['contact']
@@ -318,24 +556,39 @@ class ContactHandler(XMPPClientHandler):
 
 
 class ContactMessagesHandler(XMPPClientHandler):
+    @gen.coroutine
     def get(self, session_id, contact_id):
         """
             Request parameters:
                 offset - returns messages with event_id greater that offset
+                before - returns history messages with timestamp less than before
+                limit - maximum number of messages, 50 by default for history messages,
+                        next_offset is returned with offset pages
         """
         self.check_contact_id(contact_id)
         session = self.get_session(session_id)
         offset = self.get_offset()
+        before = self.get_before()
 
-        try:
-            self.response['messages'] = session.messages(contact_ids=[contact_id], event_offset=offset)
-        except TypeError:
-            self.raise_contact_error(contact_id)
+        if before is not None:
+            limit = self.get_limit(default=50)
+            try:
+                self.response['messages'] = yield session.history(contact_id, before=before, limit=limit)
+            except KeyError:
+                self.raise_contact_error(contact_id)
+        else:
+            limit = self.get_limit()
+            try:
+                self.response['messages'] = session.messages(contact_ids=[contact_id], event_offset=offset, limit=limit)
+            except TypeError:
+                self.raise_contact_error(contact_id)
+            self.set_next_offset(self.response['messages'], limit)
 
-        self.write(self.response)
+        self.write_response()
 
-    @gen.coroutine
     def post(self, session_id, contact_id):
+        """ Message is queued by the client and written by IOLoop, so it is sent on IOLoop thread,
+            where event_ids are assigned and appended to the message logs in order."""
         json_body = self.get_body()
         try:
             message = json_body['messages']['text']
@@ -347,13 +600,15 @@ class ContactMessagesHandler(XMPPClientHandler):
         session = self.get_session(session_id)
 
         try:
-            self.response['messages'] = yield self.async_worker.submit(session.send, contact_id, message)
+            self.response['messages'] = session.send(contact_id, message)
+        except XMPPSendQueueFull:
+            self.raise_send_queue_full_error()
         except XMPPSendError:
             self.raise_message_sending_error()
         except TypeError:
             self.raise_contact_error(contact_id)
 
-        self.write(self.response)
+        self.write_response()
 
 
 class ServerStatusHandler(XMPPClientHandler):
@@ -376,4 +631,16 @@ class ServerStatusHandler(XMPPClientHandler):
         response['im_sessions'] = len(self.session_pool.session_pool.keys())
         response['im_clients'] = len(self.session_pool.im_client_pool.keys())
         response['xmpp_clients'] = len(self.session_pool.xmpp_client_pool.keys())
-        self.write(response)
\ No newline at end of file
+        response['presence'] = self.session_pool.presence_stats()
+        response['notifications'] = self.session_pool.notifier.stats()
+        response['send_queues'] = self.session_pool.send_queue_stats()
+        response['credentials_cache'] = self.session_pool.credentials_cache.stats()
+        response['reconnect'] = self.session_pool.reconnect_scheduler.stats()
+        response['stream_management'] = self.session_pool.stream_management_stats()
+        if self.session_pool.keepalive is not None:
+            response['keepalive'] = self.session_pool.keepalive.stats()
+        if self.session_pool.io_loop_pool is not None:
+            response['io_loops'] = self.session_pool.io_loop_pool.stats()
+        if self.session_pool.stanza_scheduler is not None:
+            response['stanza_scheduler'] = self.session_pool.stanza_scheduler.stats()
+        self.write_response(response)
\ No newline at end of file
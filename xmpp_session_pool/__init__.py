@@ -4,5 +4,7 @@ __author__ = 'v.kovtash@gmail.com'
 from session_pool import XMPPSessionPool
 from message_store import XMPPMessagesStore
 from session import XMPPSession
-from errors import XMPPAuthError, XMPPConnectionError, XMPPRosterError, XMPPSendError
+from message_backends import MessagesStorageAbstract, SQLiteMessagesStorage
+from roster_backends import RosterStorageAbstract, SQLiteRosterStorage
+from errors import XMPPAuthError, XMPPConnectionError, XMPPRosterError, XMPPSendError, XMPPSendQueueFull
 from push_notificators import *
\ No newline at end of file
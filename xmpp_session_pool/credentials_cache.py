@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import os
+import hmac
+import time
+import hashlib
+
+class XMPPCredentialsCache(object):
+    """ Remembers passwords recently verified by XMPP server, so repeated logins with the same jid
+        are not checked by a new connection. Only salted HMAC of password is kept, with a key
+        that lives in process memory. Entries expire after ttl seconds, ttl 0 disables cache."""
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        self._entries = {}
+
+    def _digest(self, salt, password):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac.new(self._key, salt + password, hashlib.sha256).digest()
+
+    def store(self, jid, password):
+        if not self.ttl:
+            return
+        salt = os.urandom(16)
+        self._entries[jid] = (salt, self._digest(salt, password), time.time() + self.ttl)
+
+    def check(self, jid, password):
+        """ Returns True when password was verified for jid and has not expired."""
+        entry = self._entries.get(jid)
+        if entry is not None:
+            salt, digest, expires = entry
+            if expires < time.time():
+                del self._entries[jid]
+            elif hmac.compare_digest(digest, self._digest(salt, password)):
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def invalidate(self, jid):
+        self._entries.pop(jid, None)
+
+    def stats(self):
+        return {'entries':len(self._entries),
+                'hits':self.hits,
+                'misses':self.misses}
@@ -13,5 +13,8 @@ class XMPPAuthError(Exception):
 class XMPPSendError(Exception):
     pass
 
+class XMPPSendQueueFull(XMPPSendError):
+    pass
+
 class XMPPRosterError(Exception):
     pass
@@ -3,5 +3,8 @@ __author__ = 'kovtash'
 import itertools
 
 class XMPPSessionEventID(object):
-    def __init__(self):
-        self.id = itertools.count().next
\ No newline at end of file
+    def __init__(self, start=0):
+        self.reset(start)
+
+    def reset(self, start):
+        self.id = itertools.count(start).next
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import bisect
+import itertools
+
+class XMPPEventLog(object):
+    """ Records kept in event_id order, e.g. contact changes or messages of a chat.
+        Records are always appended with a growing event_id, so the log stays sorted
+        and offset queries are answered by bisection. Discarded records leave a hole
+        which is skipped by readers and dropped when the log is compacted.
+        Size is bounded by owners, which discard records they no longer keep."""
+    def __init__(self):
+        self._event_ids = []
+        self._records = []
+        self._head = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self.since())
+
+    def append(self, event_id, record):
+        """ Append record with event_id greater than any stored one."""
+        self._event_ids.append(event_id)
+        self._records.append(record)
+        self._length += 1
+
+    def discard(self, event_id):
+        """ Remove record stored with event_id. Returns removed record or None."""
+        index = self._index(event_id)
+        if index is None:
+            return None
+
+        record = self._records[index]
+        self._records[index] = None
+        self._length -= 1
+        self._compact()
+        return record
+
+    def since(self, event_offset=None, limit=None):
+        """ Returns records with event_id greater than event_offset in event_id order,
+            at most limit records when limit is set."""
+        if limit is not None:
+            return [record for event_id, record in itertools.islice(self.items_since(event_offset), limit)]
+        return [record for record in self._records[self._start(event_offset):] if record is not None]
+
+    def items_since(self, event_offset=None):
+        """ Iterates over (event_id, record) pairs with event_id greater than event_offset.
+            Log should not be changed while iterating."""
+        event_ids = self._event_ids
+        records = self._records
+        for index in xrange(self._start(event_offset), len(records)):
+            record = records[index]
+            if record is not None:
+                yield event_ids[index], record
+
+    def _start(self, event_offset):
+        if event_offset is None:
+            return self._head
+        return bisect.bisect_right(self._event_ids, event_offset, self._head)
+
+    def clear(self):
+        self._event_ids = []
+        self._records = []
+        self._head = 0
+        self._length = 0
+
+    def _index(self, event_id):
+        index = bisect.bisect_left(self._event_ids, event_id, self._head)
+        if index < len(self._event_ids) and self._event_ids[index] == event_id and self._records[index] is not None:
+            return index
+        return None
+
+    def _compact(self):
+        records = self._records
+        while self._head < len(records) and records[self._head] is None:
+            self._head += 1
+
+        holes = len(records) - self._head - self._length
+        if holes > self._length:
+            event_ids = self._event_ids
+            live = [index for index in xrange(self._head, len(records)) if records[index] is not None]
+            self._event_ids = [event_ids[index] for index in live]
+            self._records = [records[index] for index in live]
+            self._head = 0
+        elif self._head and self._head * 2 >= len(records):
+            del records[:self._head]
+            del self._event_ids[:self._head]
+            self._head = 0
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import math
+import random
+import time
+import logging
+import xmpp
+from tornado import ioloop
+
+NS_PING = 'urn:xmpp:ping'
+
+class XMPPKeepalive(object):
+    """ Detects half-open XMPP connections with a single timer wheel for all clients.
+        Client is checked once per idle_interval, connection which received nothing meanwhile
+        is pinged (XEP-0199), and if nothing is received in pong_timeout after that,
+        connection is closed and client reconnects by its disconnect handlers.
+        Received data is tracked by connection itself, so busy connections cost nothing
+        until their slot comes. Clients added together are spread over the wheel.
+        Only non-blocking connections are watched."""
+    def __init__(self, idle_interval=60, pong_timeout=30, tick=1.0, io_loop=None):
+        self.idle_interval = idle_interval
+        self.pong_timeout = pong_timeout
+        self.tick = tick
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.pings = 0
+        self.timeouts = 0
+        self._slots = [set() for i in xrange(int(math.ceil(max(idle_interval, pong_timeout) / tick)) + 1)]
+        self._position = 0
+        self._entries = {}
+        self._periodic_callback = ioloop.PeriodicCallback(self._advance, tick * 1000, io_loop=self.io_loop)
+
+    def start(self):
+        self._periodic_callback.start()
+
+    def stop(self):
+        self._periodic_callback.stop()
+
+    def add(self, client):
+        if client not in self._entries:
+            self._entries[client] = [None, None]
+            self._schedule(client, random.uniform(self.tick, self.idle_interval))
+
+    def remove(self, client):
+        entry = self._entries.pop(client, None)
+        if entry is not None:
+            self._slots[entry[0]].discard(client)
+
+    def _schedule(self, client, delay):
+        entry = self._entries[client]
+        ticks = min(len(self._slots) - 1, max(1, int(math.ceil(delay / self.tick))))
+        slot = (self._position + ticks) % len(self._slots)
+        self._slots[slot].add(client)
+        entry[0] = slot
+
+    def _advance(self):
+        self._position = (self._position + 1) % len(self._slots)
+        clients = self._slots[self._position]
+        self._slots[self._position] = set()
+        now = time.time()
+        for client in clients:
+            try:
+                with client.lock:
+                    self._check(client, now)
+            except Exception as e:
+                logging.exception(e)
+                self._schedule(client, self.idle_interval)
+
+    def _check(self, client, now):
+        entry = self._entries[client]
+        ping_sent = entry[1]
+        entry[1] = None
+        connection = client.__dict__.get('Connection')
+        last_received = getattr(connection, 'last_received', None)
+        if not client.logged_in or last_received is None:
+            self._schedule(client, self.idle_interval)
+            return
+
+        if ping_sent is not None and last_received < ping_sent:
+            self.timeouts += 1
+            logging.info(u'SessionEvent : Session %s did not answer ping, reconnecting', client.jid)
+            connection.disconnect()
+            self._schedule(client, self.idle_interval)
+            client.disconnected()
+            return
+
+        idle = now - last_received
+        if idle < self.idle_interval:
+            self._schedule(client, self.idle_interval - idle)
+            return
+
+        self.pings += 1
+        entry[1] = now
+        client.send(xmpp.protocol.Iq('get', to=client.Server, payload=[xmpp.simplexml.Node('ping', attrs={'xmlns':NS_PING})]))
+        self._schedule(client, self.pong_timeout)
+
+    def stats(self):
+        return {'connections':len(self._entries),
+                'pings':self.pings,
+                'timeouts':self.timeouts}
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+class XMPPMessage(object):
+    """ Buffered chat message. Slots keep per message overhead to a fixed size record
+        instead of a dict per message."""
+    __slots__ = ('event_id', 'inbound', 'text', 'timestamp', 'contact_id', 'message_id', 'delivered', 'delivery_receipt_asked')
+
+    def __init__(self, event_id, inbound, text, timestamp, contact_id, message_id=None, delivered=False, delivery_receipt_asked=False):
+        self.event_id = event_id
+        self.inbound = inbound
+        self.text = text
+        self.timestamp = timestamp
+        self.contact_id = contact_id
+        self.message_id = message_id
+        self.delivered = delivered
+        self.delivery_receipt_asked = delivery_receipt_asked
+
+    def as_dict(self):
+        return {'event_id':self.event_id,
+                'inbound':self.inbound,
+                'text':self.text,
+                'timestamp':self.timestamp,
+                'contact_id':self.contact_id,
+                'message_id':self.message_id,
+                'delivered':self.delivered,
+                'delivery_receipt_asked':self.delivery_receipt_asked}
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import logging
+import sqlite3
+import threading
+from Queue import Queue, Empty
+from concurrent import futures
+
+def bare_jid(jid):
+    """ Storage key of jid: bare jid in lower case, so resources and case of incoming stanzas
+        match roster jids."""
+    return unicode(jid).split('/', 1)[0].lower()
+
+
+class MessagesStorageAbstract(object):
+    """ Persistent history behind XMPPMessagesStore. The store keeps only a short hot tail in memory,
+        every message is also handed to the storage and older history is read back from it."""
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def store_message(self, jid, contact_jid, message):
+        pass
+
+    def set_message_delivered(self, jid, contact_jid, message_id, inbound=False):
+        pass
+
+    def remove_messages(self, jid, contact_jid):
+        pass
+
+    def history(self, jid, contact_jid, contact_id, before=None, limit=50):
+        """ Returns future resolved with list of messages older than before timestamp.
+            History messages have no event_id, event_ids are valid for the live feed of the running process only."""
+        future = futures.Future()
+        future.set_result([])
+        return future
+
+
+class SQLiteMessagesStorage(threading.Thread, MessagesStorageAbstract):
+    """ SQLite history storage. Database is used only from the storage thread,
+        so neither writes nor history reads are performed on the IOLoop.
+        stop() waits up to stop_timeout seconds for queued operations to be written."""
+    def __init__(self, path, batch_size=100, stop_timeout=10):
+        super(SQLiteMessagesStorage, self).__init__()
+        self.path = path
+        self.batch_size = batch_size
+        self.stop_timeout = stop_timeout
+        self.daemon = True
+        self.keepRunning = True
+        self.operations = Queue()
+
+    def run(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'jid TEXT NOT NULL, '
+                           'contact_jid TEXT NOT NULL, '
+                           'message_id TEXT, '
+                           'inbound INTEGER NOT NULL, '
+                           'text TEXT, '
+                           'timestamp REAL NOT NULL, '
+                           'delivered INTEGER NOT NULL, '
+                           'delivery_receipt_asked INTEGER NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS messages_history ON messages (jid, contact_jid, timestamp)')
+        connection.execute('CREATE INDEX IF NOT EXISTS messages_message_id ON messages (jid, contact_jid, message_id)')
+        connection.commit()
+
+        while self.keepRunning or not self.operations.empty():
+            operations = [self.operations.get()]
+            try:
+                while len(operations) < self.batch_size:
+                    operations.append(self.operations.get_nowait())
+            except Empty:
+                pass
+
+            for operation in operations:
+                if operation is not None:
+                    function, args = operation
+                    try:
+                        function(connection, *args)
+                    except Exception as e:
+                        logging.exception(e)
+                self.operations.task_done()
+
+            connection.commit()
+
+        connection.close()
+
+    def stop(self):
+        self.keepRunning = False
+        self.operations.put(None)
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(self.stop_timeout)
+            if self.is_alive():
+                logging.error('SQLiteMessagesStorage : %d operations left unwritten on stop', self.operations.qsize())
+
+    def store_message(self, jid, contact_jid, message):
+        self.operations.put((self._insert_message, (bare_jid(jid), bare_jid(contact_jid), message.message_id,
+                                                    message.inbound, message.text, message.timestamp, message.delivered,
+                                                    message.delivery_receipt_asked)))
+
+    def set_message_delivered(self, jid, contact_jid, message_id, inbound=False):
+        self.operations.put((self._update_message_delivered, (bare_jid(jid), bare_jid(contact_jid), message_id, inbound)))
+
+    def remove_messages(self, jid, contact_jid):
+        self.operations.put((self._delete_messages, (bare_jid(jid), bare_jid(contact_jid))))
+
+    def history(self, jid, contact_jid, contact_id, before=None, limit=50):
+        future = futures.Future()
+        self.operations.put((self._select_history, (future, bare_jid(jid), bare_jid(contact_jid), contact_id, before, limit)))
+        return future
+
+    def _insert_message(self, connection, *values):
+        connection.execute('INSERT INTO messages (jid, contact_jid, message_id, inbound, text, timestamp, delivered, '
+                           'delivery_receipt_asked) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', values)
+
+    def _update_message_delivered(self, connection, jid, contact_jid, message_id, inbound):
+        connection.execute('UPDATE messages SET delivered = 1 WHERE jid = ? AND contact_jid = ? AND message_id = ? AND inbound = ?',
+                           (jid, contact_jid, message_id, int(inbound)))
+
+    def _delete_messages(self, connection, jid, contact_jid):
+        connection.execute('DELETE FROM messages WHERE jid = ? AND contact_jid = ?', (jid, contact_jid))
+
+    def _select_history(self, connection, future, jid, contact_jid, contact_id, before, limit):
+        try:
+            if before is None:
+                before = float('inf')
+            rows = connection.execute('SELECT message_id, inbound, text, timestamp, delivered, delivery_receipt_asked FROM messages '
+                                      'WHERE jid = ? AND contact_jid = ? AND timestamp < ? ORDER BY timestamp DESC, id DESC LIMIT ?',
+                                      (jid, contact_jid, before, limit)).fetchall()
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        messages = []
+        for message_id, inbound, text, timestamp, delivered, delivery_receipt_asked in reversed(rows):
+            messages.append({'inbound':bool(inbound),
+                             'text':text,
+                             'timestamp':timestamp,
+                             'contact_id':contact_id,
+                             'message_id':message_id,
+                             'delivered':bool(delivered),
+                             'delivery_receipt_asked':bool(delivery_receipt_asked)})
+        future.set_result(messages)
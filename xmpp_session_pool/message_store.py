@@ -3,20 +3,37 @@ __author__ = 'v.kovtash@gmail.com'
 
 import time
 from xmpp.client import PlugIn
+from tornado.concurrent import Future
+from collections import OrderedDict, deque
+import heapq
 import itertools
+from event_log import XMPPEventLog
+from message import XMPPMessage
 
 class XMPPMessagesStore(PlugIn):
-    def __init__(self, id_generator, chat_buffer_size=50):
+    def __init__(self, id_generator, chat_buffer_size=50, storage=None):
         PlugIn.__init__(self)
         self.id_generator = id_generator
         self.chat_buffer_size = chat_buffer_size
+        self.storage = storage
         self.chats_store = {}
+        self.chats_order = {}
+        self.last_messages = {}
+        self.events = XMPPEventLog()
+        self.outbound_messages = {}
+        self.pending_receipts = OrderedDict()
+        self._receipts_flush_scheduled = False
         self.DBG_LINE = 'message_store'
 
     def plugin(self,owner):
-        """ Register presence and subscription trackers in the owner's dispatcher.
-       Also request roster from server if the 'request' argument is set.
+        """ Register message and delivery receipt handlers in the owner's dispatcher.
+       Storage restored from snapshot is plugged in before connection is established,
+       its handlers are registered by RegisterHandlers later.
        Used internally."""
+        if owner.__dict__.has_key('Dispatcher'):
+            self.RegisterHandlers()
+
+    def RegisterHandlers(self):
         self._owner.Dispatcher.RegisterHandler('message', self.xmpp_message_handler, makefirst=True)
         self._owner.Dispatcher.RegisterHandler('message', self.xmpp_delivery_status_handler, ns='urn:xmpp:receipts', makefirst=True)
 
@@ -37,7 +54,7 @@ class XMPPMessagesStore(PlugIn):
         if  event.getID() is not None and event.getTag('request') is not None:
             delivery_receipt_asked = True
 
-        self.append_message(contact_id=contact_id, inbound=True, text=message_text, message_id=message_id, delivery_receipt_asked = delivery_receipt_asked)
+        self.append_message(contact_id=contact_id, inbound=True, text=message_text, message_id=message_id, delivery_receipt_asked = delivery_receipt_asked, jid=jid_from)
 
     def xmpp_delivery_status_handler(self, con, event):
         received = event.getTag('received')
@@ -45,62 +62,176 @@ class XMPPMessagesStore(PlugIn):
             message_id = received.getAttr('id')
             jid_from = event.getFrom().getStripped()
             contact_id = self._owner.getRoster().itemId(jid_from)
-            if message_id is not None and contact_id in self.chats_store:
-                for message in self.chats_store[contact_id]:
-                    if not message['inbound'] and message['message_id'] == message_id:
-                        message['delivered'] = True
-                        message['event_id'] = self.id_generator.id()
-
-    def append_message(self, contact_id, inbound, text, message_id = None, delivery_receipt_asked=False):
-        if contact_id not in self.chats_store:
-            self.chats_store[contact_id] = []
-
+            message = self.outbound_messages.get(message_id)
+            if message is not None and message.contact_id == contact_id:
+                chat = self.chats_store[contact_id]
+                chat.discard(message.event_id)
+                self.events.discard(message.event_id)
+                message.delivered = True
+                message.event_id = self.id_generator.id()
+                chat.append(message.event_id, message)
+                self.events.append(message.event_id, message)
+                if self.storage is not None:
+                    self.storage.set_message_delivered(self.account_jid, jid_from, message_id)
+
+    def append_message(self, contact_id, inbound, text, message_id = None, delivery_receipt_asked=False, jid=None):
+        """ Should be called holding client lock, event logs rely on event_ids being appended in increasing order."""
         messages = []
         event_id = self.id_generator.id()
         timestamp = time.time()
 
-        messages.append({'event_id':event_id,
-                         'inbound':inbound,
-                         'text':text,
-                         'timestamp':timestamp,
-                         'contact_id':contact_id,
-                         'message_id': message_id,
-                         'delivered':False,
-                         'delivery_receipt_asked':delivery_receipt_asked
-        })
+        messages.append(XMPPMessage(event_id=event_id,
+                                    inbound=inbound,
+                                    text=text,
+                                    timestamp=timestamp,
+                                    contact_id=contact_id,
+                                    message_id=message_id,
+                                    delivered=False,
+                                    delivery_receipt_asked=delivery_receipt_asked))
 
         for message in messages:
-            self.chats_store[contact_id].append(message)
+            self._buffer_message(message)
+            self.last_messages[contact_id] = message
 
-        if len(self.chats_store[contact_id]) > self.chat_buffer_size:
-            for i in xrange (0,len(self.chats_store[contact_id]) - self.chat_buffer_size):
-                del self.chats_store[contact_id][0]
+        if self.storage is not None:
+            if jid is None:
+                jid = self._owner.getRoster().getItem(contact_id)['jid']
+            for message in messages:
+                self.storage.store_message(self.account_jid, jid, message)
 
         return messages
 
-    def messages(self,contact_ids=None, event_offset=None):
+    def messages(self,contact_ids=None, event_offset=None, limit=None):
+        """ Returns messages with event_id greater than event_offset, at most limit messages
+            with the lowest event_ids when limit is set."""
         chat_store = self.chats_store
         if contact_ids is None:
-            result = list(itertools.chain.from_iterable(chat_store.values()))
+            result = self.events.since(event_offset, limit=limit)
+        elif limit is None:
+            result = list(itertools.chain.from_iterable(chat_store[contact_id].since(event_offset)
+                                                        for contact_id in contact_ids if contact_id in chat_store))
         else:
-            result = []
-            for jid in contact_ids:
-                if jid in chat_store:
-                    result += chat_store[jid]
+            events = heapq.merge(*[chat_store[contact_id].items_since(event_offset)
+                                   for contact_id in contact_ids if contact_id in chat_store])
+            result = [message for event_id, message in itertools.islice(events, limit)]
 
-        if event_offset is not None:
-            result = filter(lambda message: message['event_id'] > event_offset, result)
+        self.messages_delivered(result)
+        return result
 
-        for message in result:
-            if message['inbound'] and message['delivery_receipt_asked'] and not message['delivered']:
-                self._owner.send_message_delivery_receipt(message['contact_id'],message['message_id'])
-                message['delivered']=True
+    def message_events(self, event_offset=None):
+        """ Iterates over (event_id, message) pairs with event_id greater than event_offset.
+            Caller should pass returned messages to messages_delivered."""
+        return self.events.items_since(event_offset)
 
-        return result
+    def messages_delivered(self, messages):
+        """ Schedules delivery receipts for messages returned to the client."""
+        for message in messages:
+            if message.inbound and message.delivery_receipt_asked and not message.delivered:
+                self.schedule_delivery_receipt(message)
+
+    def schedule_delivery_receipt(self, message):
+        """ Mark message as delivered and queue its receipt. Queued receipts are sent
+            by flush_delivery_receipts on the next IOLoop iteration."""
+        message.delivered = True
+        if self.storage is not None:
+            contact = self._owner.getRoster().getItem(message.contact_id)
+            if contact is not None:
+                self.storage.set_message_delivered(self.account_jid, contact['jid'], message.message_id, inbound=True)
+        self.pending_receipts.setdefault(message.contact_id, []).append(message.message_id)
+        if not self._receipts_flush_scheduled:
+            self._receipts_flush_scheduled = True
+            self._owner.add_callback(self.flush_delivery_receipts)
+
+    def flush_delivery_receipts(self):
+        self._receipts_flush_scheduled = False
+        pending_receipts = self.pending_receipts
+        self.pending_receipts = OrderedDict()
+        if len(pending_receipts):
+            self._owner.send_message_delivery_receipts(pending_receipts)
+
+    def history(self, contact_id, before=None, limit=50):
+        """ Returns future resolved with up to limit messages of contact older than before timestamp.
+            Older messages are read from the persistent storage, without storage only buffered messages are returned."""
+        contact = self._owner.getRoster().getItem(contact_id)
+        if contact is None:
+            raise KeyError(contact_id)
+
+        if self.storage is not None:
+            return self.storage.history(self.account_jid, contact['jid'], contact_id, before=before, limit=limit)
+
+        messages = []
+        if contact_id in self.chats_store:
+            messages = sorted(self.chats_store[contact_id], key=lambda message: message.timestamp)
+            if before is not None:
+                messages = [message for message in messages if message.timestamp < before]
+
+        history = []
+        for message in messages[-limit:]:
+            message = message.as_dict()
+            del message['event_id']
+            history.append(message)
+        future = Future()
+        future.set_result(history)
+        return future
+
+    @property
+    def account_jid(self):
+        return self._owner.jid.getStripped()
+
+    def last_message(self, contact_id):
+        return self.last_messages.get(contact_id)
 
     def all_messages(self):
-        return self.chats_store.copy()
+        return dict((contact_id, chat.since()) for contact_id, chat in self.chats_store.iteritems())
 
     def remove_messages_for_contact(self, contact_id):
         if contact_id in self.chats_store:
+            for message in self.chats_store[contact_id]:
+                self._forget_message(message)
             del self.chats_store[contact_id]
+            del self.chats_order[contact_id]
+        if contact_id in self.last_messages:
+            del self.last_messages[contact_id]
+        if self.storage is not None:
+            contact = self._owner.getRoster().getItem(contact_id)
+            if contact is not None:
+                self.storage.remove_messages(self.account_jid, contact['jid'])
+
+    def snapshot(self):
+        return {'messages':[message.as_dict() for message in self.events],
+                'last_messages':dict((contact_id, message.event_id) for contact_id, message in self.last_messages.iteritems())}
+
+    def restore(self, snapshot):
+        last_messages = snapshot['last_messages']
+        for message_data in sorted(snapshot['messages'], key=lambda message_data: message_data['event_id']):
+            message = XMPPMessage(**message_data)
+            self._buffer_message(message)
+            if last_messages.get(message.contact_id) == message.event_id:
+                self.last_messages[message.contact_id] = message
+        for contact_id, order in self.chats_order.iteritems():
+            self.chats_order[contact_id] = deque(sorted(order, key=lambda message: message.timestamp))
+
+    def _buffer_message(self, message):
+        """ Chat keeps chat_buffer_size messages in arrival order. Delivered outbound message gets
+            a new event_id, but it is evicted by the time it was buffered, like before delivery."""
+        contact_id = message.contact_id
+        if contact_id not in self.chats_store:
+            self.chats_store[contact_id] = XMPPEventLog()
+            self.chats_order[contact_id] = deque()
+
+        self.events.append(message.event_id, message)
+        if not message.inbound and message.message_id is not None:
+            self.outbound_messages[message.message_id] = message
+        chat = self.chats_store[contact_id]
+        order = self.chats_order[contact_id]
+        chat.append(message.event_id, message)
+        order.append(message)
+        while len(order) > self.chat_buffer_size:
+            evicted_message = order.popleft()
+            chat.discard(evicted_message.event_id)
+            self._forget_message(evicted_message)
+
+    def _forget_message(self, message):
+        self.events.discard(message.event_id)
+        if not message.inbound and self.outbound_messages.get(message.message_id) is message:
+            del self.outbound_messages[message.message_id]
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import time
+import random
+import logging
+import functools
+from collections import deque
+from tornado import ioloop
+from errors import XMPPAuthError
+
+class XMPPReconnectScheduler(object):
+    """ Reconnects clients which lost connection in background.
+        Attempt n starts after random delay up to min(max_delay, base_delay * 2 ** n), so clients dropped
+        by a restarting server spread their retries, and at most max_concurrent logins per XMPP server
+        are in progress at once. Clients which fail authentication are passed to auth_failed.
+        Clients restored from snapshot are connected the same way until their first login succeeds."""
+    def __init__(self, base_delay=1.0, max_delay=300.0, max_concurrent=10, timeout=30, io_loop=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.auth_failed = None
+        self.started = 0
+        self.succeeded = 0
+        self.failed = 0
+        self._attempts = {}
+        self._timeouts = {}
+        self._waiting = {}
+        self._active = {}
+        self._cancelled = set()
+
+    def schedule(self, client):
+        """ Schedules reconnection of client. May be called from any thread."""
+        self.io_loop.add_callback(self._schedule, client)
+
+    def cancel(self, client):
+        """ Stops reconnecting client, connection in progress is closed when established.
+            May be called from any thread."""
+        if ioloop.IOLoop.current() is not self.io_loop:
+            self.io_loop.add_callback(self.cancel, client)
+            return
+        timeout = self._timeouts.pop(client, None)
+        if timeout is not None:
+            self.io_loop.remove_timeout(timeout)
+        waiting = self._waiting.get(client._Server)
+        if waiting is not None and client in waiting:
+            waiting.remove(client)
+        elif client in self._attempts and timeout is None:
+            self._cancelled.add(client)
+        self._attempts.pop(client, None)
+
+    def _schedule(self, client):
+        if client in self._timeouts or not (client.reconnecting or client.restored):
+            return
+        attempt = self._attempts.get(client, 0)
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        self._attempts[client] = attempt + 1
+        logging.debug(u'SessionEvent : Session %s reconnect attempt %d in %.1f s', client.jid, attempt + 1, delay)
+        self._timeouts[client] = self.io_loop.add_timeout(time.time() + delay, functools.partial(self._ready, client))
+
+    def _ready(self, client):
+        del self._timeouts[client]
+        server = client._Server
+        self._waiting.setdefault(server, deque()).append(client)
+        self._start_next(server)
+
+    def _start_next(self, server):
+        waiting = self._waiting.get(server)
+        while waiting and self._active.get(server, 0) < self.max_concurrent:
+            client = waiting.popleft()
+            self._active[server] = self._active.get(server, 0) + 1
+            self.started += 1
+            future = client.connect_async(timeout=self.timeout)
+            self.io_loop.add_future(future, functools.partial(self._finished, client, server))
+
+        if waiting is not None and not waiting:
+            del self._waiting[server]
+
+    def _finished(self, client, server, future):
+        self._active[server] -= 1
+        if not self._active[server]:
+            del self._active[server]
+
+        error = future.exception()
+        if client in self._cancelled:
+            self._cancelled.discard(client)
+            if error is None:
+                client.close()
+        elif error is None:
+            self.succeeded += 1
+            self._attempts.pop(client, None)
+        else:
+            self.failed += 1
+            if isinstance(error, XMPPAuthError):
+                self._attempts.pop(client, None)
+                if self.auth_failed is not None:
+                    self.auth_failed(client)
+            else:
+                self._schedule(client)
+
+        self._start_next(server)
+
+    def stats(self):
+        return {'waiting':len(self._timeouts) + sum(len(waiting) for waiting in self._waiting.itervalues()),
+                'connecting':sum(self._active.itervalues()),
+                'started':self.started,
+                'succeeded':self.succeeded,
+                'failed':self.failed}
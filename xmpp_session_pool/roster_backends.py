@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import json
+import logging
+import sqlite3
+import threading
+from Queue import Queue, Empty
+from concurrent import futures
+
+class RosterStorageAbstract(object):
+    """ Persistent roster cache behind XMPPRoster. Roster is stored with its version (XEP-0237),
+        so after login only changes since that version are requested from server."""
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def store_roster(self, jid, snapshot):
+        pass
+
+    def remove_roster(self, jid):
+        pass
+
+    def load_roster(self, jid):
+        """ Returns future resolved with roster snapshot saved by store_roster or None. """
+        future = futures.Future()
+        future.set_result(None)
+        return future
+
+
+class SQLiteRosterStorage(threading.Thread, RosterStorageAbstract):
+    """ SQLite roster cache. One row per account jid, replaced on every store.
+        Database is used only from the storage thread, snapshots are serialized there as well.
+        stop() waits up to stop_timeout seconds for queued operations to be written."""
+    def __init__(self, path, stop_timeout=10):
+        super(SQLiteRosterStorage, self).__init__()
+        self.path = path
+        self.stop_timeout = stop_timeout
+        self.daemon = True
+        self.keepRunning = True
+        self.operations = Queue()
+
+    def run(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE IF NOT EXISTS rosters ('
+                           'jid TEXT PRIMARY KEY, '
+                           'version TEXT, '
+                           'roster TEXT NOT NULL)')
+        connection.commit()
+
+        while self.keepRunning or not self.operations.empty():
+            operations = [self.operations.get()]
+            try:
+                while True:
+                    operations.append(self.operations.get_nowait())
+            except Empty:
+                pass
+
+            # Only the latest of several stores of the same roster in a batch is written
+            stored = {}
+            for operation in operations:
+                if operation is None:
+                    continue
+                function, args = operation
+                jid = args[-2] if function == self._insert_roster else args[-1]
+                if function == self._insert_roster:
+                    stored[jid] = args
+                    continue
+                if function == self._select_roster and jid in stored:
+                    self._run(connection, self._insert_roster, stored.pop(jid))
+                if function == self._delete_roster:
+                    stored.pop(jid, None)
+                self._run(connection, function, args)
+
+            for args in stored.itervalues():
+                self._run(connection, self._insert_roster, args)
+            connection.commit()
+            for operation in operations:
+                self.operations.task_done()
+
+        connection.close()
+
+    def _run(self, connection, function, args):
+        try:
+            function(connection, *args)
+        except Exception as e:
+            logging.exception(e)
+
+    def stop(self):
+        self.keepRunning = False
+        self.operations.put(None)
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(self.stop_timeout)
+            if self.is_alive():
+                logging.error('SQLiteRosterStorage : %d operations left unwritten on stop', self.operations.qsize())
+
+    def store_roster(self, jid, snapshot):
+        self.operations.put((self._insert_roster, (jid, snapshot)))
+
+    def remove_roster(self, jid):
+        self.operations.put((self._delete_roster, (jid,)))
+
+    def load_roster(self, jid):
+        future = futures.Future()
+        self.operations.put((self._select_roster, (future, jid)))
+        return future
+
+    def _insert_roster(self, connection, jid, snapshot):
+        connection.execute('INSERT OR REPLACE INTO rosters (jid, version, roster) VALUES (?, ?, ?)',
+                           (jid, snapshot.get('version'), json.dumps(snapshot)))
+
+    def _delete_roster(self, connection, jid):
+        connection.execute('DELETE FROM rosters WHERE jid = ?', (jid,))
+
+    def _select_roster(self, connection, future, jid):
+        try:
+            row = connection.execute('SELECT roster FROM rosters WHERE jid = ?', (jid,)).fetchone()
+            future.set_result(json.loads(row[0]) if row is not None else None)
+        except Exception as e:
+            future.set_exception(e)
@@ -1,28 +1,53 @@
 # -*- coding: utf-8 -*-
 __author__ = 'v.kovtash@gmail.com'
 
+import time
 import uuid
 import logging
-from Queue import Queue
+import functools
+from collections import OrderedDict
+from tornado import ioloop
+from tornado.concurrent import Future
+from session_notifier import default_notifier
+
+def client_locked(method):
+    """ XMPP client may be served by XMPP IOLoop thread, so session methods hold client lock.
+        Contacts are returned as copies, which stanza handlers do not change while they are written out."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.xmpp_client.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class XMPPSession(object):
-    def __init__(self, session_id, xmpp_client, im_client):
+    def __init__(self, session_id, xmpp_client, im_client, token=None, max_waiters=100, notifier=None):
         self.session_id = session_id
-        self.token = uuid.uuid4().hex
+        if token is None:
+            token = uuid.uuid4().hex
+        self.token = token
         self.im_client = im_client
         self.xmpp_client = xmpp_client
         self.xmpp_client.register_events_observer(self)
-        self.notification_queue = Queue()
-        if not self.xmpp_client.isConnected():
-            self.xmpp_client.setup_connection()
+        self.max_waiters = max_waiters
+        self.notification_waiters = OrderedDict()
+        if notifier is None:
+            notifier = default_notifier
+        self.notifier = notifier
         self.should_send_message_body = False
 
+    def snapshot(self):
+        return {'session_id':self.session_id,
+                'token':self.token,
+                'im_client_id':self.im_client.client_id,
+                'should_send_message_body':self.should_send_message_body}
+
     def clean(self, with_notification=True):
         if with_notification:
             self.im_client.push_notification(message="Session closed. Login again, to start new session.")
         logging.debug(u'SessionEvent : Session %s start cleaning', self.xmpp_client.jid)
         self.im_client.session_closed(self)
         self.xmpp_client.unregister_events_observer(self)
+        self.notify_observers()
         logging.debug(u'SessionEvent : Session %s cleaning done', self.xmpp_client.jid)
 
     def message_appended_notification(self, contact_id, message_text, inbound):
@@ -43,9 +68,19 @@ class XMPPSession(object):
     def contacts_updated_notification(self):
         self.notify_observers()
 
+    def connection_state_changed_notification(self):
+        self.notify_observers()
+
+    @property
+    def state(self):
+        return self.xmpp_client.state
+
     def unread_count_updated_notification(self):
         self.im_client.push_notification(sound=False)
 
+    def unread_count_changed_notification(self, delta):
+        self.im_client.unread_count_changed(self, delta)
+
     @property
     def jid(self):
         return self.xmpp_client.jid.getStripped()
@@ -54,48 +89,103 @@ class XMPPSession(object):
     def unread_count(self):
         return self.xmpp_client.unread_count
 
-    def messages(self, contact_ids=None, event_offset=None):
-        return self.xmpp_client.messages(contact_ids=contact_ids, event_offset=event_offset)
+    @client_locked
+    def messages(self, contact_ids=None, event_offset=None, limit=None):
+        messages = self.xmpp_client.messages(contact_ids=contact_ids, event_offset=event_offset, limit=limit)
+        return [message.as_dict() for message in messages]
+
+    @client_locked
+    def feed(self, event_offset=None, limit=None):
+        contacts, messages = self.xmpp_client.feed(event_offset=event_offset, limit=limit)
+        return [dict(contact) for contact in contacts], [message.as_dict() for message in messages]
+
+    @client_locked
+    def history(self, contact_id, before=None, limit=50):
+        return self.xmpp_client.history(contact_id=contact_id, before=before, limit=limit)
 
+    @client_locked
     def send(self, contact_id, message):
-        return self.xmpp_client.send_message(contact_id=contact_id, message=message)
+        messages = self.xmpp_client.send_message(contact_id=contact_id, message=message)
+        return [message.as_dict() for message in messages]
 
+    @client_locked
     def send_by_jid(self, jid, message):
-        return self.xmpp_client.send_message_by_jid(jid=jid, message=message)
+        messages = self.xmpp_client.send_message_by_jid(jid=jid, message=message)
+        return [message.as_dict() for message in messages]
 
-    def contacts(self, event_offset=None):
-        return self.xmpp_client.contacts(event_offset=event_offset)
+    @client_locked
+    def contacts(self, event_offset=None, limit=None):
+        return [dict(contact) for contact in self.xmpp_client.contacts(event_offset=event_offset, limit=limit)]
 
+    @client_locked
     def contact(self, contact_id):
         contact = self.xmpp_client.contact(contact_id)
         if  contact is None:
             raise KeyError
-        return contact
+        return dict(contact)
 
+    @client_locked
     def add_contact(self, jid, name=None, groups=[]):
         return self.xmpp_client.add_contact(jid=jid, name=name, groups=groups)
 
+    @client_locked
     def update_contact(self, contact_id, name=None, groups=None):
         self.xmpp_client.update_contact(contact_id=contact_id, name=name, groups=groups)
 
+    @client_locked
     def set_contact_read_offset(self, contact_id, read_offset):
         self.xmpp_client.set_contact_read_offset(contact_id=contact_id, read_offset=read_offset)
 
+    @client_locked
     def set_contact_authorization(self, contact_id, authorization):
         self.xmpp_client.set_contact_authorization(contact_id=contact_id, authorization=authorization)
 
+    @client_locked
     def contact_by_jid(self, jid):
-        return self.xmpp_client.contact_by_jid(jid=jid)
+        contact = self.xmpp_client.contact_by_jid(jid=jid)
+        if contact is not None:
+            contact = dict(contact)
+        return contact
 
+    @client_locked
     def remove_contact(self, contact_id):
         self.xmpp_client.remove_contact(contact_id=contact_id)
 
-    def wait_for_notification(self, callback):
-        self.notification_queue.put_nowait(callback)
+    def wait_for_notification(self, timeout=None):
+        """ Returns Future resolved with True on the next notification or with False when timeout
+            in seconds expires. When session has max_waiters waiters the oldest one is resolved with False.
+            Should be called from IOLoop thread."""
+        waiter = Future()
+        timeout_handle = None
+        if timeout is not None:
+            timeout_handle = ioloop.IOLoop.instance().add_timeout(time.time() + timeout,
+                                                                  functools.partial(self._resolve_waiter, waiter, False))
+        self.notification_waiters[waiter] = timeout_handle
+
+        while len(self.notification_waiters) > self.max_waiters:
+            oldest_waiter = next(iter(self.notification_waiters))
+            self._resolve_waiter(oldest_waiter, False)
+
+        return waiter
+
+    def cancel_wait(self, waiter):
+        """ Resolves waiter with False, used when HTTP connection is closed by client,
+            so the request waiting for it finishes and is released."""
+        self._resolve_waiter(waiter, False)
+
+    def _resolve_waiter(self, waiter, notified):
+        if waiter not in self.notification_waiters:
+            return
+        timeout_handle = self.notification_waiters.pop(waiter)
+        if timeout_handle is not None:
+            ioloop.IOLoop.instance().remove_timeout(timeout_handle)
+        waiter.set_result(notified)
 
     def notify_observers(self):
-        notification_queue = self.notification_queue
-        while not notification_queue.empty():
-            callback = notification_queue.get_nowait()
-            callback()
-            notification_queue.task_done()
+        """ Wakes all waiters. May be called from any thread, waiters are resolved on IOLoop thread
+            by the notifier, which merges notifications of the same session."""
+        self.notifier.notify(self)
+
+    def wake_waiters(self):
+        for waiter in self.notification_waiters.keys():
+            self._resolve_waiter(waiter, True)
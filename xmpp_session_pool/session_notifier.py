@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import time
+import threading
+from tornado import ioloop
+
+class XMPPSessionNotifier(object):
+    """ Collects sessions notified while stanzas are processed and wakes waiters of every
+        dirty session once per IOLoop iteration, or once per window seconds when window is set.
+        Waiters read the combined changes from their offset, so merged notifications lose nothing."""
+    def __init__(self, window=None):
+        self.window = window
+        self.dirty_sessions = set()
+        self.notifications = 0
+        self.merged = 0
+        self.wakeups = 0
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+
+    def notify(self, session):
+        """ Marks session dirty. May be called from any thread."""
+        with self._lock:
+            self.notifications += 1
+            if session in self.dirty_sessions:
+                self.merged += 1
+                return
+            self.dirty_sessions.add(session)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+
+        ioloop.IOLoop.instance().add_callback(self._schedule_flush)
+
+    def _schedule_flush(self):
+        if self.window:
+            ioloop.IOLoop.instance().add_timeout(time.time() + self.window, self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            dirty_sessions = self.dirty_sessions
+            self.dirty_sessions = set()
+            self._flush_scheduled = False
+            self.wakeups += len(dirty_sessions)
+
+        for session in dirty_sessions:
+            session.wake_waiters()
+
+    def stats(self):
+        return {'notifications':self.notifications,
+                'merged':self.merged,
+                'wakeups':self.wakeups}
+
+
+default_notifier = XMPPSessionNotifier()
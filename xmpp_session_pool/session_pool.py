@@ -1,92 +1,347 @@
 # -*- coding: utf-8 -*-
 __author__ = 'v.kovtash@gmail.com'
 
+import os
 import uuid
+import logging
+import threading
+from tornado import ioloop, gen
 from session import XMPPSession
+from session_notifier import XMPPSessionNotifier
 from xmpp_client import XMPPClient
+from xmpp_transport import DEFAULT_HIGH_WATER_MARK
+from credentials_cache import XMPPCredentialsCache
+from reconnect_scheduler import XMPPReconnectScheduler
+from keepalive import XMPPKeepalive
 from errors import XMPPAuthError
 import xmpp_inbound_dispatchers
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
 class XMPPSessionPool(object):
-    def __init__(self, debug=False, push_sender=None):
+    def __init__(self, debug=False, push_sender=None, messages_storage=None, roster_storage=None, chat_buffer_size=50,
+                 presence_debounce=None, notification_window=None, send_high_water_mark=DEFAULT_HIGH_WATER_MARK,
+                 credentials_ttl=300, reconnect_max_delay=300.0, reconnect_concurrency=10,
+                 keepalive_interval=60, keepalive_timeout=30, io_loops=0, stanza_budget=0.01):
         self.session_pool = {}
         self.xmpp_client_pool = {}
         self.im_client_pool = {}
         self.debug = debug
         self.push_sender = push_sender
+        self.messages_storage = messages_storage
+        self.roster_storage = roster_storage
+        self.chat_buffer_size = chat_buffer_size
+        self.presence_debounce = presence_debounce
+        self.send_high_water_mark = send_high_water_mark
+        self.notifier = XMPPSessionNotifier(window=notification_window)
+        self.pending_logins = {}
+        self.credentials_cache = XMPPCredentialsCache(ttl=credentials_ttl)
+        self.reconnect_scheduler = XMPPReconnectScheduler(max_delay=reconnect_max_delay, max_concurrent=reconnect_concurrency)
+        self.reconnect_scheduler.auth_failed = self._reconnect_auth_failed
+        self.keepalive = None
+        if keepalive_interval:
+            self.keepalive = XMPPKeepalive(idle_interval=keepalive_interval, pong_timeout=keepalive_timeout)
+            self.keepalive.start()
+        self.io_loop_pool = None
+        if io_loops:
+            self.io_loop_pool = xmpp_inbound_dispatchers.XMPPTornadoIOLoopPool(io_loops)
+            self.io_loop_pool.start()
+        self.stanza_scheduler = None
+        if stanza_budget and not io_loops:
+            self.stanza_scheduler = xmpp_inbound_dispatchers.XMPPStanzaScheduler(budget=stanza_budget)
         if self.push_sender is not None:
             self.push_sender.start()
+        if self.messages_storage is not None:
+            self.messages_storage.start()
+        if self.roster_storage is not None:
+            self.roster_storage.start()
 
+    @gen.coroutine
     def start_session(self, jid, password, server=None, push_token=None, im_client_id=None):
+        """ Logs in to XMPP server without blocking IOLoop. Concurrent requests for the same jid
+            wait for the single login in progress, then check their own credentials.
+            Credentials verified recently are not checked by XMPP server again."""
+        if jid in self.pending_logins:
+            try:
+                yield self.pending_logins[jid]
+            except Exception:
+                pass
+
         if jid not in self.xmpp_client_pool:
-            xmpp_client = XMPPClient(jid=jid, password=password, server=server)
-            xmpp_client.setup_connection()
-            xmpp_dispatcher = xmpp_inbound_dispatchers.XMPPTornadoMainIOLoopDispatcher(xmpp_client)
+            xmpp_client = XMPPClient(jid=jid, password=password, server=server,
+                                     chat_buffer_size=self.chat_buffer_size, messages_storage=self.messages_storage,
+                                     roster_storage=self.roster_storage,
+                                     presence_debounce=self.presence_debounce,
+                                     send_high_water_mark=self.send_high_water_mark,
+                                     reconnect_scheduler=self.reconnect_scheduler)
+            login = xmpp_client.connect_async()
+            self.pending_logins[jid] = login
+            try:
+                yield login
+            finally:
+                del self.pending_logins[jid]
+            self.credentials_cache.store(jid, password)
+            xmpp_dispatcher = self._new_dispatcher(xmpp_client)
             xmpp_dispatcher.start()
 
             self.xmpp_client_pool[jid] = xmpp_dispatcher
+            if self.keepalive is not None:
+                self.keepalive.add(xmpp_client)
         else:
             xmpp_dispatcher = self.xmpp_client_pool[jid]
-            if not xmpp_dispatcher.client.check_credentials(jid, password):
-                raise XMPPAuthError
+            if not self.credentials_cache.check(jid, password):
+                credentials_valid = yield xmpp_dispatcher.client.check_credentials_async(jid, password)
+                if not credentials_valid:
+                    self.credentials_cache.invalidate(jid)
+                    raise XMPPAuthError
+                self.credentials_cache.store(jid, password)
+            if not xmpp_dispatcher.client.available:
+                yield self._connect_closed_client(jid, xmpp_dispatcher.client)
 
         if im_client_id is None:
             im_client_id = uuid.uuid4().hex
 
         if im_client_id not in self.im_client_pool:
-            self.im_client_pool[im_client_id] = IMClient(client_id=im_client_id, push_token=push_token, push_sender=self.push_sender)
+            self.im_client_pool[im_client_id] = IMClient(client_id=im_client_id, push_token=push_token, push_sender=self.push_sender,
+                                                         notifier=self.notifier)
 
         im_client = self.im_client_pool[im_client_id]
 
-        session = im_client.start_session(jid=jid, xmpp_client=xmpp_dispatcher.client)
+        with xmpp_dispatcher.client.lock:
+            session = im_client.start_session(jid=jid, xmpp_client=xmpp_dispatcher.client)
         if session.session_id not in self.session_pool:
             self.session_pool[session.session_id] = session
 
-        return session.session_id
+        raise gen.Return(session.session_id)
+
+    @gen.coroutine
+    def _connect_closed_client(self, jid, xmpp_client):
+        """ Pooled client closed by server error is connected again before a new session is started for it."""
+        login = self.pending_logins.get(jid)
+        if login is not None:
+            yield login
+            return
+
+        login = xmpp_client.connect_async()
+        self.pending_logins[jid] = login
+        try:
+            yield login
+        finally:
+            del self.pending_logins[jid]
 
     def close_session(self,session_id,with_notification=False):
+        """ Should be called from IOLoop thread, XMPP connection is closed without waiting for server."""
         session = self.session_pool[session_id]
         im_client = session.im_client
-
-        if session.xmpp_client.jid in self.xmpp_client_pool:
-            xmpp_dispatcher = self.xmpp_client_pool[session.xmpp_client.jid]
+        xmpp_dispatcher = self.xmpp_client_pool.get(session.xmpp_client.jid)
 
         if len(im_client.sessions) and im_client.client_id in self.im_client_pool:
             del self.im_client_pool[im_client.client_id]
 
-        session.clean(with_notification=with_notification)
+        with session.xmpp_client.lock:
+            session.clean(with_notification=with_notification)
         del self.session_pool[session_id]
 
         if  xmpp_dispatcher is not None and not xmpp_dispatcher.client.observers_count:
+            if self.keepalive is not None:
+                self.keepalive.remove(xmpp_dispatcher.client)
             xmpp_dispatcher.stop()
             del self.xmpp_client_pool[session.xmpp_client.jid]
 
+    def _new_dispatcher(self, xmpp_client):
+        """ Every dispatcher is created here, so streams of all clients, restored ones included, are read
+            and handled by XMPP IOLoop thread of their jid when io_loops are configured, by IOLoop in turns
+            limited by stanza_budget otherwise."""
+        if self.io_loop_pool is not None:
+            return xmpp_inbound_dispatchers.XMPPTornadoShardedDispatcher(xmpp_client, self.io_loop_pool)
+        return xmpp_inbound_dispatchers.XMPPTornadoMainIOLoopDispatcher(xmpp_client, scheduler=self.stanza_scheduler)
+
     def session_for_id(self,session_id):
         return self.session_pool[session_id]
 
     def clean(self):
         for session_key in self.session_pool.keys():
             self.close_session(session_key,with_notification=True)
+        self.shutdown()
+
+    def presence_stats(self):
+        """ Presence counters summed over all XMPP clients."""
+        stats = {'received':0, 'suppressed':0, 'debounced':0}
+        for xmpp_dispatcher in self.xmpp_client_pool.itervalues():
+            roster = xmpp_dispatcher.client.__dict__.get('XMPPRoster')
+            if roster is None:
+                continue
+            for key, value in roster.presenceStats().iteritems():
+                stats[key] += value
+        return stats
+
+    def stream_management_stats(self):
+        """ Stream management counters summed over all XMPP clients."""
+        stats = {'enabled':0, 'unacked':0, 'resumed':0, 'resume_failed':0}
+        for xmpp_dispatcher in self.xmpp_client_pool.itervalues():
+            for key, value in xmpp_dispatcher.client.XMPPStreamManagement.stats().iteritems():
+                stats[key] += value
+        return stats
+
+    def send_queue_stats(self):
+        """ Outgoing queue depth and flush latency of every connected XMPP client."""
+        stats = {}
+        for jid, xmpp_dispatcher in self.xmpp_client_pool.iteritems():
+            client_stats = xmpp_dispatcher.client.send_queue_stats()
+            if client_stats is not None:
+                stats[jid] = client_stats
+        return stats
+
+    def shutdown(self):
+        """ Stop background workers and keep sessions, used when pool state is saved by save_snapshot. """
         if self.push_sender is not None:
             self.push_sender.stop()
+        if self.messages_storage is not None:
+            self.messages_storage.stop()
+        if self.roster_storage is not None:
+            self.roster_storage.stop()
+        if self.keepalive is not None:
+            self.keepalive.stop()
+        if self.io_loop_pool is not None:
+            self.io_loop_pool.stop()
+
+    def snapshot(self):
+        xmpp_clients = []
+        xmpp_client_keys = {}
+        for jid, xmpp_dispatcher in self.xmpp_client_pool.iteritems():
+            with xmpp_dispatcher.client.lock:
+                client_snapshot = xmpp_dispatcher.client.snapshot()
+            client_snapshot['key'] = jid
+            xmpp_clients.append(client_snapshot)
+            xmpp_client_keys[id(xmpp_dispatcher.client)] = jid
+
+        sessions = []
+        for session in self.session_pool.itervalues():
+            session_snapshot = session.snapshot()
+            session_snapshot['xmpp_client'] = xmpp_client_keys[id(session.xmpp_client)]
+            sessions.append(session_snapshot)
+
+        im_clients = [{'client_id':im_client.client_id, 'push_token':im_client.push_token}
+                      for im_client in self.im_client_pool.itervalues()]
+
+        return {'xmpp_clients':xmpp_clients, 'im_clients':im_clients, 'sessions':sessions}
+
+    def restore(self, snapshot):
+        """ Restore sessions, tokens, rosters and buffered messages saved by snapshot.
+            XMPP connections are not established here, see connect_restored_clients."""
+        for client_snapshot in snapshot['xmpp_clients']:
+            xmpp_client = XMPPClient(jid=client_snapshot['jid'], password=client_snapshot['password'],
+                                     server=client_snapshot['server'], port=client_snapshot['port'],
+                                     chat_buffer_size=self.chat_buffer_size, messages_storage=self.messages_storage,
+                                     roster_storage=self.roster_storage,
+                                     presence_debounce=self.presence_debounce,
+                                     send_high_water_mark=self.send_high_water_mark,
+                                     reconnect_scheduler=self.reconnect_scheduler)
+            xmpp_client.restore(client_snapshot)
+            xmpp_dispatcher = self._new_dispatcher(xmpp_client)
+            xmpp_dispatcher.start()
+            self.xmpp_client_pool[client_snapshot['key']] = xmpp_dispatcher
+            if self.keepalive is not None:
+                self.keepalive.add(xmpp_client)
+
+        for im_client_snapshot in snapshot['im_clients']:
+            im_client_id = im_client_snapshot['client_id']
+            self.im_client_pool[im_client_id] = IMClient(client_id=im_client_id, push_token=im_client_snapshot['push_token'], push_sender=self.push_sender,
+                                                         notifier=self.notifier)
+
+        for session_snapshot in snapshot['sessions']:
+            xmpp_dispatcher = self.xmpp_client_pool.get(session_snapshot['xmpp_client'])
+            im_client = self.im_client_pool.get(session_snapshot['im_client_id'])
+            if xmpp_dispatcher is None or im_client is None:
+                continue
+            session = im_client.start_session(jid=xmpp_dispatcher.client.jid.getStripped(), xmpp_client=xmpp_dispatcher.client,
+                                              session_id=session_snapshot['session_id'], token=session_snapshot['token'])
+            session.should_send_message_body = session_snapshot['should_send_message_body']
+            self.session_pool[session.session_id] = session
+
+    def connect_restored_clients(self):
+        """ Establish connections of restored clients in background by reconnect_scheduler, which paces them
+            as reconnects, retries failed ones with backoff and closes sessions which fail authentication.
+            Restored sessions keep serving their tokens, contacts and messages in the meantime."""
+        for xmpp_dispatcher in self.xmpp_client_pool.values():
+            if xmpp_dispatcher.client.restored:
+                self.reconnect_scheduler.schedule(xmpp_dispatcher.client)
+
+    def _reconnect_auth_failed(self, xmpp_client):
+        for jid, xmpp_dispatcher in self.xmpp_client_pool.items():
+            if xmpp_dispatcher.client is xmpp_client:
+                self.credentials_cache.invalidate(jid)
+        logging.info(u'SessionEvent : Session %s can not authenticate on reconnect', xmpp_client.jid)
+        self._close_client_sessions(xmpp_client)
+
+    def _close_client_sessions(self, xmpp_client):
+        for session_id, session in self.session_pool.items():
+            if session.xmpp_client is xmpp_client:
+                self.close_session(session_id, with_notification=True)
+
+    def save_snapshot(self, path, async_worker=None):
+        """ Write snapshot to path. It contains passwords and tokens, so file is readable by owner only.
+            File is written by async_worker when it is given."""
+        data = json.dumps(self.snapshot())
+
+        def write_snapshot():
+            temp_path = path + '.tmp'
+            snapshot_file = os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w')
+            try:
+                snapshot_file.write(data)
+            finally:
+                snapshot_file.close()
+            os.rename(temp_path, path)
+
+        if async_worker is not None:
+            return async_worker.submit(write_snapshot)
+        write_snapshot()
+
+    def load_snapshot(self, path):
+        if not os.path.exists(path):
+            return False
+        with open(path) as snapshot_file:
+            self.restore(json.loads(snapshot_file.read()))
+        return True
 
 class IMClient(object):
-    def __init__(self, client_id, push_token=None, push_sender=None):
+    def __init__(self, client_id, push_token=None, push_sender=None, notifier=None):
         self.client_id = client_id
+        self.notifier = notifier
         self.sessions = {}
         self.push_token = push_token
         self.push_sender = push_sender
+        self.unread_count = 0
+        self._lock = threading.Lock()
 
-    def start_session(self, jid, xmpp_client):
-        if jid not in self.sessions:
-            self.sessions[jid] = XMPPSession(session_id=uuid.uuid4().hex, xmpp_client=xmpp_client, im_client=self)
-        return self.sessions[jid]
+    def start_session(self, jid, xmpp_client, session_id=None, token=None):
+        with self._lock:
+            if jid not in self.sessions:
+                if session_id is None:
+                    session_id = uuid.uuid4().hex
+                self.sessions[jid] = XMPPSession(session_id=session_id, xmpp_client=xmpp_client, im_client=self, token=token,
+                                                 notifier=self.notifier)
+                self.unread_count += self.sessions[jid].unread_count
+            return self.sessions[jid]
 
     def session_closed(self, session):
-        del self.sessions[session.jid]
+        with self._lock:
+            del self.sessions[session.jid]
+            self.unread_count -= session.unread_count
+
+    def unread_count_changed(self, session, delta):
+        """ Keeps running badge total. Changes reported before session is registered are
+            already included in its unread_count when start_session adds it.
+            Called holding lock of the session's XMPP client, as are start_session and session_closed,
+            sessions of different clients may change the total from different XMPP IOLoop threads."""
+        with self._lock:
+            if self.sessions.get(session.jid) is session:
+                self.unread_count += delta
 
     def push_notification(self,message=None,contact_name=None,contact_id=None,sound=True):
         if self.push_token is None or self.push_sender is None:
             return
-        unread_count = sum(session.unread_count for session in self.sessions.values())
-        self.push_sender.notify(token=self.push_token,message=message,unread_count=unread_count,contact_name=contact_name,contact_id=contact_id,sound=sound)
\ No newline at end of file
+        self.push_sender.notify(token=self.push_token,message=message,unread_count=self.unread_count,contact_name=contact_name,contact_id=contact_id,sound=sound)
\ No newline at end of file
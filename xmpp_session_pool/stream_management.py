@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import xmpp
+import threading
+from xmpp.client import PlugIn
+from collections import deque
+from tornado import ioloop
+
+NS_SM = 'urn:xmpp:sm:3'
+STANZAS = ('message', 'presence', 'iq')
+
+class XMPPStreamManagement(PlugIn):
+    """ XEP-0198 stream management. Counts handled inbound stanzas and keeps sent ones until
+        server acknowledges them. Nothing is dropped from unacked, senders of messages are expected
+        to back off while it is backlogged, at max_unacked stanzas. Stanzas may be sent from any thread,
+        sequence number is assigned under lock together with queueing of stanza data, so it follows
+        the order stanzas are written in. Stream enabled with resumption can be resumed
+        after reconnection: server resends what client missed, client resends what server has not
+        acknowledged, and session is not established again.
+        Plugin outlives connections, it is enabled or resumed by XMPPLogin after authentication."""
+    def __init__(self, max_unacked=500, io_loop=None):
+        PlugIn.__init__(self)
+        self.max_unacked = max_unacked
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.DBG_LINE = 'stream_management'
+        self.enabled = False
+        self.stream_id = None
+        self.inbound = 0
+        self.outbound = 0
+        self.unacked = deque()
+        self.resumed = 0
+        self.resume_failed = 0
+        self.lock = threading.RLock()
+        self._ack_requested = False
+        self._dispatcher = None
+        self._dispatcher_send = None
+        self._resumed_callback = None
+        self._failed_callback = None
+
+    @property
+    def resumable(self):
+        return self.stream_id is not None
+
+    @property
+    def backlogged(self):
+        return len(self.unacked) >= self.max_unacked
+
+    def supported(self):
+        features = self._owner.Dispatcher.Stream.features
+        return features is not None and features.getTag('sm', namespace=NS_SM) is not None
+
+    def enable(self):
+        """ Enables stream management on a new session. Messages left unacknowledged by
+            previous stream are sent again."""
+        with self.lock:
+            pending = [stanza for sequence, stanza in self.unacked if stanza.getName() == 'message']
+            self.inbound = 0
+            self.outbound = 0
+            self.unacked.clear()
+            self._install()
+            self._owner.Dispatcher.send('<enable xmlns="%s" resume="true"/>'%NS_SM)
+            self.enabled = True
+            for stanza in pending:
+                self.send(stanza)
+
+    def resume(self, resumed, failed):
+        """ Asks server to resume previous stream, resumed or failed is called with server answer."""
+        self.enabled = False
+        self._install()
+        self._resumed_callback = resumed
+        self._failed_callback = failed
+        self._owner.Dispatcher.send('<resume xmlns="%s" h="%d" previd="%s"/>'%(NS_SM, self.inbound, self.stream_id))
+
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            self.stream_id = None
+            self.unacked.clear()
+
+    def send(self, stanza):
+        """ Replaces owner's send while stream management is enabled."""
+        with self.lock:
+            result = self._dispatcher_send(stanza)
+            if self.enabled and isinstance(stanza, xmpp.simplexml.Node):
+                self.track(stanza)
+        return result
+
+    def track(self, stanza):
+        """ Counts stanza sent bypassing send, e.g. serialised together with others.
+            Caller holds lock from sending stanza data until it is tracked."""
+        if stanza.getName() not in STANZAS:
+            return
+        self.outbound += 1
+        self.unacked.append((self.outbound, stanza))
+        if not self._ack_requested:
+            self._ack_requested = True
+            self.io_loop.add_callback(self._request_ack)
+
+    def _install(self):
+        """ Wraps send and stanza dispatching of the current dispatcher."""
+        dispatcher = self._owner.Dispatcher
+        if dispatcher is self._dispatcher:
+            return
+        self._dispatcher = dispatcher
+        self._dispatcher_send = dispatcher.send
+        self._owner.__dict__['send'] = self.send
+
+        stream = dispatcher.Stream
+        dispatch = stream.dispatch
+        def counting_dispatch(stanza, *args, **kwargs):
+            if stanza.getName() in STANZAS and stanza.getNamespace() == self._owner.Namespace:
+                self.inbound += 1
+            return dispatch(stanza, *args, **kwargs)
+        stream.dispatch = counting_dispatch
+
+        for name in ('enabled', 'resumed', 'failed', 'r', 'a'):
+            dispatcher.RegisterHandler(name, self.StreamManagementHandler, xmlns=NS_SM)
+
+    def _request_ack(self):
+        self._ack_requested = False
+        if self.enabled and self._owner.isConnected():
+            self._owner.Dispatcher.send('<r xmlns="%s"/>'%NS_SM)
+
+    def _acknowledged(self, h):
+        with self.lock:
+            while len(self.unacked) and self.unacked[0][0] <= h:
+                self.unacked.popleft()
+
+    def StreamManagementHandler(self, dis, stanza):
+        name = stanza.getName()
+        if name == 'r':
+            self._owner.Dispatcher.send('<a xmlns="%s" h="%d"/>'%(NS_SM, self.inbound))
+        elif name == 'a':
+            self._acknowledged(int(stanza.getAttr('h')))
+        elif name == 'enabled':
+            if stanza.getAttr('resume') in ('true', '1'):
+                self.stream_id = stanza.getAttr('id')
+        elif name == 'resumed':
+            self.resumed += 1
+            h = int(stanza.getAttr('h'))
+            with self.lock:
+                self._acknowledged(h)
+                unacked = [stanza for sequence, stanza in self.unacked]
+                self.unacked.clear()
+                self.outbound = h
+                self.enabled = True
+                for stanza in unacked:
+                    self.send(stanza)
+            self._resumed_callback()
+        elif name == 'failed':
+            if self.enabled:
+                self.enabled = False
+                self.stream_id = None
+            else:
+                self.resume_failed += 1
+                self.stream_id = None
+                self._failed_callback()
+        raise xmpp.protocol.NodeProcessed
+
+    def stats(self):
+        return {'enabled':self.enabled,
+                'unacked':len(self.unacked),
+                'resumed':self.resumed,
+                'resume_failed':self.resume_failed}
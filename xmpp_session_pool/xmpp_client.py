@@ -2,14 +2,24 @@
 __author__ = 'v.kovtash@gmail.com'
 
 import xmpp
+import heapq
 import logging
+import itertools
+import threading
+from tornado import gen, ioloop
+from xmpp_login import XMPPLogin
+from xmpp_transport import XMPPAsyncSocket, DEFAULT_HIGH_WATER_MARK
+from stream_management import XMPPStreamManagement
 from xmpp_roster import XMPPRoster
 from event_id import XMPPSessionEventID
-from errors import XMPPAuthError, XMPPConnectionError, XMPPRosterError, XMPPSendError
+from errors import XMPPAuthError, XMPPConnectionError, XMPPRosterError, XMPPSendError, XMPPSendQueueFull
 from message_store import XMPPMessagesStore
+from message import XMPPMessage
 
 class XMPPClient(xmpp.Client):
-    def __init__(self, jid, password, server, port=5222):
+    def __init__(self, jid, password, server, port=5222, chat_buffer_size=50, messages_storage=None,
+                 presence_debounce=None, send_high_water_mark=DEFAULT_HIGH_WATER_MARK, reconnect_scheduler=None,
+                 roster_storage=None):
         self.jid = xmpp.protocol.JID(jid)
         self._Password = password
         self._User = self.jid.getNode()
@@ -21,9 +31,22 @@ class XMPPClient(xmpp.Client):
         self._DEBUG = xmpp.Debug.NoDebug()
         self.DEBUG = self._DEBUG.Show
         self.id_generator = XMPPSessionEventID()
+        self.chat_buffer_size = chat_buffer_size
+        self.messages_storage = messages_storage
+        self.roster_storage = roster_storage
         self._event_observers = []
         self._connect_handlers = []
         self.error_state = False
+        self.restored = False
+        self.reconnecting = False
+        self.reconnect_scheduler = reconnect_scheduler
+        self.unread_contacts = set()
+        self.presence_debounce = presence_debounce
+        # Stanza handlers may run on XMPP IOLoop thread, client state is changed and read holding lock
+        self.lock = threading.RLock()
+        self.callback_queue = None
+        XMPPStreamManagement().PlugIn(self)
+        self.send_high_water_mark = send_high_water_mark
 
     def RegisterConnectHandler(self, handler):
         """ Register handler that will be called on connect."""
@@ -36,6 +59,18 @@ class XMPPClient(xmpp.Client):
     def _connected(self):
         for i in self._connect_handlers: i()
 
+    def add_callback(self, callback, *args):
+        """ Runs callback on IOLoop holding client lock. May be called from any thread,
+            callbacks of clients served by XMPP IOLoop threads are run in batches by callback_queue."""
+        if self.callback_queue is not None:
+            self.callback_queue.put(self._run_locked, callback, args)
+        else:
+            ioloop.IOLoop.instance().add_callback(self._run_locked, callback, args)
+
+    def _run_locked(self, callback, args):
+        with self.lock:
+            callback(*args)
+
     def reconnectAndReauth(self):
         """ Example of reconnection method. In fact, it can be used to batch connection and auth as well. """
         handlerssave=self.Dispatcher.dumpHandlers()
@@ -49,6 +84,7 @@ class XMPPClient(xmpp.Client):
         self.Dispatcher.PlugOut()
         if self.__dict__.has_key('HTTPPROXYsocket'): self.HTTPPROXYsocket.PlugOut()
         if self.__dict__.has_key('TCPsocket'): self.TCPsocket.PlugOut()
+        if self.__dict__.has_key('XMPPAsyncSocket'): self.XMPPAsyncSocket.PlugOut()
         if not self.connect(server=self._Server,proxy=self._Proxy): return
         if not self.auth(self._User,self._Password,self._Resource): return
         self.Dispatcher.restoreHandlers(handlerssave)
@@ -56,6 +92,15 @@ class XMPPClient(xmpp.Client):
         return self.connected
 
     def DisconnectHandler(self):
+        """ Reconnects by reconnect_scheduler in background when it is set. Contacts and messages
+            are served meanwhile and observers are notified that client is reconnecting."""
+        if self.reconnect_scheduler is not None:
+            if not self.reconnecting:
+                self.reconnecting = True
+                self.post_connection_state_notification()
+                self.reconnect_scheduler.schedule(self)
+            return
+
         retry_count = 5
         while not self.isConnected() and retry_count:
             self.reconnectAndReauth()
@@ -70,14 +115,14 @@ class XMPPClient(xmpp.Client):
     def getRoster(self):
         """ Return the Roster instance, previously plugging it in and
             requesting roster from server if needed. """
-        if not self.__dict__.has_key('Roster'):
-            XMPPRoster(self.id_generator).PlugIn(self)
-        return self.Roster.getRoster()
+        if not self.__dict__.has_key('XMPPRoster'):
+            XMPPRoster(self.id_generator, presence_debounce=self.presence_debounce, storage=self.roster_storage).PlugIn(self)
+        return self.XMPPRoster.getRoster()
 
     def sendPresence(self,jid=None,typ=None,requestRoster=0):
         """ Send some specific presence state.
             Can also request roster from server if according agrument is set."""
-        if requestRoster: XMPPRoster(self.id_generator).PlugIn(self)
+        if requestRoster: XMPPRoster(self.id_generator, presence_debounce=self.presence_debounce, storage=self.roster_storage).PlugIn(self)
         self.send(xmpp.dispatcher.Presence(to=jid, typ=typ))
 
     def _debugging_handler(self, con, event):
@@ -99,6 +144,7 @@ class XMPPClient(xmpp.Client):
         if message_text is not None:
             jid_from = event.getFrom().getStripped()
             contact_id = self.roster.itemId(jid_from)
+            self._update_unread_state(contact_id)
             self.post_message_notification(contact_id, message_text, inbound=True)
         else:
             received = event.getTag('received')
@@ -116,60 +162,173 @@ class XMPPClient(xmpp.Client):
     @property
     def message_storage(self):
         if not self.__dict__.has_key('XMPPMessagesStore'):
-            XMPPMessagesStore(self.id_generator).PlugIn(self)
+            XMPPMessagesStore(self.id_generator, chat_buffer_size=self.chat_buffer_size, storage=self.messages_storage).PlugIn(self)
         return self.XMPPMessagesStore
 
-    def setup_connection(self):
-        if not self.isConnected():
+    @gen.coroutine
+    def connect_async(self, timeout=30):
+        """ Connects, authenticates and requests roster driven by IOLoop, without blocking the calling thread.
+            Roster cached by roster_storage is loaded first, so only its changes are downloaded.
+            Client closed before gets its disconnect handler back, so it reconnects in background again."""
+        with self.lock:
+            # Lost connection may be still handled by XMPP IOLoop thread, login starts after it
+            connected = self.isConnected()
+        if not connected:
             logging.debug('SessionEvent : Session %s Setup connection',self.jid)
-            con = self.connect(server=self._Server)
+            if self.DisconnectHandler not in self.disconnect_handlers:
+                self.disconnect_handlers.insert(0, self.DisconnectHandler)
+            if self.roster_storage is not None and not self.__dict__.has_key('XMPPRoster'):
+                try:
+                    roster_snapshot = yield self.roster_storage.load_roster(self.jid.getStripped())
+                except Exception as e:
+                    logging.exception(e)
+                    roster_snapshot = None
+                if roster_snapshot is not None and not self.__dict__.has_key('XMPPRoster'):
+                    XMPPRoster(self.id_generator, presence_debounce=self.presence_debounce, storage=self.roster_storage).PlugIn(self)
+                    self.XMPPRoster.restore(roster_snapshot, renumber=True)
+                    self.XMPPRoster.set = None
+            login = XMPPLogin(self, self._Server, self._User, self._Password, self._Resource,
+                              session_started=self._session_established,
+                              session_resumed=self._session_resumed,
+                              ready=self._roster_received,
+                              timeout=timeout,
+                              high_water_mark=self.send_high_water_mark)
+            yield login.start()
+            self._session_ready()
+
+    def _session_established(self):
+        """ Registers handlers and requests roster once session is established."""
+        self._register_handlers()
+
+        if not self.error_state:
+            if self.__dict__.has_key('XMPPRoster'):
+                self.XMPPRoster.Request(force=1)
+            self.sendInitPresence()
+        else:
+            raise XMPPConnectionError(self.Server)
 
-            if not self.isConnected() or con is None:
-                raise XMPPConnectionError(self.Server)
+    def _session_resumed(self):
+        """ Resumed stream keeps presence and roster on server, only the new dispatcher needs handlers."""
+        self._register_handlers()
 
-            self._connected()
+    def _register_handlers(self):
+        if self.restored or self.reconnecting:
+            self.message_storage.RegisterHandlers()
+        else:
+            self.message_storage #Create message storage and register its handlers before registering self handlers
 
-            auth = self.auth(self._User,self._Password,self._Resource)
-            if not auth:
-                raise XMPPAuthError()
+        self.Dispatcher.RegisterHandler('presence', self._xmpp_presence_handler)
+        self.Dispatcher.RegisterHandler('iq', self._xmpp_presence_handler,'set', xmpp.protocol.NS_ROSTER)
+        self.Dispatcher.RegisterHandler('message', self._xmpp_message_handler)
+        self.Dispatcher.RegisterDefaultHandler(self._debugging_handler)
+        self.Dispatcher.RegisterHandler('iq', self._xmpp_error_handler,'error', xmpp.protocol.NS_ROSTER)
 
-            self.message_storage #Create message storage and register its handlers before registering self handlers
+        if not self.error_state and self.__dict__.has_key('XMPPRoster'):
+            self.XMPPRoster.RegisterHandlers()
 
-            self.Dispatcher.RegisterHandler('presence', self._xmpp_presence_handler)
-            self.Dispatcher.RegisterHandler('iq', self._xmpp_presence_handler,'set', xmpp.protocol.NS_ROSTER)
-            self.Dispatcher.RegisterHandler('message', self._xmpp_message_handler)
-            self.Dispatcher.RegisterDefaultHandler(self._debugging_handler)
-            self.Dispatcher.RegisterHandler('iq', self._xmpp_error_handler,'error', xmpp.protocol.NS_ROSTER)
+    def _roster_received(self):
+        if self.error_state:
+            raise XMPPConnectionError(self.Server)
+        return self.XMPPRoster.set
 
-            if not self.error_state:
-                self.sendInitPresence()
-            else:
-                raise XMPPConnectionError(self.Server)
+    def _session_ready(self):
+        reconnected = self.reconnecting
+        self.restored = False
+        self.reconnecting = False
+        self._connected()
+        if reconnected:
+            self.post_connection_state_notification()
 
-            if not self.error_state:
-                self.getRoster()
-            else:
-                raise XMPPConnectionError(self.Server)
+    @property
+    def logged_in(self):
+        """ XMPPLogin sets connected as soon as TCP is connected, stanzas queued while TLS and SASL
+            are negotiated would go out ahead of the new stream header, so they are sent only after login
+            has finished and client is neither reconnecting nor restored."""
+        return bool(self.isConnected() and '+sasl' in self.connected and not (self.reconnecting or self.restored))
+
+    @property
+    def state(self):
+        if self.logged_in:
+            return 'connected'
+        if self.reconnecting:
+            return 'reconnecting'
+        if self.restored:
+            return 'restored'
+        return 'disconnected'
 
-    def check_credentials(self, jid, password):
+    @property
+    def available(self):
+        """ Contacts and messages are served while client is connected, restored or reconnecting."""
+        return bool(self.isConnected() or self.restored or self.reconnecting)
+
+    def snapshot(self):
+        roster = self.__dict__.get('XMPPRoster')
+        if roster is not None and roster.set:
+            roster_snapshot = roster.snapshot()
+        else:
+            roster_snapshot = None
+
+        return {'jid':unicode(self.jid),
+                'password':self._Password,
+                'server':self._Server[0],
+                'port':self._Server[1],
+                'event_id':self.id_generator.id(),
+                'roster':roster_snapshot,
+                'messages':self.message_storage.snapshot()}
+
+    def restore(self, snapshot):
+        """ Restore roster and buffered messages saved by snapshot before connection is established.
+            Restored client serves contacts and messages until connect_async has finished."""
+        self.id_generator.reset(snapshot['event_id'])
+        XMPPRoster(self.id_generator, presence_debounce=self.presence_debounce, storage=self.roster_storage).PlugIn(self)
+        if snapshot['roster'] is not None:
+            self.XMPPRoster.restore(snapshot['roster'])
+        else:
+            self.XMPPRoster.set = 1
+        self.message_storage.restore(snapshot['messages'])
+        self.restored = True
+        for contact_id in self.XMPPRoster.getRawRoster().keys():
+            self._update_unread_state(contact_id)
+
+    @gen.coroutine
+    def check_credentials_async(self, jid, password, timeout=30):
+        """ Checks password of jid by a separate login, which does not block IOLoop."""
         jid = xmpp.protocol.JID(jid)
-        user = jid.getNode()
         client = xmpp.Client(jid.getDomain(), self.Port,debug=[])
-        con = client.connect(server=self._Server)
-
-        if not client.isConnected() or con is None:
-            raise XMPPConnectionError(self.Server)
+        login = XMPPLogin(client, self._Server, jid.getNode(), password, self._Resource, timeout=timeout)
+        try:
+            yield login.start()
+        except XMPPAuthError:
+            raise gen.Return(False)
 
-        auth = client.auth(user,password,self._Resource)
-        client.Dispatcher.disconnect()
-        if not auth:
-            return False
-        else:
-            return True
+        login.disconnect()
+        raise gen.Return(True)
 
     def close(self):
-        self.UnregisterDisconnectHandler(self.DisconnectHandler)
-        self.Dispatcher.disconnect()
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.DisconnectHandler in self.disconnect_handlers:
+            self.UnregisterDisconnectHandler(self.DisconnectHandler)
+        if self.reconnecting or self.restored:
+            self.reconnecting = False
+            self.restored = False
+            if self.reconnect_scheduler is not None:
+                self.reconnect_scheduler.cancel(self)
+        self.XMPPStreamManagement.disable()
+        if self.__dict__.has_key('XMPPRoster'):
+            self.XMPPRoster.cancelDeferredPresence()
+        if self.__dict__.has_key('Dispatcher'):
+            connection = self.__dict__.get('Connection')
+            if isinstance(connection, XMPPAsyncSocket) and connection.attached:
+                # Dispatcher.disconnect would wait for server to close the stream, so stream is closed
+                # by queued footer and connection is closed right after it without blocking IOLoop.
+                connection.send('</stream:stream>')
+                connection.disconnect()
+                self.disconnected()
+            else:
+                self.Dispatcher.disconnect()
 
     def register_events_observer(self,observer):
         self._event_observers.append(observer)
@@ -199,21 +358,58 @@ class XMPPClient(xmpp.Client):
             if callable(contacts_updated_notification):
                 contacts_updated_notification()
 
+    def post_connection_state_notification(self):
+        for observer in self._event_observers:
+            connection_state_changed_notification = getattr(observer, 'connection_state_changed_notification', None)
+            if callable(connection_state_changed_notification):
+                connection_state_changed_notification()
+
     def post_unread_count_notification(self):
         for observer in self._event_observers:
             unread_count_updated_notification = getattr(observer, 'unread_count_updated_notification', None)
             if callable(unread_count_updated_notification):
                 unread_count_updated_notification()
 
-    def messages(self, contact_ids=None, event_offset=None):
-        return self.message_storage.messages(contact_ids=contact_ids, event_offset=event_offset)
+    def post_unread_count_changed_notification(self, delta):
+        for observer in self._event_observers:
+            unread_count_changed_notification = getattr(observer, 'unread_count_changed_notification', None)
+            if callable(unread_count_changed_notification):
+                unread_count_changed_notification(delta)
+
+    def messages(self, contact_ids=None, event_offset=None, limit=None):
+        return self.message_storage.messages(contact_ids=contact_ids, event_offset=event_offset, limit=limit)
+
+    def feed(self, event_offset=None, limit=None):
+        """ Returns contacts and messages changed after event_offset, at most limit objects in total
+            with the lowest event_ids. Contacts and messages are merged lazily from their logs."""
+        if not self.available:
+            raise XMPPRosterError()
+
+        if limit is None:
+            return self.contacts(event_offset=event_offset), self.messages(event_offset=event_offset)
+
+        changes = heapq.merge(self.roster.contactChanges(event_offset), self.message_storage.message_events(event_offset))
+        contacts = []
+        messages = []
+        for event_id, record in itertools.islice(changes, limit):
+            if isinstance(record, XMPPMessage):
+                messages.append(record)
+            else:
+                contacts.append(record)
+
+        self.message_storage.messages_delivered(messages)
+        return contacts, messages
+
+    def history(self, contact_id, before=None, limit=50):
+        return self.message_storage.history(contact_id=contact_id, before=before, limit=limit)
 
     def send_message(self, contact_id, message):
         jid = self.roster.getItem(contact_id)['jid']
         return self.send_message_by_jid(jid, message)
 
     def send_message_by_jid(self, jid, message):
-        if self.isConnected():
+        if self.logged_in:
+            self.check_send_queue()
             delivery_receipt_request = xmpp.protocol.Protocol(name='request', xmlns='urn:xmpp:receipts')
             message_stanza = xmpp.protocol.Message(to=jid, body=message,
                 typ='chat',
@@ -225,7 +421,8 @@ class XMPPClient(xmpp.Client):
             if not id:
                 raise XMPPSendError()
 
-            result = self.message_storage.append_message(contact_id=contact_id, inbound=False, text=message, message_id=message_id)
+            result = self.message_storage.append_message(contact_id=contact_id, inbound=False, text=message, message_id=message_id, jid=jid)
+            self._update_unread_state(contact_id)
             self.post_message_notification(contact_id=contact_id, message_text=message, inbound=False)
             return result
         else:
@@ -236,59 +433,132 @@ class XMPPClient(xmpp.Client):
         self.send_message_delivery_receipt_by_jid(jid, message_id)
 
     def send_message_delivery_receipt_by_jid(self, jid, message_id):
-        if  self.isConnected():
-            delivery_receipt_ack = xmpp.protocol.Protocol(name='received', xmlns='urn:xmpp:receipts', attrs={'id':message_id})
-            message_stanza = xmpp.protocol.Message(to=jid, payload=[delivery_receipt_ack])
+        if  self.logged_in:
+            message_stanza = self._delivery_receipt_stanza(jid, message_id)
 
             logging.debug(u"XMPPEvent : %s"%message_stanza)
             self.send(message_stanza)
             if not id:
                 raise XMPPSendError()
 
-    def contacts(self,event_offset=None):
-        if not self.isConnected():
+    def send_message_delivery_receipts(self, receipts):
+        """ Send receipts for dict of contact_id: [message_id, ...] with a single socket write. """
+        if not self.logged_in:
+            return
+
+        stanzas = []
+        for contact_id, message_ids in receipts.iteritems():
+            contact = self.roster.getItem(contact_id)
+            if contact is None:
+                continue
+            for message_id in message_ids:
+                stanzas.append(self._delivery_receipt_stanza(contact['jid'], message_id))
+
+        self.send_stanzas(stanzas)
+
+    def check_send_queue(self):
+        """ Raises XMPPSendQueueFull while outgoing queue is above high-water mark,
+            so senders back off instead of growing it."""
+        connection = self.__dict__.get('Connection')
+        if isinstance(connection, XMPPAsyncSocket) and connection.backlogged:
+            raise XMPPSendQueueFull()
+        if self.XMPPStreamManagement.backlogged:
+            raise XMPPSendQueueFull()
+
+    def send_queue_stats(self):
+        connection = self.__dict__.get('Connection')
+        if isinstance(connection, XMPPAsyncSocket):
+            return connection.queue_stats()
+
+    def _delivery_receipt_stanza(self, jid, message_id):
+        delivery_receipt_ack = xmpp.protocol.Protocol(name='received', xmlns='urn:xmpp:receipts', attrs={'id':message_id})
+        return xmpp.protocol.Message(to=jid, payload=[delivery_receipt_ack])
+
+    def send_stanzas(self, stanzas):
+        """ Serialise stanzas and put them on the wire with a single write. """
+        if not len(stanzas):
+            return
+
+        metastream = self.Dispatcher._metastream
+        for stanza in stanzas:
+            stanza.setNamespace(self.Namespace)
+            stanza.setParent(metastream)
+
+        data = u''.join(xmpp.simplexml.ustr(stanza) for stanza in stanzas)
+        logging.debug(u"XMPPEvent : %s"%data)
+        stream_management = self.XMPPStreamManagement
+        with stream_management.lock:
+            self.send(data)
+            if stream_management.enabled:
+                for stanza in stanzas:
+                    stream_management.track(stanza)
+
+    def contacts(self,event_offset=None,limit=None):
+        if not self.available:
             raise XMPPRosterError()
 
-        return self.roster.getContacts(event_offset=event_offset)
+        return self.roster.getContacts(event_offset=event_offset, limit=limit)
 
     def contact(self,contact_id):
-        if self.isConnected():
+        if self.available:
             return self.roster.getItem(contact_id)
         else:
             raise XMPPRosterError()
 
     def add_contact(self,jid,name=None,groups=[]):
-        if self.isConnected():
+        if self.logged_in:
+            self.check_send_queue()
             self.roster.setItem(jid,name=name,groups=groups)
             self.roster.Subscribe(jid)
 
     def update_contact(self,contact_id,name=None,groups=None):
-        if self.isConnected():
+        if self.logged_in:
+            self.check_send_queue()
             self.roster.updateItem(contact_id,name=name,groups=groups)
 
     @property
     def unread_count(self):
-        unread_count = 0
-        chats_store = self.message_storage.chats_store
-        for contact in self.roster.getRawRoster().values():
-            if (contact['id'] in chats_store
-                and chats_store[contact['id']][-1]['inbound']
-                and contact['read_offset'] < chats_store[contact['id']][-1]['event_id']):
-                unread_count += 1
+        return len(self.unread_contacts)
+
+    def _update_unread_state(self, contact_id):
+        """ Contact is unread when its last message is inbound and newer than contact read offset.
+            Returns True if unread count has changed. Unread state is changed holding client lock only,
+            together with the messages and read offsets it is derived from."""
+        contact = self.roster.getItem(contact_id)
+        last_message = self.message_storage.last_message(contact_id)
+        unread = (contact is not None
+                  and last_message is not None
+                  and last_message.inbound
+                  and contact['read_offset'] < last_message.event_id)
+
+        if unread == (contact_id in self.unread_contacts):
+            return False
 
-        return unread_count
+        if unread:
+            self.unread_contacts.add(contact_id)
+            self.post_unread_count_changed_notification(1)
+        else:
+            self.unread_contacts.discard(contact_id)
+            self.post_unread_count_changed_notification(-1)
+        return True
+
+    def contact_removed(self, contact_id):
+        if contact_id in self.unread_contacts:
+            self.unread_contacts.discard(contact_id)
+            self.post_unread_count_changed_notification(-1)
+            self.post_unread_count_notification()
 
     def set_contact_read_offset(self, contact_id, read_offset):
-        old_unread_count_value = self.unread_count
+        """ Should be called holding client lock, see _update_unread_state."""
         if self.roster.setItemReadOffset(contact_id, read_offset):
             self.post_contacts_notification()
-        if  old_unread_count_value != self.unread_count:
-            self.post_unread_count_notification()
+            if self._update_unread_state(contact_id):
+                self.post_unread_count_notification()
 
     def set_contact_authorization(self, contact_id, authorization):
         roster = self.roster
         contact = roster.getItem(contact_id)
-        if contact is None or contact['authorization'] == authorization:
+        if not self.logged_in or contact is None or contact['authorization'] == authorization:
             return
 
         if  authorization == 'granted':
@@ -298,12 +568,12 @@ class XMPPClient(xmpp.Client):
             roster.Unauthorize(contact['jid'])
 
     def contact_by_jid(self,jid):
-        if self.isConnected():
+        if self.available:
             return self.roster.getItemByJID(jid)
         else:
             raise XMPPRosterError()
 
     def remove_contact(self,contact_id):
         item = self.roster.getItem(contact_id)
-        if item is not None and 'jid' in item:
+        if self.logged_in and item is not None and 'jid' in item:
             self.roster.delItem(item['jid'])
\ No newline at end of file
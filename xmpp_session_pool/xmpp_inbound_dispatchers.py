@@ -1,16 +1,31 @@
 __author__ = 'kovtash'
 
+import time
+import bisect
+import hashlib
 import logging
+import functools
+from collections import deque
 from tornado import ioloop
 import threading
 import xmpp
 from errors import XMPPConnectionError
+from xmpp_transport import XMPPAsyncSocket
+
+def detach_connection(client):
+    """ Switches non-blocking connection to blocking mode for Process based dispatchers."""
+    connection = client.__dict__.get('Connection')
+    if isinstance(connection, XMPPAsyncSocket):
+        connection.detach()
+
 
 class XMPPTornadoIOLoopThread(threading.Thread):
+    """ IOLoop running in its own thread. Handlers may be added and removed from any thread,
+        changes are applied by the loop itself. Loop keeps running without handlers until stop()."""
     def __init__(self):
         super(XMPPTornadoIOLoopThread, self).__init__()
         self.ioLoop = ioloop.IOLoop()
-        self.handlers = self.ioLoop.__dict__['_handlers']
+        self.clients = set()
         self.daemon = True
 
     def run(self):
@@ -19,15 +34,184 @@ class XMPPTornadoIOLoopThread(threading.Thread):
 
     def stop(self):
         logging.info('DispatcherEvent : stopping ioloop')
-        self.ioLoop.stop()
+        self.ioLoop.add_callback(self.ioLoop.stop)
 
     def add_handler(self, fd, handler, events):
-        self.ioLoop.add_handler(fd, handler, events)
+        self.ioLoop.add_callback(self.ioLoop.add_handler, fd, handler, events)
 
     def remove_handler(self, fd):
-        self.ioLoop.remove_handler(fd)
-        if len(self.handlers) < 2:
-            self.stop()
+        self.ioLoop.add_callback(self.ioLoop.remove_handler, fd)
+
+
+class XMPPCallbackQueue(object):
+    """ Thread-safe queue of callbacks run by IOLoop. Callbacks put from other threads during one
+        IOLoop iteration are run together, so IOLoop is woken up once per batch instead of once per callback."""
+    def __init__(self, io_loop=None):
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.callbacks = 0
+        self.batches = 0
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def put(self, callback, *args):
+        with self._lock:
+            self._queue.append((callback, args))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.io_loop.add_callback(self._run)
+
+    def _run(self):
+        with self._lock:
+            queue, self._queue = self._queue, deque()
+            self._scheduled = False
+        self.batches += 1
+        self.callbacks += len(queue)
+        for callback, args in queue:
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.exception(e)
+
+
+class XMPPStanzaScheduler(object):
+    """ Shares IOLoop between XMPP streams and HTTP requests. Data read from XMPP connections is queued
+        and parsed in slices of at most chunk_size bytes, round robin over connections, until budget seconds
+        are spent in the IOLoop iteration. The rest is parsed in the next iteration, after requests which
+        became ready meanwhile, so a burst of inbound stanzas holds IOLoop for about budget and one slice.
+        Stanza wait is the time data waited in the queue, request wait is the time each run held IOLoop."""
+    def __init__(self, budget=0.01, chunk_size=4096, io_loop=None):
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.queued_bytes = 0
+        self.slices = 0
+        self.runs = 0
+        self.deferred = 0
+        self.stanza_wait = 0.0
+        self.max_stanza_wait = 0.0
+        self.request_wait = 0.0
+        self.max_request_wait = 0.0
+        self._queue = deque()
+        self._pending = {}
+        self._scheduled = False
+        self._active = None
+        self._flush_active = False
+
+    def submit(self, dispatcher, data):
+        pending = self._pending.get(dispatcher)
+        if pending is None:
+            pending = self._pending[dispatcher] = deque()
+            self._queue.append(dispatcher)
+        pending.append([data, time.time()])
+        self.queued_bytes += len(data)
+        if not self._scheduled:
+            self._scheduled = True
+            self.io_loop.add_callback(self._run)
+
+    def flush(self, dispatcher):
+        """ Parses all queued data of dispatcher at once, before its connection changes."""
+        if dispatcher not in self._pending:
+            return
+        if dispatcher is self._active:
+            self._flush_active = True
+            return
+        self._queue.remove(dispatcher)
+        dispatcher.process_data(self._take(dispatcher))
+
+    def _take(self, dispatcher, size=None):
+        pending = self._pending[dispatcher]
+        chunks = []
+        taken = 0
+        now = time.time()
+        while pending and (size is None or taken < size):
+            entry = pending[0]
+            data, arrived = entry
+            if size is not None and taken + len(data) > size:
+                data, entry[0] = data[:size - taken], data[size - taken:]
+            else:
+                pending.popleft()
+            chunks.append(data)
+            taken += len(data)
+            wait = now - arrived
+            self.stanza_wait += wait
+            self.max_stanza_wait = max(self.max_stanza_wait, wait)
+            self.slices += 1
+        if not pending:
+            del self._pending[dispatcher]
+        self.queued_bytes -= taken
+        return ''.join(chunks)
+
+    def _run(self):
+        self._scheduled = False
+        self.runs += 1
+        started = time.time()
+        while self._queue and time.time() - started < self.budget:
+            dispatcher = self._queue.popleft()
+            data = self._take(dispatcher, self.chunk_size)
+            if dispatcher in self._pending:
+                self._queue.append(dispatcher)
+            self._active = dispatcher
+            try:
+                dispatcher.process_data(data)
+            finally:
+                self._active = None
+            if self._flush_active:
+                self._flush_active = False
+                self.flush(dispatcher)
+
+        elapsed = time.time() - started
+        self.request_wait += elapsed
+        self.max_request_wait = max(self.max_request_wait, elapsed)
+        if self._queue:
+            self.deferred += 1
+            self._scheduled = True
+            self.io_loop.add_callback(self._run)
+
+    def stats(self):
+        return {'queued':len(self._queue),
+                'queued_bytes':self.queued_bytes,
+                'runs':self.runs,
+                'deferred':self.deferred,
+                'stanza_wait':self.stanza_wait / self.slices if self.slices else 0.0,
+                'max_stanza_wait':self.max_stanza_wait,
+                'request_wait':self.request_wait / self.runs if self.runs else 0.0,
+                'max_request_wait':self.max_request_wait}
+
+
+class XMPPTornadoIOLoopPool(object):
+    """ XMPP IOLoop threads. Client is assigned to a thread by consistent hashing of its jid,
+        so it stays on the same thread across reconnects and changing the number of threads
+        moves only a share of clients. Work for IOLoop is handed back by callback_queue."""
+    def __init__(self, count, replicas=64, io_loop=None):
+        self.threads = [XMPPTornadoIOLoopThread() for i in xrange(count)]
+        self.callback_queue = XMPPCallbackQueue(io_loop=io_loop)
+        self._ring = sorted((self._hash('%d-%d'%(index, replica)), index)
+                            for index in xrange(count) for replica in xrange(replicas))
+        self._ring_keys = [key for key, index in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def thread_for(self, jid):
+        position = bisect.bisect(self._ring_keys, self._hash(unicode(jid).lower().encode('utf-8'))) % len(self._ring)
+        return self.threads[self._ring[position][1]]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for thread in self.threads:
+            thread.stop()
+
+    def stats(self):
+        return {'threads':len(self.threads),
+                'clients':[len(thread.clients) for thread in self.threads],
+                'callbacks':self.callback_queue.callbacks,
+                'batches':self.callback_queue.batches}
 
 
 class XMPPTornadoIOLoopDispatcher(object):
@@ -45,9 +229,10 @@ class XMPPTornadoIOLoopDispatcher(object):
         if self.current_sock is not None:
             self.ioLoopThread.remove_handler(self.current_sock)
 
-        if 'TCPsocket' in self.client.__dict__:
+        detach_connection(self.client)
+        if 'Connection' in self.client.__dict__:
             try:
-                self.current_sock = self.client.__dict__['TCPsocket']._sock.fileno()
+                self.current_sock = self.client.__dict__['Connection']._sock.fileno()
             except AttributeError:
                 self.stop()
                 raise XMPPConnectionError
@@ -83,21 +268,38 @@ class XMPPTornadoIOLoopDispatcher(object):
         self.client.close()
 
 class XMPPTornadoMainIOLoopDispatcher(object):
-    def __init__(self, client):
+    """ Serves client on the main IOLoop. Non-blocking connection is read as data arrives and
+        fed to the incremental stream parser, which dispatches complete stanzas only,
+        so a slow server can not block IOLoop. With scheduler data is parsed when it is the
+        connection's turn. Blocking connections are served by Process."""
+    def __init__(self, client, scheduler=None):
         super(XMPPTornadoMainIOLoopDispatcher, self).__init__()
         self.client = client
+        self.scheduler = scheduler
         self.ioLoop = ioloop.IOLoop.instance()
         self.current_sock = None
+        self.current_connection = None
         client.RegisterConnectHandler(self._connected)
         client.RegisterDisconnectHandler(self._disconnected)
 
     def _connected(self):
+        self._flush()
         if self.current_sock is not None:
             self.ioLoop.remove_handler(self.current_sock)
+            self.current_sock = None
+        if self.current_connection is not None:
+            self.current_connection.pause()
+            self.current_connection = None
 
-        if 'TCPsocket' in self.client.__dict__:
+        connection = self.client.__dict__.get('Connection')
+        if isinstance(connection, XMPPAsyncSocket) and connection.attached:
+            self.current_connection = connection
+            connection.resume(self.handle_connection_event)
+            return
+
+        if connection is not None:
             try:
-                self.current_sock = self.client.__dict__['TCPsocket']._sock.fileno()
+                self.current_sock = connection._sock.fileno()
             except AttributeError:
                 self.stop()
                 raise XMPPConnectionError
@@ -106,9 +308,13 @@ class XMPPTornadoMainIOLoopDispatcher(object):
             self.ioLoop.add_handler(self.current_sock, self.handle_read, self.ioLoop.READ)
 
     def _disconnected(self):
+        self._flush()
         if self.current_sock is not None:
             self.ioLoop.remove_handler(self.current_sock)
             self.current_sock = None
+        if self.current_connection is not None:
+            self.current_connection.pause()
+            self.current_connection = None
 
     def handle_read(self, fd, events):
         try:
@@ -118,13 +324,88 @@ class XMPPTornadoMainIOLoopDispatcher(object):
         except Exception as e:
             logging.exception(e)
 
+    def _flush(self):
+        if self.scheduler is not None:
+            self.scheduler.flush(self)
+
+    def handle_connection_event(self, event, data):
+        """ Same as Process, for data already read by connection."""
+        if event in ('error', 'detached'):
+            self._flush()
+        if event == 'error':
+            self.client.disconnected()
+            return
+        if event != 'data':
+            return
+
+        if self.scheduler is not None:
+            self.scheduler.submit(self, data)
+        else:
+            self.process_data(data)
+
+    def process_data(self, data):
+        try:
+            dispatcher = self.client.Dispatcher
+            for handler in dispatcher._cycleHandlers: handler(dispatcher)
+            dispatcher.Stream.Parse(data)
+            if len(dispatcher._pendingExceptions):
+                exc_info = dispatcher._pendingExceptions.pop()
+                raise exc_info[0], exc_info[1], exc_info[2]
+        except xmpp.protocol.StreamError:
+            self.client.close()
+        except Exception as e:
+            logging.exception(e)
+
     def start(self):
         self._connected()
 
     def stop(self):
+        self._flush()
         self.client.close()
 
 
+class XMPPTornadoShardedDispatcher(XMPPTornadoMainIOLoopDispatcher):
+    """ Serves client on one of XMPPTornadoIOLoopPool threads. Login and reconnects run on the main IOLoop,
+        then connection is moved to the thread, which reads it, parses the stream and runs stanza handlers
+        holding client lock. Main IOLoop holds the same lock while it serves the client, and work handed
+        to it by client.add_callback goes through callback_queue of the pool. Blocking connections
+        are served by the main IOLoop."""
+    def __init__(self, client, io_loop_pool):
+        super(XMPPTornadoShardedDispatcher, self).__init__(client)
+        self.thread = io_loop_pool.thread_for(client.jid.getStripped())
+        client.callback_queue = io_loop_pool.callback_queue
+
+    def _connected(self):
+        connection = self.client.__dict__.get('Connection')
+        if not (isinstance(connection, XMPPAsyncSocket) and connection.attached):
+            return super(XMPPTornadoShardedDispatcher, self)._connected()
+        if connection is self.current_connection:
+            return
+
+        self._disconnected()
+        self.current_connection = connection
+        connection.move(self.thread.ioLoop, functools.partial(self.handle_thread_event, connection))
+
+    def handle_thread_event(self, connection, event, data):
+        """ Runs on the XMPP IOLoop thread. Events of the connection replaced or released
+            by the main IOLoop meanwhile are dropped."""
+        with self.client.lock:
+            if connection is not self.current_connection:
+                return
+            if event == 'error':
+                self.client.disconnected()
+            elif event == 'data':
+                self.process_data(data)
+
+    def start(self):
+        self.thread.clients.add(self)
+        super(XMPPTornadoShardedDispatcher, self).start()
+
+    def stop(self):
+        self.thread.clients.discard(self)
+        super(XMPPTornadoShardedDispatcher, self).stop()
+
+
 class XMPPThreadedDispatcher(threading.Thread):
     """Threaded XMPPClient dispatcher"""
     def __init__(self, client):
@@ -133,6 +414,7 @@ class XMPPThreadedDispatcher(threading.Thread):
         self.keepRunning = True
 
     def run(self):
+        detach_connection(self.client)
         while self.keepRunning:
             try:
                 self.client.Process(30)
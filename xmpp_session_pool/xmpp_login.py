@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import sys
+import time
+import logging
+import xmpp
+from tornado import ioloop, netutil
+from tornado.concurrent import Future
+from xmpp_transport import XMPPAsyncSocket, DEFAULT_HIGH_WATER_MARK
+from errors import XMPPAuthError, XMPPConnectionError
+
+class XMPPLogin(object):
+    """ Logs xmpp.Client in without blocking IOLoop: TCP connect, STARTTLS when server offers it,
+        SASL authentication, resource binding and session. Then session_started is called and login
+        waits until ready returns true, e.g. until roster is received.
+        Client with XMPPStreamManagement plugged in resumes its previous stream instead of binding
+        when it can, session_resumed is called then, otherwise stream management is enabled.
+        Blocking xmpppy loops are replaced by the same conditions checked after every received chunk,
+        SASL steps and stream restarts are done by xmpppy's own event driven handlers.
+        Host name is resolved by tornado's ThreadedResolver, its threads are shared by all logins,
+        so slow DNS does not block IOLoop.
+        start() returns Future resolved with client or failed with XMPPAuthError or XMPPConnectionError.
+        Connection of logged in client is paused until dispatcher resumes or detaches it."""
+    def __init__(self, client, server, user, password, resource, use_tls=True,
+                 session_started=None, session_resumed=None, ready=None, timeout=30,
+                 high_water_mark=DEFAULT_HIGH_WATER_MARK, io_loop=None):
+        self.client = client
+        self.server = server
+        self.user = user
+        self.password = password
+        self.resource = resource
+        self.use_tls = use_tls
+        self.session_started = session_started
+        self.session_resumed = session_resumed
+        self.ready = ready
+        self.timeout = timeout
+        self.high_water_mark = high_water_mark
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.state = None
+        self.future = Future()
+        self._tls_done = False
+        self._session_required = False
+        self._timeout_handle = None
+
+    def start(self):
+        self.reset_client(self.client)
+        self._timeout_handle = self.io_loop.add_timeout(time.time() + self.timeout, self._timed_out)
+        self.state = 'resolving'
+        host, port = self.server
+        resolved = netutil.ThreadedResolver(io_loop=self.io_loop).resolve(host, port)
+        self.io_loop.add_future(resolved, self._resolved)
+        return self.future
+
+    @staticmethod
+    def reset_client(client):
+        """ Plugs out connection plugins left by previous connection."""
+        for name in ('Bind', 'SASL', 'TLS', 'Dispatcher', 'XMPPAsyncSocket', 'TCPsocket'):
+            if client.__dict__.has_key(name):
+                try:
+                    client.__dict__[name].PlugOut()
+                except Exception:
+                    client.__dict__.pop(name, None)
+        client.connected = ''
+
+    def disconnect(self):
+        """ Closes stream of logged in client, used when connection was needed for authentication only."""
+        connection = self.client.__dict__.get('Connection')
+        if connection is not None:
+            try:
+                connection.send('</stream:stream>')
+            finally:
+                self.reset_client(self.client)
+
+    def _resolved(self, future):
+        try:
+            addresses = future.result()
+            transport = XMPPAsyncSocket(self.server, io_loop=self.io_loop, high_water_mark=self.high_water_mark)
+            transport.PlugIn(self.client)
+            self.state = 'connecting'
+            transport.connect_async(addresses[0], self._transport_event)
+        except Exception:
+            self._fail(XMPPConnectionError(self.server[0]))
+
+    def _transport_event(self, event, data):
+        try:
+            if event == 'connected':
+                self.client.connected = 'tcp'
+                self.client._Server, self.client._Proxy = self.server, None
+                xmpp.dispatcher.Dispatcher().PlugIn(self.client)
+                self.state = 'stream'
+            elif event == 'tls':
+                self._tls_done = True
+                self.client.connected = 'tls'
+                self.client.Dispatcher.PlugOut()
+                xmpp.dispatcher.Dispatcher().PlugIn(self.client)
+                self.state = 'stream'
+            elif event == 'data':
+                dispatcher = self.client.Dispatcher
+                dispatcher.Stream.Parse(data)
+                if len(dispatcher._pendingExceptions):
+                    exc_info = dispatcher._pendingExceptions.pop()
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            elif event == 'error':
+                raise XMPPConnectionError(self.server[0])
+            self._advance()
+        except (XMPPAuthError, XMPPConnectionError) as error:
+            self._fail(error)
+        except Exception:
+            logging.debug(u'SessionEvent : Login of %s failed', self.user, exc_info=sys.exc_info())
+            self._fail(XMPPConnectionError(self.server[0]))
+
+    def _advance(self):
+        """ Runs state steps until state stops changing, each step waits for its condition."""
+        while not self.future.done():
+            state = self.state
+            getattr(self, '_step_' + state)()
+            if self.state == state:
+                break
+
+    def _step_resolving(self):
+        pass
+
+    def _step_connecting(self):
+        pass
+
+    def _step_stream(self):
+        stream = self.client.Dispatcher.Stream
+        if stream._document_attrs is None:
+            return
+        if stream._document_attrs.get('version') != '1.0':
+            raise XMPPConnectionError(self.server[0])
+        if not stream.features:
+            return
+
+        if self.use_tls and not self._tls_done and stream.features.getTag('starttls', namespace=xmpp.protocol.NS_TLS):
+            self.client.RegisterHandler('proceed', self._starttls_handler, xmlns=xmpp.protocol.NS_TLS)
+            self.client.RegisterHandler('failure', self._starttls_handler, xmlns=xmpp.protocol.NS_TLS)
+            self.client.send('<starttls xmlns="%s"/>'%xmpp.protocol.NS_TLS)
+            self.state = 'starttls'
+        else:
+            self.state = 'sasl'
+
+    def _step_starttls(self):
+        pass
+
+    def _starttls_handler(self, conn, stanza):
+        if stanza.getName() == 'proceed':
+            self.client.Connection.start_tls()
+            self.state = 'tls_handshake'
+        else:
+            self.state = 'failed'
+        raise xmpp.protocol.NodeProcessed
+
+    def _step_tls_handshake(self):
+        pass
+
+    def _step_failed(self):
+        raise XMPPConnectionError(self.server[0])
+
+    def _step_sasl(self):
+        xmpp.auth.SASL(self.user, self.password).PlugIn(self.client)
+        if self.client.SASL.startsasl == 'not-supported':
+            raise XMPPConnectionError(self.server[0])
+        if self.client.SASL.startsasl != 'in-process':
+            raise XMPPAuthError()
+        self.state = 'authenticating'
+
+    def _step_authenticating(self):
+        if self.client.SASL.startsasl == 'success':
+            self.state = 'bind'
+        elif self.client.SASL.startsasl != 'in-process':
+            raise XMPPAuthError()
+
+    def _step_bind(self):
+        features = self.client.Dispatcher.Stream.features
+        if not features:
+            return
+        stream_management = self.client.__dict__.get('XMPPStreamManagement')
+        if stream_management is not None and stream_management.resumable and stream_management.supported():
+            stream_management.resume(self._stream_resumed, self._stream_resume_failed)
+            self.state = 'resuming'
+            return
+        if not features.getTag('bind', namespace=xmpp.protocol.NS_BIND):
+            raise XMPPConnectionError(self.server[0])
+        self._session_required = features.getTag('session', namespace=xmpp.protocol.NS_SESSION) is not None
+
+        resource = []
+        if self.resource:
+            resource = [xmpp.simplexml.Node('resource', payload=[self.resource])]
+        bind = xmpp.protocol.Protocol('iq', typ='set', payload=[xmpp.simplexml.Node('bind', attrs={'xmlns':xmpp.protocol.NS_BIND}, payload=resource)])
+        self.client.SendAndCallForResponse(bind, self._bind_response)
+        self.state = 'binding'
+
+    def _step_binding(self):
+        pass
+
+    def _step_resuming(self):
+        pass
+
+    def _stream_resumed(self):
+        self.state = 'resumed'
+
+    def _stream_resume_failed(self):
+        self.state = 'bind'
+
+    def _step_resumed(self):
+        self.client.connected += '+sasl'
+        if self.session_resumed is not None:
+            self.session_resumed()
+        self.state = 'ready'
+
+    def _bind_response(self, conn, stanza):
+        if not xmpp.protocol.isResultNode(stanza):
+            self.state = 'failed'
+            return
+
+        jid = xmpp.protocol.JID(stanza.getTag('bind').getTagData('jid'))
+        self.client.User = jid.getNode()
+        self.client.Resource = jid.getResource()
+        if self._session_required:
+            session = xmpp.protocol.Protocol('iq', typ='set', payload=[xmpp.simplexml.Node('session', attrs={'xmlns':xmpp.protocol.NS_SESSION})])
+            self.client.SendAndCallForResponse(session, self._session_response)
+            self.state = 'opening_session'
+        else:
+            self.state = 'session_started'
+
+    def _step_opening_session(self):
+        pass
+
+    def _session_response(self, conn, stanza):
+        if xmpp.protocol.isResultNode(stanza):
+            self.state = 'session_started'
+        else:
+            self.state = 'failed'
+
+    def _step_session_started(self):
+        self.client.connected += '+sasl'
+        stream_management = self.client.__dict__.get('XMPPStreamManagement')
+        if stream_management is not None and stream_management.supported():
+            stream_management.enable()
+        if self.session_started is not None:
+            self.session_started()
+        self.state = 'ready'
+
+    def _step_ready(self):
+        if self.ready is None or self.ready():
+            self.state = 'done'
+
+    def _step_done(self):
+        self.io_loop.remove_timeout(self._timeout_handle)
+        self.client.Connection.pause()
+        self.future.set_result(self.client)
+
+    def _timed_out(self):
+        self._timeout_handle = None
+        self._fail(XMPPConnectionError(self.server[0]))
+
+    def _fail(self, error):
+        if self.future.done():
+            return
+        logging.debug(u'SessionEvent : Login of %s failed in state %s', self.user, self.state)
+        if self._timeout_handle is not None:
+            self.io_loop.remove_timeout(self._timeout_handle)
+        self.reset_client(self.client)
+        self.future.set_exception(error)
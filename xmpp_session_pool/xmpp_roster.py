@@ -3,11 +3,17 @@ __author__ = 'v.kovtash@gmail.com'
 
 import xmpp
 import uuid
+import time
 import operator
+import functools
+from tornado import ioloop
 from event_id import XMPPSessionEventID
+from event_log import XMPPEventLog
+
+NS_ROSTER_VER = 'urn:xmpp:features:rosterver'
 
 class XMPPRoster(xmpp.roster.Roster):
-    def __init__(self,id_generator):
+    def __init__(self,id_generator,presence_debounce=None,storage=None):
         xmpp.roster.Roster.__init__(self)
         self.uuid_namespace = uuid.uuid4()
         self._internal_data = {}
@@ -15,17 +21,95 @@ class XMPPRoster(xmpp.roster.Roster):
         self.self_jid = None
         self.id_generator = id_generator
         self._jid_to_id_mapping = {}
+        self._changes = XMPPEventLog()
+        self.presence_debounce = presence_debounce
+        self.presence_received = 0
+        self.presence_suppressed = 0
+        self.presence_debounced = 0
+        self._presence_published = {}
+        self._presence_timeouts = {}
+        self.version = None
+        self.storage = storage
+        self._store_scheduled = False
+        self._request_id = None
 
     def plugin(self,owner,request=1):
         """ Register presence and subscription trackers in the owner's dispatcher.
         Also request roster from server if the 'request' argument is set.
+        Roster restored from snapshot is plugged in before connection is established,
+        its handlers are registered by RegisterHandlers later.
         Used internally."""
+        if owner.__dict__.has_key('Dispatcher'):
+            self.RegisterHandlers()
+            if request: self.Request()
+
+    def RegisterHandlers(self):
         self._owner.Dispatcher.RegisterHandler('iq', self.RosterIqHandler,'result', xmpp.protocol.NS_ROSTER, makefirst=True)
         self._owner.Dispatcher.RegisterHandler('iq', self.RosterIqHandler,'set', xmpp.protocol.NS_ROSTER, makefirst=True)
         self._owner.Dispatcher.RegisterHandler('presence', self.PresenceHandler, makefirst=True)
+        self._owner.Dispatcher.RegisterHandler('iq', self.RosterUnchangedHandler,'result', makefirst=True)
         self.self_jid = ''.join([self._owner.User,'@', self._owner.Server])
         self.self_jid = self.self_jid.lower()
-        if request: self.Request()
+
+    def versioningSupported(self):
+        features = self._owner.Dispatcher.Stream.features
+        return features is not None and features.getTag('ver', namespace=NS_ROSTER_VER) is not None
+
+    def Request(self,force=0):
+        """ Request roster from server if it were not yet requested (or if the 'force' argument is set).
+            When server supports roster versioning (XEP-0237), known version is sent along,
+            and server answers with pushes of changed items only."""
+        if self.set is None: self.set=0
+        elif not force: return
+        iq = xmpp.protocol.Iq('get',xmpp.protocol.NS_ROSTER)
+        if self.versioningSupported():
+            iq.getTag('query').setAttr('ver', self.version or '')
+        self._request_id = self._owner.send(iq)
+        self.DEBUG('Roster requested from server','start')
+
+    def _store(self):
+        """ Schedules roster saving to storage, several changes in one IOLoop iteration are saved once."""
+        if self.storage is not None and self.version is not None and not self._store_scheduled:
+            self._store_scheduled = True
+            self._owner.add_callback(self._flush_store)
+
+    def _flush_store(self):
+        self._store_scheduled = False
+        snapshot = self.snapshot()
+        snapshot['items'] = [dict(item) for item in snapshot['items']]
+        self.storage.store_roster(self._owner.jid.getStripped(), snapshot)
+
+    def snapshot(self):
+        return {'version':self.version,
+                'uuid_namespace':self.uuid_namespace.hex,
+                'items':self._data.values(),
+                'names':dict((item_id, data['name']) for item_id, data in self._internal_data.iteritems() if item_id in self._data)}
+
+    def restore(self, snapshot, renumber=False):
+        """ Restore items saved by snapshot. Presence is not restored, so online items are marked offline
+            with a new event_id until presence from contact arrives. Items loaded from storage of another
+            process get new event_ids in their previous order when renumber is set."""
+        self.version = snapshot.get('version')
+        self.uuid_namespace = uuid.UUID(snapshot['uuid_namespace'])
+        self._jid_to_id_mapping = {}
+        self._changes.clear()
+        for item in snapshot['items']:
+            item = dict(item)
+            if item['show'] != 'offline':
+                item['show'] = 'offline'
+                item['status'] = None
+                item['event_id'] = self.id_generator.id()
+            self._data[item['id']] = item
+
+        for item in sorted(self._data.itervalues(), key=operator.itemgetter('event_id')):
+            if renumber:
+                item['event_id'] = self.id_generator.id()
+            self._changes.append(item['event_id'], item)
+
+        for item_id, name in snapshot['names'].iteritems():
+            self._get_item_internal_data(item_id)['name'] = name
+
+        self.set = 1
 
     def itemId(self, jid):
         contact_id = self._jid_to_id_mapping.get(jid, None)
@@ -47,6 +131,23 @@ class XMPPRoster(xmpp.roster.Roster):
                                 'ask':None,}
         return self._data[item_id]
 
+    def _touch_item(self,item):
+        """ Assigns new event_id to the item and moves it to the end of the change index.
+            Should be called holding client lock, like roster stanzas are handled."""
+        if 'event_id' in item:
+            self._changes.discard(item['event_id'])
+        item['event_id'] = self.id_generator.id()
+        self._changes.append(item['event_id'], item)
+
+    def _remove_item(self,item_id):
+        self._presence_published.pop(item_id, None)
+        timeout = self._presence_timeouts.pop(item_id, None)
+        if timeout is not None:
+            self._owner.add_callback(ioloop.IOLoop.instance().remove_timeout, timeout)
+        item = self._data.pop(item_id, None)
+        if item is not None and 'event_id' in item:
+            self._changes.discard(item['event_id'])
+
     def _get_item_internal_data(self,item_id):
         if item_id not in self._internal_data:
             self._internal_data[item_id] = {'name':None,'nick':None,'resources':{}}
@@ -54,14 +155,29 @@ class XMPPRoster(xmpp.roster.Roster):
 
     def RosterIqHandler(self,dis,stanza):
         """ Subscription tracker. Used internally for setting items state in
-            internal roster representation. """
-        for item in stanza.getTag('query').getTags('item'):
+            internal roster representation. Full result replaces the roster, items which are not changed
+            keep their event_id."""
+        query = stanza.getTag('query')
+        if query.getAttr('ver') is not None and query.getAttr('ver') != self.version:
+            self.version = query.getAttr('ver')
+            self._store()
+
+        if stanza.getType() == 'result':
+            received = set(self.itemId(item.getAttr('jid')) for item in query.getTags('item'))
+            for item_id, roster_item in self._data.items():
+                if item_id not in received and roster_item['subscription'] != 'none':
+                    self._remove_item(item_id)
+                    self._internal_data.pop(item_id, None)
+                    self._owner.contact_removed(item_id)
+
+        for item in query.getTags('item'):
             jid=item.getAttr('jid')
             item_id = self.itemId(jid)
 
             if item.getAttr('subscription')=='remove':
-                if item_id in self._data: del self._data[item_id]
+                self._remove_item(item_id)
                 if item_id in self._internal_data: del self._internal_data[item_id]
+                self._owner.contact_removed(item_id)
                 raise xmpp.protocol.NodeProcessed             # a MUST
 
             if ((item.getAttr('subscription')=='none'
@@ -73,20 +189,25 @@ class XMPPRoster(xmpp.roster.Roster):
                 self.Unsubscribe(jid=jid)
                 self.Subscribe(jid=jid)
 
+            groups = [group.getData() for group in item.getTags('group')]
+            if item_id in self._data and item_id in self._internal_data:
+                roster_item = self._data[item_id]
+                if (self._internal_data[item_id]['name'] == item.getAttr('name') and roster_item['ask'] == item.getAttr('ask')
+                    and roster_item['subscription'] == item.getAttr('subscription') and roster_item.get('groups') == groups):
+                    continue
+
             self.DEBUG('Setting roster item %s...'%item_id,'ok')
             if item_id not in  self._data:
                 self._new_roster_item(jid)
             roster_item = self._data[item_id]
             internal_data_item = self._get_item_internal_data(item_id)
-            roster_item['event_id'] = self.id_generator.id()
+            self._touch_item(roster_item)
             roster_item['name'] = item.getAttr('name')
             roster_item['ask'] = item.getAttr('ask')
             roster_item['subscription'] = item.getAttr('subscription')
             if roster_item['subscription'] == 'from' or roster_item['subscription'] == 'both':
                 roster_item['authorization'] = 'granted'
-            roster_item['groups'] = []
-            for group in item.getTags('group'):
-                roster_item['groups'].append(group.getData())
+            roster_item['groups'] = groups
 
             internal_data_item['name'] = item.getAttr('name')
 
@@ -94,6 +215,13 @@ class XMPPRoster(xmpp.roster.Roster):
 
         raise xmpp.protocol.NodeProcessed   # a MUST. Otherwise you'll get back an <iq type='error'/>
 
+    def RosterUnchangedHandler(self,dis,stanza):
+        """ Empty result of versioned roster request, roster has not changed since requested version
+            and changes, if any, come as roster pushes."""
+        if stanza.getID() == self._request_id and stanza.getTag('query') is None:
+            self.set=1
+            raise xmpp.protocol.NodeProcessed
+
     def PresenceHandler(self,dis,pres):
         """ Presence tracker. Used internally for setting items' resources state in
             internal roster representation. """
@@ -107,6 +235,7 @@ class XMPPRoster(xmpp.roster.Roster):
         internal_data = self._get_item_internal_data(item_id)
         roster_item_resources = internal_data['resources']
         typ=pres.getType()
+        self.presence_received += 1
 
         if not typ:
             self.DEBUG('Setting roster item %s for resource %s...'%(jid.getStripped(),jid.getResource()),'ok')
@@ -133,7 +262,7 @@ class XMPPRoster(xmpp.roster.Roster):
             if roster_item is None:
                 roster_item = self._new_roster_item(jid.getStripped())
                 roster_item['authorization'] = 'requested'
-                roster_item['event_id']=self.id_generator.id()
+                self._touch_item(roster_item)
             else:
                 if roster_item['subscription'] == 'to':
                     self.Authorize(roster_item['jid'])
@@ -141,30 +270,98 @@ class XMPPRoster(xmpp.roster.Roster):
         elif typ == 'subscribed':
             if item_id in self._data:
                 self._data[item_id]['authorization'] = 'granted'
-                self._data[item_id]['event_id']=self.id_generator.id()
+                self._touch_item(self._data[item_id])
 
         elif typ == 'unavailable' and jid.getResource() in roster_item_resources:
             del roster_item_resources[jid.getResource()]
 
         # Need to handle type='error' also
 
-        current_resource = None
+        if item_id not in self._data:
+            return
+
+        if typ is None or typ == 'unavailable':
+            if not self._presenceChanged(item_id):
+                self.presence_suppressed += 1
+                raise xmpp.protocol.NodeProcessed
+
+            if self.presence_debounce:
+                now = time.time()
+                publish_at = self._presence_published.get(item_id, 0) + self.presence_debounce
+                if now < publish_at:
+                    self.presence_debounced += 1
+                    if item_id not in self._presence_timeouts:
+                        self._presence_timeouts[item_id] = None
+                        self._owner.add_callback(self._deferPresence, item_id, publish_at)
+                    raise xmpp.protocol.NodeProcessed
+                self._presence_published[item_id] = now
+
+        self._publishPresence(item_id)
+
+    def _effectivePresence(self,item_id):
+        """ Returns show, status, nick and name of the item computed from its most prioritized resource."""
+        roster_item = self._data[item_id]
+        internal_data = self._get_item_internal_data(item_id)
+        roster_item_resources = internal_data['resources']
         if len(roster_item_resources):
             current_resource = max(roster_item_resources.itervalues(), key=operator.itemgetter('priority'))
         else:
             current_resource = {'priority':0,'show':'offline','status':None,'nick':None}
 
-        if item_id in self._data:
-            roster_item = self._data[item_id]
-            roster_item['event_id']=self.id_generator.id()
-            roster_item['show'] = current_resource['show']
-            roster_item['status'] = current_resource['status']
-            internal_data['nick'] = current_resource['nick']
-            if internal_data['name'] is None:
-                if current_resource['nick'] is not None:
-                    roster_item['name'] = current_resource['nick']
-                else:
-                    roster_item['name'] = jid.getStripped()
+        name = roster_item['name']
+        if internal_data['name'] is None:
+            if current_resource['nick'] is not None:
+                name = current_resource['nick']
+            else:
+                name = roster_item['jid']
+
+        return current_resource['show'], current_resource['status'], current_resource['nick'], name
+
+    def _presenceChanged(self,item_id):
+        roster_item = self._data[item_id]
+        show, status, nick, name = self._effectivePresence(item_id)
+        return (show != roster_item['show'] or status != roster_item['status'] or name != roster_item['name']
+                or nick != self._internal_data[item_id]['nick'])
+
+    def _publishPresence(self,item_id):
+        roster_item = self._data[item_id]
+        show, status, nick, name = self._effectivePresence(item_id)
+        self._touch_item(roster_item)
+        roster_item['show'] = show
+        roster_item['status'] = status
+        roster_item['name'] = name
+        self._internal_data[item_id]['nick'] = nick
+
+    def _deferPresence(self,item_id,publish_at):
+        """ Presence may be handled by XMPP IOLoop thread, so timeout is added by IOLoop."""
+        if item_id in self._presence_timeouts and self._presence_timeouts[item_id] is None:
+            self._presence_timeouts[item_id] = ioloop.IOLoop.instance().add_timeout(publish_at,
+                functools.partial(self._owner.add_callback, self._publishDeferredPresence, item_id))
+
+    def _publishDeferredPresence(self,item_id):
+        """ Called by IOLoop when debounce window of the item is over.
+            Publishes the latest presence if it differs from the published one.
+            Timeout cancelled by another thread may still fire, it is skipped then."""
+        if self._presence_timeouts.get(item_id) is None:
+            return
+        del self._presence_timeouts[item_id]
+        if item_id not in self._data or not self._presenceChanged(item_id):
+            return
+        self._presence_published[item_id] = time.time()
+        self._publishPresence(item_id)
+        self._owner.post_contacts_notification()
+
+    def cancelDeferredPresence(self):
+        io_loop = ioloop.IOLoop.instance()
+        for timeout in self._presence_timeouts.itervalues():
+            if timeout is not None:
+                self._owner.add_callback(io_loop.remove_timeout, timeout)
+        self._presence_timeouts = {}
+
+    def presenceStats(self):
+        return {'received':self.presence_received,
+                'suppressed':self.presence_suppressed,
+                'debounced':self.presence_debounced}
 
     def _getItemData(self,jid,dataname):
         """ Return specific jid's representation in internal format. Used internally. """
@@ -190,7 +387,7 @@ class XMPPRoster(xmpp.roster.Roster):
             item = self._data[item_id]
             if  read_offset > item['read_offset']:
                 item['read_offset'] = read_offset
-                item['event_id'] = self.id_generator.id()
+                self._touch_item(item)
                 return True
         return False
 
@@ -200,11 +397,16 @@ class XMPPRoster(xmpp.roster.Roster):
         else:
             return 0
 
-    def getContacts(self,event_offset=None):
-        contacts = self.getRawRoster().values()
-        if  event_offset is not None:
-            contacts = filter(lambda contact: contact['event_id'] > event_offset,contacts)
-        return contacts
+    def getContacts(self,event_offset=None,limit=None):
+        """ Returns contacts changed after event_offset in change order, at most limit contacts when limit is set.
+            Costs O(changed contacts) thanks to the change index."""
+        if  event_offset is None and limit is None:
+            return self.getRawRoster().values()
+        return self._changes.since(event_offset, limit=limit)
+
+    def contactChanges(self,event_offset=None):
+        """ Iterates over (event_id, contact) pairs changed after event_offset in change order."""
+        return self._changes.items_since(event_offset)
 
     def getRawItem(self,jid):
         """ Returns roster item 'jid' representation in internal format. """
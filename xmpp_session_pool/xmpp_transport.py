@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+__author__ = 'v.kovtash@gmail.com'
+
+import os
+import ssl
+import errno
+import select
+import time
+import socket
+import threading
+import xmpp
+from tornado import ioloop
+
+_ERRNO_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+_ERRNO_INPROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK)
+_SSL_WANT = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+
+DEFAULT_HIGH_WATER_MARK = 256 * 1024
+
+class XMPPAsyncSocket(xmpp.transports.TCPsocket):
+    """ Non-blocking connection driven by IOLoop events.
+        Connect, TLS handshake, reads and writes are reported to event_handler
+        as ('connected'), ('tls'), ('data', data), ('error', error) and ('detached').
+        Reading stops while there is no event_handler, see pause() and resume().
+        Connection may be handed over to IOLoop of another thread by move(), after that pause()
+        and disconnect() called by other threads are applied by that IOLoop.
+        Outgoing data is queued from any thread and written by IOLoop without blocking,
+        data sent during one IOLoop iteration goes out with a single write. Senders should
+        check backlogged and back off while more than high_water_mark bytes are queued.
+        detach() switches socket to blocking mode, after that connection is served
+        by Process based dispatchers like TCPsocket."""
+    def __init__(self, server, io_loop=None, high_water_mark=DEFAULT_HIGH_WATER_MARK):
+        xmpp.transports.TCPsocket.__init__(self, server, use_srv=False)
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.event_handler = None
+        self._sock = None
+        self._ssl = False
+        self._attached = False
+        self._connecting = False
+        self._handshaking = False
+        self._handshake_events = ioloop.IOLoop.READ
+        self._write_buffer = ''
+        self._write_queue = []
+        self._write_lock = threading.Lock()
+        self._flush_scheduled = False
+        self._seen_data = 0
+        self.last_received = None
+        self.high_water_mark = high_water_mark
+        self.queued_bytes = 0
+        self.sends = 0
+        self.writes = 0
+        self.flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._queued_since = None
+
+    def plugin(self, owner):
+        """ Connection is started by connect_async, so plugging in only registers the transport."""
+        self._owner.Connection = self
+        self._owner.RegisterDisconnectHandler(self.disconnected)
+        self.last_received = time.time()
+        return 'ok'
+
+    def plugout(self):
+        self.disconnect()
+        if self._owner.__dict__.has_key('Connection'):
+            del self._owner.Connection
+            self._owner.UnregisterDisconnectHandler(self.disconnected)
+
+    def connect_async(self, address, event_handler):
+        """ Starts connecting to address, which is (family, sockaddr) pair given by tornado Resolver."""
+        family, sockaddr = address
+        self.event_handler = event_handler
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.setblocking(0)
+        self._send = self._sock.send
+        self._recv = self._sock.recv
+        self._connecting = True
+        error = self._sock.connect_ex(sockaddr)
+        if error and error not in _ERRNO_INPROGRESS:
+            raise socket.error(error, os.strerror(error))
+        self.io_loop.add_handler(self._sock.fileno(), self._handle_events, ioloop.IOLoop.WRITE)
+        self._attached = True
+
+    def start_tls(self):
+        """ Wraps connected socket with TLS, handshake is performed on IOLoop events."""
+        self._sock = ssl.wrap_socket(self._sock, do_handshake_on_connect=False)
+        self._send = self._sock.send
+        self._recv = self._sock.recv
+        self._ssl = True
+        self._handshaking = True
+        self._do_handshake()
+        self._update_handler()
+
+    def pause(self):
+        """ Stops reading until resume(), received data stays in socket. Writes are still flushed."""
+        if not self._owned():
+            self.io_loop.add_callback(self.pause)
+            return
+        self.event_handler = None
+        if self._attached:
+            self._update_handler()
+
+    def resume(self, event_handler):
+        self.event_handler = event_handler
+        if self._attached:
+            self._update_handler()
+
+    def move(self, io_loop, event_handler):
+        """ Hands attached connection over to io_loop, which resumes reading with event_handler.
+            Should be called by the current IOLoop of connection, data left in socket is read by the new one."""
+        self.io_loop.remove_handler(self._sock.fileno())
+        self.event_handler = None
+        self.io_loop = io_loop
+        io_loop.add_callback(self._moved, event_handler)
+
+    def _moved(self, event_handler):
+        if not self._attached:
+            return
+        self.io_loop.add_handler(self._sock.fileno(), self._handle_events, ioloop.IOLoop.ERROR)
+        self.resume(event_handler)
+
+    def _owned(self):
+        """ Detached connection is not served by IOLoop, so any thread owns it."""
+        return not self._attached or ioloop.IOLoop.current() is self.io_loop
+
+    @property
+    def attached(self):
+        return self._attached
+
+    def detach(self):
+        """ Stops IOLoop handling and switches socket to blocking mode."""
+        if not self._attached:
+            return
+        self._event('detached')
+        self._remove_handler()
+        self._sock.setblocking(1)
+        self._take_queue()
+        if self._write_buffer:
+            self._sock.sendall(self._write_buffer)
+            self._write_buffer = ''
+        self._written(self.queued_bytes)
+        self._send = self._sock.sendall
+        self._recv = self._sock.recv
+        self.event_handler = None
+
+    def send(self, raw_data):
+        """ Queues data while attached to IOLoop, writes it blocking afterwards. May be called from any thread."""
+        if not self._attached:
+            return xmpp.transports.TCPsocket.send(self, raw_data)
+
+        if type(raw_data) == type(u''): raw_data = raw_data.encode('utf-8')
+        elif type(raw_data) <> type(''): raw_data = xmpp.simplexml.ustr(raw_data).encode('utf-8')
+        with self._write_lock:
+            self._write_queue.append(raw_data)
+            self.queued_bytes += len(raw_data)
+            self.sends += 1
+            if self._queued_since is None:
+                self._queued_since = time.time()
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+
+        self.io_loop.add_callback(self._flush_queue)
+
+    @property
+    def backlogged(self):
+        return self.queued_bytes > self.high_water_mark
+
+    def queue_stats(self):
+        return {'queued_bytes':self.queued_bytes,
+                'sends':self.sends,
+                'writes':self.writes,
+                'flush_latency':self.flush_latency,
+                'max_flush_latency':self.max_flush_latency}
+
+    def pending_data(self, timeout=0):
+        """ TLS socket may keep decrypted data which select does not see."""
+        if self._ssl and self._sock.pending():
+            return True
+        return select.select([self._sock], [], [], timeout)[0]
+
+    def disconnect(self):
+        if not self._owned():
+            self.io_loop.add_callback(self.disconnect)
+            return
+        if self._attached and not self._connecting and not self._handshaking:
+            try:
+                self._flush()
+            except (socket.error, ssl.SSLError):
+                pass
+        self._remove_handler()
+        if self._sock is not None:
+            self._sock.close()
+
+    def _handle_events(self, fd, events):
+        try:
+            if self._connecting:
+                self._handle_connect()
+            elif self._handshaking:
+                self._do_handshake()
+            else:
+                if events & ioloop.IOLoop.READ and self.event_handler is not None:
+                    self._handle_read()
+                if self._attached and not self._handshaking and events & ioloop.IOLoop.WRITE:
+                    self._flush()
+        except (socket.error, ssl.SSLError, IOError) as error:
+            self._fail(error)
+            return
+
+        if self._attached:
+            self._update_handler()
+
+    def _handle_connect(self):
+        error = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, os.strerror(error))
+        self._connecting = False
+        self._event('connected')
+
+    def _do_handshake(self):
+        try:
+            self._sock.do_handshake()
+        except ssl.SSLError as error:
+            if error.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._handshake_events = ioloop.IOLoop.READ
+                return
+            if error.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._handshake_events = ioloop.IOLoop.WRITE
+                return
+            raise
+        self._handshaking = False
+        self._event('tls')
+
+    def _handle_read(self):
+        """ Reads everything socket and TLS layer have, so nothing is left behind on detach."""
+        chunks = []
+        while True:
+            try:
+                chunk = self._recv(xmpp.transports.BUFLEN)
+            except ssl.SSLError as error:
+                if error.args[0] in _SSL_WANT:
+                    break
+                raise
+            except socket.error as error:
+                if error.args[0] in _ERRNO_WOULDBLOCK:
+                    break
+                raise
+            if not chunk:
+                if chunks:
+                    break
+                raise IOError('Disconnected from server')
+            chunks.append(chunk)
+
+        if chunks:
+            self._seen_data = 1
+            self.last_received = time.time()
+            self._event('data', ''.join(chunks))
+
+    def _flush_queue(self):
+        if not self._owned():
+            # Connection was moved to another IOLoop after the flush was scheduled
+            self.io_loop.add_callback(self._flush_queue)
+            return
+        with self._write_lock:
+            self._flush_scheduled = False
+
+        if not self._attached or self._connecting or self._handshaking:
+            return
+        try:
+            self._flush()
+        except (socket.error, ssl.SSLError) as error:
+            self._fail(error)
+            return
+        self._update_handler()
+
+    def _take_queue(self):
+        with self._write_lock:
+            if self._write_queue:
+                self._write_buffer += ''.join(self._write_queue)
+                self._write_queue = []
+
+    def _flush(self):
+        self._take_queue()
+        while self._write_buffer:
+            try:
+                sent = self._send(self._write_buffer)
+            except ssl.SSLError as error:
+                if error.args[0] in _SSL_WANT:
+                    break
+                raise
+            except socket.error as error:
+                if error.args[0] in _ERRNO_WOULDBLOCK:
+                    break
+                raise
+            self.writes += 1
+            self._write_buffer = self._write_buffer[sent:]
+            self._written(sent)
+
+    def _written(self, sent):
+        with self._write_lock:
+            self.queued_bytes -= sent
+            if self.queued_bytes or self._queued_since is None:
+                return
+            self.flush_latency = time.time() - self._queued_since
+            self.max_flush_latency = max(self.max_flush_latency, self.flush_latency)
+            self._queued_since = None
+
+    def _update_handler(self):
+        if self._connecting:
+            events = ioloop.IOLoop.WRITE
+        elif self._handshaking:
+            events = self._handshake_events
+        else:
+            events = 0
+            if self.event_handler is not None:
+                events |= ioloop.IOLoop.READ
+            if self._write_buffer or self._write_queue:
+                events |= ioloop.IOLoop.WRITE
+        self.io_loop.update_handler(self._sock.fileno(), events | ioloop.IOLoop.ERROR)
+
+    def _remove_handler(self):
+        if self._attached:
+            self._attached = False
+            self.io_loop.remove_handler(self._sock.fileno())
+
+    def _fail(self, error):
+        if not self._attached:
+            return
+        self._remove_handler()
+        self._event('error', error)
+
+    def _event(self, event, data=None):
+        if self.event_handler is not None:
+            self.event_handler(event, data)